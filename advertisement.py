@@ -0,0 +1,311 @@
+from bluepy.btle import Scanner, ScanEntry, DefaultDelegate, BTLEException
+from threading import Thread, Lock
+from battery import Battery, BatterySnapshot
+from utils import *
+from struct import *
+import time
+
+# Seconds one scan runs before the seen devices are cleared, and the wait after a scanner error
+ADV_SCAN_PERIOD = 10
+ADV_RESTART_DELAY = 5
+# Seconds get_settings() waits for the first advertisement, then the service gives up and is restarted
+ADV_FIRST_DATA_TIMEOUT = 300
+
+BTHOME_UUID = 0xfcd2
+BTHOME_ENCRYPTED = 0x01
+BTHOME_VERSION = 2
+
+# BTHome v2 object id: (field, struct format, factor). Fields starting with _ aren't used, they
+# are only listed to step over them.
+BTHOME_OBJECTS = {
+	0x00: ("_packet_id", "B", 1),
+	0x01: ("soc", "B", 1),
+	0x02: ("temp", "h", 0.01),
+	0x03: ("_humidity", "H", 0.01),
+	0x04: ("_pressure", "3", 0.01),
+	0x05: ("_illuminance", "3", 0.01),
+	0x06: ("_mass", "H", 0.01),
+	0x07: ("_mass_lb", "H", 0.01),
+	0x08: ("_dewpoint", "h", 0.01),
+	0x09: ("_count", "B", 1),
+	0x0a: ("_energy", "3", 0.001),
+	0x0b: ("_power", "3", 0.01),
+	0x0c: ("voltage", "H", 0.001),
+	0x0d: ("_pm25", "H", 1),
+	0x0e: ("_pm10", "H", 1),
+	0x0f: ("_generic", "B", 1),
+	0x10: ("_power_on", "B", 1),
+	0x11: ("_opening", "B", 1),
+	0x12: ("_co2", "H", 1),
+	0x13: ("_tvoc", "H", 1),
+	0x14: ("_moisture", "H", 0.01),
+	0x2e: ("_humidity", "B", 1),
+	0x2f: ("_moisture", "B", 1),
+	0x3a: ("_button", "B", 1),
+	0x3c: ("_dimmer", "H", 1),
+	0x3d: ("_count", "H", 1),
+	0x3e: ("_count", "I", 1),
+	0x3f: ("_rotation", "h", 0.1),
+	0x40: ("_distance", "H", 1),
+	0x41: ("_distance", "H", 0.1),
+	0x42: ("_duration", "3", 0.001),
+	0x43: ("current", "H", 0.001),
+	0x44: ("_speed", "H", 0.01),
+	0x45: ("temp", "h", 0.1),
+	0x46: ("_uv", "B", 0.1),
+	0x47: ("_volume", "H", 0.1),
+	0x48: ("_volume", "H", 1),
+	0x49: ("_flow", "H", 0.001),
+	0x4a: ("voltage", "H", 0.1),
+	0x4b: ("_gas", "3", 0.001),
+	0x4c: ("_gas", "I", 0.001),
+	0x4d: ("_energy", "I", 0.001),
+	0x4e: ("_volume", "I", 0.001),
+	0x4f: ("_water", "I", 0.001),
+	0x50: ("_timestamp", "I", 1),
+	0x51: ("_acceleration", "H", 0.001),
+	0x52: ("_gyroscope", "H", 0.001),
+	0x55: ("_volume", "I", 0.001),
+	0x56: ("_conductivity", "H", 1),
+	0x57: ("temp", "b", 1),
+	0x58: ("temp", "b", 0.35),
+	0x59: ("_count", "b", 1),
+	0x5a: ("_count", "h", 1),
+	0x5b: ("_count", "i", 1),
+	0x5c: ("_power", "i", 0.01),
+	0x5d: ("current", "h", 0.001),
+	0x5e: ("_direction", "H", 0.01),
+	0x5f: ("_precipitation", "H", 1),
+	0x60: ("_channel", "B", 1),
+}
+# Binary sensors (battery low, charging, ...), one byte each
+BTHOME_OBJECTS.update((objectId, ("_binary", "B", 1)) for objectId in range(0x15, 0x2e))
+# Objects with a length byte (text and raw)
+BTHOME_VARIABLE = (0x53, 0x54)
+
+
+def decode_bthome(data):
+	"""
+	Decode the service data of an unencrypted BTHome v2 advertisement (UUID 0xfcd2).
+
+	Returns a dict with the values of the battery fields it holds (soc, voltage, current, temps
+	and packet_id), None if data isn't BTHome v2 or is encrypted. Decoding stops at the first
+	unknown object, as its length isn't known.
+	"""
+	if data is None or len(data) < 3 or (data[0] | data[1] << 8) != BTHOME_UUID:
+		return None
+	info = data[2]
+	if info & BTHOME_ENCRYPTED or info >> 5 != BTHOME_VERSION:
+		return None
+
+	values = {}
+	temps = []
+	i = 3
+	end = len(data)
+	while i < end:
+		objectId = data[i]
+		i += 1
+		if objectId in BTHOME_VARIABLE:
+			if i >= end:
+				break
+			i += 1 + data[i]
+			continue
+
+		entry = BTHOME_OBJECTS.get(objectId)
+		if entry is None:
+			break
+		name, fmt, factor = entry
+		if fmt == "3":
+			if i + 3 > end:
+				break
+			value = data[i] | data[i + 1] << 8 | data[i + 2] << 16
+			i += 3
+		else:
+			size = calcsize(fmt)
+			if i + size > end:
+				break
+			value = unpack_from("<" + fmt, data, i)[0]
+			i += size
+
+		if name == "temp":
+			temps.append(value * factor)
+		elif name == "_packet_id":
+			values["packet_id"] = value
+		elif not name.startswith("_"):
+			values[name] = value * factor
+
+	if temps:
+		values["temps"] = tuple(temps)
+	return values
+
+
+
+class AdvScanner(DefaultDelegate, Thread):
+	"""
+	Scans continuously in the background and hands the advertisements of the registered
+	addresses to their listener, listener(entry) with the bluepy ScanEntry. Runs in its own
+	thread and needs no connection to any of the devices.
+	"""
+
+	def __init__(self):
+		DefaultDelegate.__init__(self)
+		Thread.__init__(self, name="adv-scanner")
+		# Thread will die with us if deamon
+		self.daemon = True
+
+		self.lock = Lock()
+		self.listeners = {}
+		self.running = False
+		self.advertisements = 0
+
+	def add(self, address, listener):
+		with self.lock:
+			self.listeners[address.lower()] = listener
+		if not self.running:
+			self.running = True
+			self.start()
+
+	def remove(self, address):
+		with self.lock:
+			self.listeners.pop(address.lower(), None)
+
+	def stop(self):
+		self.running = False
+
+	def run(self):
+		while self.running:
+			scanner = Scanner().withDelegate(self)
+			try:
+				scanner.start(passive=False)
+				while self.running:
+					end = time.monotonic() + ADV_SCAN_PERIOD
+					while self.running and time.monotonic() < end:
+						scanner.process(1)
+					# Forget the seen devices, they would pile up otherwise
+					scanner.clear()
+			except BTLEException as ex:
+				logger.info(f'Scanner failed, restarting: {ex}')
+				time.sleep(ADV_RESTART_DELAY)
+			finally:
+				try:
+					scanner.stop()
+				except Exception:
+					pass
+
+	def handleDiscovery(self, entry, isNewDev, isNewData):
+		listener = self.listeners.get(entry.addr)
+		if listener is not None and (isNewDev or isNewData):
+			self.advertisements += 1
+			listener(entry)
+
+
+
+scanner = None
+
+def get_scanner():
+	# The AdvScanner shared by all advertisement batteries of this process
+	global scanner
+	if scanner is None:
+		scanner = AdvScanner()
+	return scanner
+
+
+
+class AdvBt(Battery):
+	"""
+	A battery that is only read from its advertisements, without a connection. The decoder
+	turns the service data into a dict of battery fields, see decode_bthome().
+	"""
+
+	def __init__(self, address, decoder=decode_bthome):
+		Battery.__init__(self, 0, 0, address)
+
+		self.type = "BTHome BT"
+		self.address = address
+		self.port = "/adv" + address.replace(":", "")
+		self.decoder = decoder
+
+		# Only touched by the scanner thread, the poller only sees published snapshots
+		self.values = {}
+		self.packetId = None
+		self.dataTS = time.monotonic()
+
+		get_scanner().add(self.address, self.handleAdvertisement)
+
+	def test_connection(self):
+		return False
+
+	def get_settings(self):
+		result = self.apply_snapshot()
+		end = time.monotonic() + ADV_FIRST_DATA_TIMEOUT
+		while not result:
+			if time.monotonic() > end:
+				logger.error(f"No advertisement from {self.address} in {ADV_FIRST_DATA_TIMEOUT}s")
+				return False
+			time.sleep(1)
+			result = self.apply_snapshot()
+		self.max_battery_charge_current = MAX_BATTERY_CHARGE_CURRENT
+		self.max_battery_discharge_current = MAX_BATTERY_DISCHARGE_CURRENT
+		return result
+
+	def refresh_data(self):
+		# Advertisements are best effort, stale data is reported as a failed refresh
+		if time.monotonic() - self.dataTS > ADV_STALE_TIME:
+			return False
+		return self.apply_snapshot()
+
+	def log_settings(self):
+		# Override log_settings() to call get_settings() first
+		self.get_settings()
+		Battery.log_settings(self)
+
+	def handleAdvertisement(self, entry):
+		values = self.decoder(entry.getValue(ScanEntry.SERVICE_DATA_16B))
+		if not values:
+			return
+
+		# Devices repeat an advertisement several times, with the same packet id
+		packetId = values.pop("packet_id", None)
+		if packetId is not None and packetId == self.packetId:
+			return
+		self.packetId = packetId
+
+		self.dataTS = time.monotonic()
+		# Not every advertisement holds every field, keep the last value of the others
+		self.values.update(values)
+		if not all(k in self.values for k in ("soc", "voltage", "current")):
+			return
+
+		soc = self.values["soc"]
+		capacity = BATTERY_CAPACITY
+		self.publish_snapshot(BatterySnapshot(
+			timestamp=self.dataTS,
+			voltage=self.values["voltage"],
+			current=self.values["current"],
+			soc=soc,
+			capacity=capacity,
+			capacity_remain=capacity * soc / 100,
+			cycles=0,
+			total_ah_drawn=0,
+			# Advertisements have no FET state, don't block charging or discharging
+			charge_fet=True,
+			discharge_fet=True,
+			cell_count=ADV_CELL_COUNT,
+			temps=self.values.get("temps", ()),
+			balance_mask=0,
+			protection=0,
+		))
+
+
+
+# Unit test
+if __name__ == "__main__":
+	import sys
+
+	batt = AdvBt(sys.argv[1] if len(sys.argv) > 1 else "a4:c1:38:00:00:00")
+	batt.get_settings()
+
+	while True:
+		batt.refresh_data()
+		print("Voltage " + str(batt.voltage) + " Current " + str(batt.current) + " SOC " + str(batt.soc))
+		time.sleep(5)
@@ -4,11 +4,15 @@ from typing import Union, Tuple, List
 from utils import logger
 import utils
 import logging
-import math
+from array import array
 from datetime import timedelta
-from time import time
+from itertools import islice
+from time import time, monotonic
 from abc import ABC, abstractmethod
 
+# Stored in a CellArray for cells without a voltage reading
+NO_VOLTAGE = 0xFFFF
+
 
 class Protection(object):
     """
@@ -44,6 +48,239 @@ class Cell:
         self.balance = balance
 
 
+class CellView(Cell):
+    """
+    Read-only Cell compatible view on one cell of a CellArray
+    """
+
+    __slots__ = ("_cells", "_idx")
+
+    def __init__(self, cells, idx):
+        self._cells = cells
+        self._idx = idx
+
+    @property
+    def voltage(self) -> Union[float, None]:
+        return self._cells.get_voltage(self._idx)
+
+    @property
+    def balance(self) -> bool:
+        return self._cells.get_balance(self._idx)
+
+    @property
+    def temp(self) -> Union[float, None]:
+        return self._cells.get_temp(self._idx)
+
+
+class CellArray:
+    """
+    This class holds the cells of a battery in compact form: the voltages as millivolts in an
+    array, the balance flags as a bitmask and optional temperatures. Drivers update it in place.
+    Indexing and iterating returns read-only Cell compatible views for existing callers.
+    """
+
+    __slots__ = ("mv", "balance_mask", "temps")
+
+    def __init__(self, count: int = 0):
+        self.mv = array("H", [NO_VOLTAGE]) * count
+        self.balance_mask = 0
+        self.temps = None
+
+    def __len__(self) -> int:
+        return len(self.mv)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [CellView(self, i) for i in range(*idx.indices(len(self.mv)))]
+        if idx < 0:
+            idx += len(self.mv)
+        if not 0 <= idx < len(self.mv):
+            raise IndexError("cell index out of range")
+        return CellView(self, idx)
+
+    def __iter__(self):
+        for idx in range(len(self.mv)):
+            yield CellView(self, idx)
+
+    def resize(self, count: int) -> None:
+        """
+        Grow or shrink to count cells, keeping the data of the remaining cells
+        """
+        current = len(self.mv)
+        if count > current:
+            self.mv.extend(array("H", [NO_VOLTAGE]) * (count - current))
+        elif count < current:
+            del self.mv[count:]
+        self.balance_mask &= (1 << count) - 1
+        if self.temps is not None and len(self.temps) != count:
+            self.temps = (self.temps + [None] * count)[:count]
+
+    def get_voltage(self, idx: int) -> Union[float, None]:
+        mv = self.mv[idx]
+        return None if mv == NO_VOLTAGE else mv / 1000
+
+    def get_balance(self, idx: int) -> bool:
+        return (self.balance_mask >> idx) & 1 == 1
+
+    def set_balance_mask(self, mask: int) -> None:
+        self.balance_mask = mask & ((1 << len(self.mv)) - 1)
+
+    def get_temp(self, idx: int) -> Union[float, None]:
+        return None if self.temps is None else self.temps[idx]
+
+
+class CellStats:
+    """
+    This class holds statistics of the cells of a battery. They are computed in a single pass
+    over the cells when new data has been read, and shared by all the cell getters of Battery.
+    """
+
+    __slots__ = (
+        "count",
+        "min_cell",
+        "min_voltage",
+        "max_cell",
+        "max_voltage",
+        "sum",
+        "mean",
+        "spread",
+        "balancing",
+        "half1",
+        "half2",
+        "middle",
+    )
+
+    def __init__(self, cells: Union[CellArray, List[Cell]], cell_count: int):
+        n = min(len(cells), cell_count or 0)
+        halfcount = n // 2
+        upper_half = halfcount + n % 2
+
+        if isinstance(cells, CellArray):
+            self._from_array(cells, n, halfcount)
+            return
+
+        count = 0
+        min_cell = max_cell = None
+        min_voltage = 9999
+        max_voltage = 0
+        total = 0
+        half1 = 0
+        balancing = 0
+        for c in range(n):
+            cell = cells[c]
+            if cell.balance:
+                balancing = 1
+            voltage = cell.voltage
+            if voltage is None:
+                continue
+            count += 1
+            total += voltage
+            if voltage < min_voltage:
+                min_voltage = voltage
+                min_cell = c
+            if voltage > max_voltage:
+                max_voltage = voltage
+                max_cell = c
+            if c < halfcount:
+                half1 += voltage
+
+        self.count = count
+        self.min_cell = min_cell
+        self.min_voltage = None if min_cell is None else min_voltage
+        self.max_cell = max_cell
+        self.max_voltage = None if max_cell is None else max_voltage
+        self.sum = total
+        self.mean = total / count if count else None
+        self.spread = (
+            None if min_cell is None or max_cell is None else max_voltage - min_voltage
+        )
+        self.balancing = balancing
+        self.middle = cells[halfcount].voltage if n % 2 else 0
+        self.half1 = half1
+        self.half2 = total - half1 - (self.middle or 0) if upper_half < n else 0
+
+    def _from_array(self, cells: CellArray, n: int, halfcount: int) -> None:
+        mv = cells.mv if n == len(cells.mv) else cells.mv[:n]
+        if NO_VOLTAGE in mv:
+            # Not all cells have been read yet, do it by hand
+            self.__init__(list(islice(cells, n)), n)
+            return
+
+        self.count = n
+        self.balancing = 1 if cells.balance_mask & ((1 << n) - 1) else 0
+        if n == 0:
+            self.min_cell = self.min_voltage = self.max_cell = self.max_voltage = None
+            self.sum = self.half1 = self.half2 = self.middle = 0
+            self.mean = self.spread = None
+            return
+
+        # min(), max() and sum() run in C over the raw millivolts
+        min_mv = min(mv)
+        max_mv = max(mv)
+        total = sum(mv)
+        half1 = sum(islice(mv, halfcount))
+        middle = mv[halfcount] if n % 2 else 0
+
+        self.min_cell = mv.index(min_mv)
+        self.min_voltage = min_mv / 1000
+        self.max_cell = mv.index(max_mv)
+        self.max_voltage = max_mv / 1000
+        self.sum = total / 1000
+        self.mean = total / n / 1000
+        self.spread = (max_mv - min_mv) / 1000
+        self.middle = middle / 1000
+        self.half1 = half1 / 1000
+        self.half2 = (total - half1 - middle) / 1000
+
+
+class BatterySnapshot:
+    """
+    This class holds one immutable sample of a battery. Drivers build it in their own thread from
+    the BMS data and swap it in with Battery.publish_snapshot(). The publisher applies the latest
+    one with Battery.apply_snapshot(), so it never sees a half updated battery and never waits for
+    the driver. cell_mv is an array of millivolts that must not be changed once it is published,
+    protection is the raw protection word of the BMS, decoded by Battery.apply_protection().
+    """
+
+    __slots__ = (
+        "timestamp",
+        "voltage",
+        "current",
+        "soc",
+        "capacity",
+        "capacity_remain",
+        "cycles",
+        "total_ah_drawn",
+        "production",
+        "version",
+        "hardware_version",
+        "charge_fet",
+        "discharge_fet",
+        "cell_count",
+        "temps",
+        "cell_mv",
+        "balance_mask",
+        "protection",
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields.get(name))
+        if self.timestamp is None:
+            object.__setattr__(self, "timestamp", monotonic())
+
+    def __setattr__(self, name, value):
+        raise AttributeError("BatterySnapshot is read-only")
+
+    def replace(self, **changes) -> "BatterySnapshot":
+        """
+        Returns a copy of this snapshot with the given fields changed
+        """
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return BatterySnapshot(**fields)
+
+
 class Battery(ABC):
     """
     This Class is the abstract baseclass for all batteries. For each BMS this class needs to be extended
@@ -76,7 +313,8 @@ class Battery(ABC):
         self.temp_sensors = None
         self.temp1 = None
         self.temp2 = None
-        self.cells: List[Cell] = []
+        self.cells: CellArray = CellArray()
+        self.cell_stats: Union[CellStats, None] = None
         self.control_charging = None
         self.control_voltage = None
         self.allow_max_voltage = True
@@ -93,6 +331,11 @@ class Battery(ABC):
         self.max_battery_discharge_current = None
 
         self.time_to_soc_update = utils.TIME_TO_SOC_LOOP_CYCLES
+        # called by the driver when a fresh sample has arrived from the BMS
+        self.data_callback = None
+        # latest sample of the driver thread, and the one applied to this object
+        self.snapshot: Union[BatterySnapshot, None] = None
+        self.applied_snapshot: Union[BatterySnapshot, None] = None
 
     @abstractmethod
     def test_connection(self) -> bool:
@@ -127,6 +370,94 @@ class Battery(ABC):
         """
         return False
 
+    def set_data_callback(self, callback) -> None:
+        """
+        Register a function that is called without arguments every time the driver
+        receives a new sample from the BMS. It may be called from the driver's thread.
+        """
+        self.data_callback = callback
+
+    def notify_data(self) -> None:
+        """
+        Drivers call this after storing a fresh sample, so it can be published right away
+        """
+        if self.data_callback is not None:
+            self.data_callback()
+
+    def publish_snapshot(self, snapshot: BatterySnapshot, notify: bool = True) -> None:
+        """
+        Called by the driver thread with a new sample. Replacing the reference is atomic,
+        the publisher picks it up with apply_snapshot().
+        """
+        self.snapshot = snapshot
+        if notify:
+            self.notify_data()
+
+    def apply_snapshot(self) -> bool:
+        """
+        Copy the latest snapshot to the attributes of this object. Drivers that publish
+        snapshots call it from refresh_data(), in the publisher thread.
+
+        :return: false if the driver has no data yet, true otherwise
+        """
+        snapshot = self.snapshot
+        if snapshot is None:
+            return False
+        if snapshot is self.applied_snapshot:
+            return True
+
+        self.voltage = snapshot.voltage
+        self.current = snapshot.current
+        self.soc = snapshot.soc
+        self.capacity = snapshot.capacity
+        self.capacity_remain = snapshot.capacity_remain
+        self.cycles = snapshot.cycles
+        self.total_ah_drawn = snapshot.total_ah_drawn
+        self.charge_fet = snapshot.charge_fet
+        self.discharge_fet = snapshot.discharge_fet
+        if snapshot.production is not None:
+            self.production = snapshot.production
+        if snapshot.version is not None:
+            self.version = snapshot.version
+        if snapshot.hardware_version is not None:
+            self.hardware_version = snapshot.hardware_version
+
+        self.cell_count = snapshot.cell_count
+        self.max_battery_voltage = utils.MAX_CELL_VOLTAGE * self.cell_count
+        self.min_battery_voltage = utils.MIN_CELL_VOLTAGE * self.cell_count
+        self.cells.resize(self.cell_count)
+        if snapshot.cell_mv is not None:
+            self.cells.mv[: len(snapshot.cell_mv)] = snapshot.cell_mv
+        self.cells.set_balance_mask(snapshot.balance_mask or 0)
+
+        self.temp_sensors = len(snapshot.temps)
+        for sensor, temp in enumerate(snapshot.temps, 1):
+            self.to_temp(sensor, temp)
+
+        self.apply_protection(snapshot.protection)
+        self.applied_snapshot = snapshot
+        return True
+
+    def apply_protection(self, protection) -> None:
+        """
+        Drivers that publish snapshots override this to decode the protection word of
+        the BMS into self.protection. It is called after all other values are applied.
+        """
+        pass
+
+    def refresh_cell_stats(self) -> CellStats:
+        """
+        Recalculate the cell statistics. Called each poll after refresh_data(), the
+        cell getters use the result until the next call.
+        """
+        self.cell_stats = CellStats(self.cells, self.cell_count)
+        return self.cell_stats
+
+    def get_cell_stats(self) -> CellStats:
+        if self.cell_stats is None:
+            return self.refresh_cell_stats()
+        return self.cell_stats
+
     def to_temp(self, sensor: int, value: float) -> None:
         """
         Keep the temp value between -20 and 100 to handle sensor issues or no data.
@@ -158,20 +489,22 @@ class Battery(ABC):
         """
         foundHighCellVoltage = False
         if utils.CVCM_ENABLE:
-            currentBatteryVoltage = 0
+            stats = self.get_cell_stats()
+            currentBatteryVoltage = stats.sum
             penaltySum = 0
-            for i in range(self.cell_count):
+            # Only look at the single cells when at least one of them gets a penalty
+            cell_count = (
+                self.cell_count
+                if stats.max_voltage is not None
+                and stats.max_voltage >= utils.PENALTY_AT_CELL_VOLTAGE[0]
+                else 0
+            )
+            for i in range(cell_count):
                 cv = self.get_cell_voltage(i)
                 if cv:
-                    currentBatteryVoltage += cv
-
                     if cv >= utils.PENALTY_AT_CELL_VOLTAGE[0]:
                         foundHighCellVoltage = True
-                        penaltySum += utils.calcLinearRelationship(
-                            cv,
-                            utils.PENALTY_AT_CELL_VOLTAGE,
-                            utils.PENALTY_BATTERY_VOLTAGE,
-                        )
+                        penaltySum += utils.PENALTY_CURVE.linear(cv)
             self.voltage = currentBatteryVoltage  # for testing
 
         if foundHighCellVoltage:
@@ -190,10 +523,7 @@ class Battery(ABC):
         """
         voltageSum = 0
         if utils.CVCM_ENABLE:
-            for i in range(self.cell_count):
-                voltage = self.get_cell_voltage(i)
-                if voltage:
-                    voltageSum += voltage
+            voltageSum = self.get_cell_stats().sum
 
             if self.max_voltage_start_time is None:
                 if (
@@ -262,161 +592,70 @@ class Battery(ABC):
     def calcMaxChargeCurrentReferringToCellVoltage(self) -> float:
         try:
             if utils.LINEAR_LIMITATION_ENABLE:
-                return utils.calcLinearRelationship(
-                    self.get_max_cell_voltage(),
-                    utils.CELL_VOLTAGES_WHILE_CHARGING,
-                    utils.MAX_CHARGE_CURRENT_CV,
-                )
-            return utils.calcStepRelationship(
-                self.get_max_cell_voltage(),
-                utils.CELL_VOLTAGES_WHILE_CHARGING,
-                utils.MAX_CHARGE_CURRENT_CV,
-                False,
-            )
+                return utils.CHARGE_CURRENT_CV_CURVE.linear(self.get_max_cell_voltage())
+            return utils.CHARGE_CURRENT_CV_CURVE.step(self.get_max_cell_voltage(), False)
         except Exception:
             return self.max_battery_charge_current
 
     def calcMaxDischargeCurrentReferringToCellVoltage(self) -> float:
         try:
             if utils.LINEAR_LIMITATION_ENABLE:
-                return utils.calcLinearRelationship(
-                    self.get_min_cell_voltage(),
-                    utils.CELL_VOLTAGES_WHILE_DISCHARGING,
-                    utils.MAX_DISCHARGE_CURRENT_CV,
+                return utils.DISCHARGE_CURRENT_CV_CURVE.linear(
+                    self.get_min_cell_voltage()
                 )
-            return utils.calcStepRelationship(
-                self.get_min_cell_voltage(),
-                utils.CELL_VOLTAGES_WHILE_DISCHARGING,
-                utils.MAX_DISCHARGE_CURRENT_CV,
-                True,
+            return utils.DISCHARGE_CURRENT_CV_CURVE.step(
+                self.get_min_cell_voltage(), True
             )
         except Exception:
             return self.max_battery_charge_current
 
     def calcMaxChargeCurrentReferringToTemperature(self) -> float:
-        if self.get_max_temp() is None:
+        max_temp = self.get_max_temp()
+        if max_temp is None:
             return self.max_battery_charge_current
+        min_temp = self.get_min_temp()
 
-        temps = {0: self.get_max_temp(), 1: self.get_min_temp()}
-
-        for key, currentMaxTemperature in temps.items():
-            if utils.LINEAR_LIMITATION_ENABLE:
-                temps[key] = utils.calcLinearRelationship(
-                    currentMaxTemperature,
-                    utils.TEMPERATURE_LIMITS_WHILE_CHARGING,
-                    utils.MAX_CHARGE_CURRENT_T,
-                )
-            else:
-                temps[key] = utils.calcStepRelationship(
-                    currentMaxTemperature,
-                    utils.TEMPERATURE_LIMITS_WHILE_CHARGING,
-                    utils.MAX_CHARGE_CURRENT_T,
-                    False,
-                )
-
-        return min(temps[0], temps[1])
+        curve = utils.CHARGE_CURRENT_T_CURVE
+        if utils.LINEAR_LIMITATION_ENABLE:
+            return min(curve.linear(max_temp), curve.linear(min_temp))
+        return min(curve.step(max_temp, False), curve.step(min_temp, False))
 
     def calcMaxDischargeCurrentReferringToTemperature(self) -> float:
-        if self.get_max_temp() is None:
+        max_temp = self.get_max_temp()
+        if max_temp is None:
             return self.max_battery_discharge_current
+        min_temp = self.get_min_temp()
 
-        temps = {0: self.get_max_temp(), 1: self.get_min_temp()}
-
-        for key, currentMaxTemperature in temps.items():
-            if utils.LINEAR_LIMITATION_ENABLE:
-                temps[key] = utils.calcLinearRelationship(
-                    currentMaxTemperature,
-                    utils.TEMPERATURE_LIMITS_WHILE_DISCHARGING,
-                    utils.MAX_DISCHARGE_CURRENT_T,
-                )
-            else:
-                temps[key] = utils.calcStepRelationship(
-                    currentMaxTemperature,
-                    utils.TEMPERATURE_LIMITS_WHILE_DISCHARGING,
-                    utils.MAX_DISCHARGE_CURRENT_T,
-                    True,
-                )
-
-        return min(temps[0], temps[1])
+        curve = utils.DISCHARGE_CURRENT_T_CURVE
+        if utils.LINEAR_LIMITATION_ENABLE:
+            return min(curve.linear(max_temp), curve.linear(min_temp))
+        return min(curve.step(max_temp, True), curve.step(min_temp, True))
 
     def calcMaxChargeCurrentReferringToSoc(self) -> float:
         try:
-            # Create value list. Will more this to the settings object
-            SOC_WHILE_CHARGING = [
-                100,
-                utils.CC_SOC_LIMIT1,
-                utils.CC_SOC_LIMIT2,
-                utils.CC_SOC_LIMIT3,
-            ]
-            MAX_CHARGE_CURRENT_SOC = [
-                utils.CC_CURRENT_LIMIT1,
-                utils.CC_CURRENT_LIMIT2,
-                utils.CC_CURRENT_LIMIT3,
-                utils.MAX_BATTERY_CHARGE_CURRENT,
-            ]
             if utils.LINEAR_LIMITATION_ENABLE:
-                return utils.calcLinearRelationship(
-                    self.soc, SOC_WHILE_CHARGING, MAX_CHARGE_CURRENT_SOC
-                )
-            return utils.calcStepRelationship(
-                self.soc, SOC_WHILE_CHARGING, MAX_CHARGE_CURRENT_SOC, True
-            )
+                return utils.CHARGE_CURRENT_SOC_CURVE.linear(self.soc)
+            return utils.CHARGE_CURRENT_SOC_CURVE.step(self.soc, True)
         except Exception:
             return self.max_battery_charge_current
 
     def calcMaxDischargeCurrentReferringToSoc(self) -> float:
         try:
-            # Create value list. Will more this to the settings object
-            SOC_WHILE_DISCHARGING = [
-                utils.DC_SOC_LIMIT3,
-                utils.DC_SOC_LIMIT2,
-                utils.DC_SOC_LIMIT1,
-            ]
-            MAX_DISCHARGE_CURRENT_SOC = [
-                utils.MAX_BATTERY_DISCHARGE_CURRENT,
-                utils.DC_CURRENT_LIMIT3,
-                utils.DC_CURRENT_LIMIT2,
-                utils.DC_CURRENT_LIMIT1,
-            ]
             if utils.LINEAR_LIMITATION_ENABLE:
-                return utils.calcLinearRelationship(
-                    self.soc, SOC_WHILE_DISCHARGING, MAX_DISCHARGE_CURRENT_SOC
-                )
-            return utils.calcStepRelationship(
-                self.soc, SOC_WHILE_DISCHARGING, MAX_DISCHARGE_CURRENT_SOC, True
-            )
+                return utils.DISCHARGE_CURRENT_SOC_CURVE.linear(self.soc)
+            return utils.DISCHARGE_CURRENT_SOC_CURVE.step(self.soc, True)
         except Exception:
             return self.max_battery_charge_current
 
     def get_min_cell(self) -> int:
-        min_voltage = 9999
-        min_cell = None
         if len(self.cells) == 0 and hasattr(self, "cell_min_no"):
             return self.cell_min_no
-
-        for c in range(min(len(self.cells), self.cell_count)):
-            if (
-                self.cells[c].voltage is not None
-                and min_voltage > self.cells[c].voltage
-            ):
-                min_voltage = self.cells[c].voltage
-                min_cell = c
-        return min_cell
+        return self.get_cell_stats().min_cell
 
     def get_max_cell(self) -> int:
-        max_voltage = 0
-        max_cell = None
         if len(self.cells) == 0 and hasattr(self, "cell_max_no"):
             return self.cell_max_no
-
-        for c in range(min(len(self.cells), self.cell_count)):
-            if (
-                self.cells[c].voltage is not None
-                and max_voltage < self.cells[c].voltage
-            ):
-                max_voltage = self.cells[c].voltage
-                max_cell = c
-        return max_cell
+        return self.get_cell_stats().max_cell
 
     def get_min_cell_desc(self) -> Union[str, None]:
         cell_no = self.get_min_cell()
@@ -429,14 +668,12 @@ class Battery(ABC):
     def get_cell_voltage(self, idx) -> Union[float, None]:
         if idx >= min(len(self.cells), self.cell_count):
             return None
-        return self.cells[idx].voltage
+        return self.cells.get_voltage(idx)
 
     def get_cell_balancing(self, idx) -> Union[int, None]:
         if idx >= min(len(self.cells), self.cell_count):
             return None
-        if self.cells[idx].balance is not None and self.cells[idx].balance:
-            return 1
-        return 0
+        return 1 if self.cells.get_balance(idx) else 0
 
     def get_capacity_remain(self) -> Union[float, None]:
         if self.capacity_remain is not None:
@@ -473,12 +710,7 @@ class Battery(ABC):
             min_voltage = self.cell_min_voltage
 
         if min_voltage is None:
-            try:
-                min_voltage = min(
-                    c.voltage for c in self.cells if c.voltage is not None
-                )
-            except ValueError:
-                pass
+            min_voltage = self.get_cell_stats().min_voltage
         return min_voltage
 
     def get_max_cell_voltage(self) -> Union[float, None]:
@@ -487,12 +719,7 @@ class Battery(ABC):
             max_voltage = self.cell_max_voltage
 
         if max_voltage is None:
-            try:
-                max_voltage = max(
-                    c.voltage for c in self.cells if c.voltage is not None
-                )
-            except ValueError:
-                pass
+            max_voltage = self.get_cell_stats().max_voltage
         return max_voltage
 
     def get_midvoltage(self) -> Tuple[Union[float, None], Union[float, None]]:
@@ -511,27 +738,17 @@ class Battery(ABC):
         ):
             return None, None
 
-        halfcount = int(math.floor(self.cell_count / 2))
-        uneven_cells_offset = self.cell_count % 2
-        half1voltage = 0
-        half2voltage = 0
-
-        try:
-            half1voltage = sum(
-                cell.voltage
-                for cell in self.cells[:halfcount]
-                if cell.voltage is not None
-            )
-            half2voltage = sum(
-                cell.voltage
-                for cell in self.cells[halfcount + uneven_cells_offset :]
-                if cell.voltage is not None
-            )
-        except ValueError:
-            pass
+        stats = self.get_cell_stats()
+        # Without all cell voltages, e.g. a pack that doesn't report them, there is no midpoint
+        if stats.count < self.cell_count:
+            return None, None
+        half1voltage = stats.half1
+        half2voltage = stats.half2
+        if half1voltage + half2voltage == 0:
+            return None, None
 
         try:
-            extra = 0 if self.cell_count % 2 == 0 else self.cells[halfcount].voltage / 2
+            extra = 0 if self.cell_count % 2 == 0 else stats.middle / 2
             # get the midpoint of the battery
             midpoint = half1voltage + extra
             return (
@@ -542,10 +759,7 @@ class Battery(ABC):
             return None, None
 
     def get_balancing(self) -> int:
-        for c in range(min(len(self.cells), self.cell_count)):
-            if self.cells[c].balance is not None and self.cells[c].balance:
-                return 1
-        return 0
+        return self.get_cell_stats().balancing
 
     def extract_from_temp_values(self, extractor) -> Union[float, None]:
         if self.temp1 is not None and self.temp2 is not None:
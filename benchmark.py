@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Measures the process and memory cost of each BMS connection of this driver.
+#
+#   python3 benchmark.py [--bms JBD|JK] [--time 60] address [address ...]
+#
+# Creates one driver per address, lets them connect and poll, then prints the RSS of this
+# process and of its bluepy-helper processes, overall and per pack.
+import argparse
+import os
+import threading
+import time
+
+
+
+def read_rss(pid):
+	# Resident set size of a process in kB, 0 if it is gone
+	try:
+		with open("/proc/%d/status" % pid) as f:
+			for line in f:
+				if line.startswith("VmRSS:"):
+					return int(line.split()[1])
+	except OSError:
+		pass
+	return 0
+
+
+def helper_pids():
+	# The bluepy-helper processes started by this process
+	pids = []
+	me = os.getpid()
+	for entry in os.listdir("/proc"):
+		if not entry.isdigit():
+			continue
+		try:
+			with open("/proc/%s/stat" % entry) as f:
+				stat = f.read()
+		except OSError:
+			continue
+		# pid (comm) state ppid ...
+		comm = stat[stat.index("(") + 1:stat.rindex(")")]
+		ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+		if ppid == me and comm.startswith("bluepy-helper"):
+			pids.append(int(entry))
+	return pids
+
+
+def open_fds():
+	return len(os.listdir("/proc/self/fd"))
+
+
+def report(label, packs, baseline):
+	helpers = helper_pids()
+	rss = read_rss(os.getpid())
+	helper_rss = sum(read_rss(pid) for pid in helpers)
+	fds = open_fds()
+	threads = threading.active_count()
+
+	print(label)
+	print("  driver RSS       %6d kB" % rss)
+	print("  helpers          %6d (%d kB)" % (len(helpers), helper_rss))
+	print("  threads          %6d" % threads)
+	print("  open fds         %6d" % fds)
+	if packs and baseline:
+		print("  per pack         %6d kB, %.1f helpers, %.1f threads, %.1f fds" % (
+			(rss + helper_rss - baseline[0]) / packs,
+			(len(helpers) - baseline[1]) / packs,
+			(threads - baseline[2]) / packs,
+			(fds - baseline[3]) / packs,
+		))
+	return rss + helper_rss, len(helpers), threads, fds
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Per pack resource usage of dbus-btbattery")
+	parser.add_argument("--bms", default="JBD", help="BMS driver, JBD or JK")
+	parser.add_argument("--time", type=float, default=60, help="seconds to run before measuring")
+	parser.add_argument("addresses", nargs="+", help="BT addresses of the packs")
+	args = parser.parse_args()
+
+	# Import after parsing, so --help works without bluepy
+	if args.bms.upper() == "JK":
+		from jkbt import JkBt as bms
+	else:
+		from jbdbt import JbdBt as bms
+
+	baseline = report("Before connecting", 0, None)
+
+	batteries = [bms(address) for address in args.addresses]
+	end = time.monotonic() + args.time
+	while time.monotonic() < end:
+		for battery in batteries:
+			battery.refresh_data()
+		time.sleep(1)
+
+	report("After %d s with %d pack(s)" % (args.time, len(batteries)), len(batteries), baseline)
+	os._exit(0)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,57 @@
+from collections import namedtuple
+
+
+# name: attribute (or with setter, method) of the target that receives the flag
+# bit: bit number in the word, 0 is the least significant bit
+# on/off: value for a set/cleared bit
+Flag = namedtuple("Flag", ["name", "bit", "on", "off", "setter"], defaults=[True, False, False])
+
+
+class Bitfield(object):
+	"""
+	Table driven decoder for the flag words BMSes report, declared as a list of Flags.
+
+	For every byte of the word that holds flags, a 256 entry table with the resulting
+	(name, value, setter) triples is built once, so decoding a word is one table lookup per
+	byte instead of testing bits one by one.
+	"""
+
+	def __init__(self, width, flags):
+		self.width = width
+		self.flags = tuple(flags)
+		self.masks = {f.name: 1 << f.bit for f in self.flags}
+		self.mask = 0
+		for f in self.flags:
+			self.mask |= 1 << f.bit
+
+		self.lanes = []
+		for shift in range(0, width, 8):
+			lane = [f for f in self.flags if shift <= f.bit < shift + 8]
+			if not lane:
+				continue
+			table = tuple(
+				tuple((f.name, f.on if byte >> (f.bit - shift) & 1 else f.off, f.setter) for f in lane)
+				for byte in range(256)
+			)
+			self.lanes.append((shift, table))
+
+	def apply(self, target, value):
+		# Set the attributes, or call the setters, of target for all flags in value
+		for shift, table in self.lanes:
+			for name, flag, setter in table[(value >> shift) & 0xff]:
+				if setter:
+					getattr(target, name)(flag)
+				else:
+					setattr(target, name, flag)
+
+	def decode(self, value):
+		# Dictionary of flag name to value
+		result = {}
+		for shift, table in self.lanes:
+			for name, flag, setter in table[(value >> shift) & 0xff]:
+				result[name] = flag
+		return result
+
+	def unknown(self, value):
+		# The set bits of value that aren't declared
+		return value & ~self.mask & ((1 << self.width) - 1)
@@ -0,0 +1,660 @@
+from bluepy.btle import Peripheral, DefaultDelegate, BTLEException, BTLEDisconnectError, BTLEInternalError
+from threading import Thread, Condition
+from collections import Counter
+from utils import *
+import bisect
+import heapq
+import itertools
+import os
+import random
+import re
+import time
+
+# Reconnect backoff: the delay starts at BT_RECONNECT_DELAY and doubles with every failed attempt
+# up to BT_RECONNECT_MAX seconds. The actual delay is randomly between half and all of it, so packs
+# that drop out together don't retry in lockstep.
+BT_RECONNECT_DELAY = 3
+BT_RECONNECT_MAX = 120
+# Longest delay of the first attempt after a connection that worked was lost
+BT_RECONNECT_FAST = 0.5
+# A device is drained until it was silent for this many seconds
+BT_QUIET_TIME = 0.2
+# Weight of the last poll in the average poll duration of a link
+BT_AIRTIME_WEIGHT = 0.2
+# Longest time a time-sliced link stays connected while waiting for a sample
+BT_SLICE_TIMEOUT = 10
+# Time-sliced links connect for every sample, that is only logged at debug level. Their
+# statistics are logged every this many slices.
+BT_SLICE_SUMMARY = 100
+# A cycle closes when every link delivered a sample, or after maxStaleness seconds (this many
+# without one), the links that didn't are counted as missed deadlines. The cycle statistics
+# are logged every BT_CYCLE_SUMMARY cycles.
+BT_CYCLE_DEADLINE = 300
+BT_CYCLE_SUMMARY = 10
+# Link quality is the average success of the recent connection attempts and polls, with this
+# weight for the last one. A link is only moved to another adapter after BT_MIGRATE_ATTEMPTS
+# attempts on its adapter, and at most every BT_MIGRATE_INTERVAL seconds.
+BT_QUALITY_WEIGHT = 0.2
+BT_MIGRATE_ATTEMPTS = 5
+BT_MIGRATE_INTERVAL = 300
+# Buckets of the connection histograms in seconds, the last one holds everything above
+BT_LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 30)
+
+
+
+class Histogram(object):
+	# Counts of values in fixed buckets
+	__slots__ = ("bounds", "counts", "total", "sum")
+
+	def __init__(self, bounds):
+		self.bounds = tuple(bounds)
+		self.counts = [0] * (len(self.bounds) + 1)
+		self.total = 0
+		self.sum = 0
+
+	def add(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.total += 1
+		self.sum += value
+
+	def __str__(self):
+		if not self.total:
+			return "none"
+		buckets = [f"<{b}s:{n}" for b, n in zip(self.bounds, self.counts)]
+		buckets.append(f">={self.bounds[-1]}s:{self.counts[-1]}")
+		return " ".join(buckets) + f" (n={self.total}, avg {self.sum / self.total:.2f}s)"
+
+
+
+class BtLink(DefaultDelegate):
+	"""
+	The connection of one BMS, driven by a BtManager.
+
+	The protocol handler (the BMS driver) is also the bluepy delegate of the connection, the
+	link only takes the first notification of a connection to time it. The handler implements:
+		address			the BT address of the BMS
+		interval		seconds between two polls
+		onConnect(link)		set up the connection, e.g. subscribe and send the initial commands
+		onDisconnect(link)	forget any partial state of the connection
+		poll(link)		send the requests of one poll, false if they got no sample
+		handleNotification(handle, data)
+
+	A link is only ever stepped by one worker at a time, so handlers don't need locking.
+
+	Failed connection attempts back off exponentially with jitter, while the first attempt after
+	losing a working connection is made right away. Connect latency, time to the first data and
+	disconnect causes are kept per link.
+	"""
+
+	def __init__(self, handler, manager, addrType="public"):
+		DefaultDelegate.__init__(self)
+		self.handler = handler
+		self.manager = manager
+		self.address = handler.address
+		self.addrType = addrType
+		self.peripheral = None
+		self.connected = False
+		self.nextPoll = 0
+		# Poll interval after the airtime budget, and the average time a poll takes
+		self.interval = handler.interval
+		self.airtime = 0
+		# Set from other threads to have the worker reconnect, with a new Peripheral if restart
+		self.reconnect = False
+		self.restart = False
+
+		self.failures = 0
+		self.connectedAt = None
+		self.openedAt = None
+		self.lastSample = 0
+		self.quality = 1.0
+		self.attempts = 0
+		self.since = time.monotonic()
+		self.connectLatency = Histogram(BT_LATENCY_BUCKETS)
+		self.firstData = Histogram(BT_LATENCY_BUCKETS)
+		self.disconnects = Counter()
+
+	def step(self):
+		# Do the work that is due and return when the link wants to be stepped again
+		try:
+			if self.reconnect:
+				self.reconnect = False
+				self.close('requested')
+				if self.restart:
+					self.restart = False
+					self.peripheral = None
+				return time.monotonic() + random.uniform(0, BT_RECONNECT_FAST)
+
+			if not self.connected:
+				self.open()
+
+			now = time.monotonic()
+			sampled = False
+			if now >= self.nextPoll:
+				sampled = self.handler.poll(self) is not False
+				self.airtime += (time.monotonic() - now - self.airtime) * BT_AIRTIME_WEIGHT
+				self.interval = self.manager.stretch(self.handler.interval)
+				self.nextPoll = now + self.interval
+			self.drain(BT_QUIET_TIME)
+
+			if sampled:
+				self.manager.sampled(self, now)
+				self.lastSample = now
+				self.rate(True)
+			if self.manager.sliced():
+				# Give the connection back once we have the sample, or waited long enough for it
+				if sampled or time.monotonic() - self.openedAt > BT_SLICE_TIMEOUT:
+					if not sampled:
+						self.rate(False)
+					self.close('slice')
+					return self.nextPoll
+
+		except (BTLEException, BrokenPipeError) as ex:
+			self.rate(False)
+			if not self.connected:
+				self.close('connect failed')
+				return time.monotonic() + self.backoff()
+
+			if isinstance(ex, BTLEDisconnectError):
+				self.close('link lost', ex)
+			elif isinstance(ex, (BTLEInternalError, BrokenPipeError)):
+				self.close('helper failed', ex)
+			else:
+				self.close('error', ex)
+			return time.monotonic() + random.uniform(0, BT_RECONNECT_FAST)
+
+		return self.nextPoll
+
+	def rate(self, success):
+		self.attempts += 1
+		self.quality += ((1.0 if success else 0.0) - self.quality) * BT_QUALITY_WEIGHT
+
+	def degraded(self, threshold):
+		# True when the link has been bad for long enough to try another adapter
+		return (
+			self.attempts >= BT_MIGRATE_ATTEMPTS
+			and self.quality < threshold
+			and time.monotonic() - self.since > BT_MIGRATE_INTERVAL
+		)
+
+	def backoff(self):
+		delay = min(BT_RECONNECT_MAX, BT_RECONNECT_DELAY * 2 ** min(self.failures - 1, 16))
+		return delay / 2 + random.uniform(0, delay / 2)
+
+	def open(self):
+		if self.peripheral is None:
+			self.peripheral = Peripheral()
+		# Take the first notification to time it, then hand the connection to the handler
+		self.peripheral.withDelegate(self)
+
+		# Time-sliced links reconnect all the time, don't flood the log with it
+		log = logger.debug if self.manager.sliced() else logger.info
+		log('Connecting ' + self.address + ' on ' + self.manager.adapter)
+		start = time.monotonic()
+		try:
+			self.peripheral.connect(self.address, addrType=self.addrType, iface=self.manager.iface)
+			self.connectedAt = self.openedAt = time.monotonic()
+			self.nextPoll = 0
+			self.handler.onConnect(self)
+		except (BTLEException, BrokenPipeError) as ex:
+			self.failures += 1
+			logger.info(f'Connection to {self.address} failed ({self.failures} in a row): {ex}')
+			raise
+		self.connected = True
+		self.failures = 0
+		self.connectLatency.add(self.connectedAt - start)
+		log('Connected ' + self.address)
+
+	def close(self, cause, reason=None):
+		self.disconnects[cause] += 1
+		if self.connected:
+			log = logger.debug if cause == 'slice' else logger.info
+			log('Disconnected ' + self.address + ': ' + cause + (' (' + str(reason) + ')' if reason else ''))
+			if cause != 'slice' or self.disconnects[cause] % BT_SLICE_SUMMARY == 0:
+				logger.info(self.summary())
+			else:
+				logger.debug(self.summary())
+		self.connected = False
+		self.connectedAt = None
+		self.handler.onDisconnect(self)
+		try:
+			self.peripheral.disconnect()
+		except Exception:
+			pass
+
+	def handleNotification(self, handle, data):
+		if self.connectedAt is not None:
+			self.firstData.add(time.monotonic() - self.connectedAt)
+			self.connectedAt = None
+		self.peripheral.withDelegate(self.handler)
+		self.handler.handleNotification(handle, data)
+
+	def summary(self):
+		causes = ", ".join(f"{cause} {n}" for cause, n in self.disconnects.most_common())
+		return (
+			f"{self.address} connect latency: {self.connectLatency}; first data: {self.firstData}; "
+			f"disconnects: {causes or 'none'}"
+		)
+
+	def killHelper(self):
+		# Safe from any thread: a bluepy call that hangs in the helper fails once it is gone
+		helper = getattr(self.peripheral, "_helper", None)
+		if helper is not None:
+			try:
+				helper.kill()
+			except OSError:
+				pass
+		self.restart = True
+		self.reconnect = True
+
+	def write(self, handle, data, withResponse=False):
+		return self.peripheral.writeCharacteristic(handle, data, withResponse)
+
+	def wait(self, timeout):
+		# Deliver the notifications that arrive within timeout, true if there was one
+		return self.peripheral.waitForNotifications(timeout)
+
+	def drain(self, quiet):
+		# Deliver notifications until the device was silent for quiet seconds
+		while self.peripheral.waitForNotifications(quiet):
+			continue
+
+
+
+class BtManager(object):
+	"""
+	Runs the connections of any number of BMSes on a small, fixed pool of worker threads.
+
+	Links wait in a heap ordered by the time they are due. A free worker takes the first due
+	link, steps it and puts it back at the time the step returned. Blocking bluepy calls only
+	hold a worker for one step, and at most maxConnecting workers are connecting at a time, so
+	a pack that is out of range can't hold up the others.
+
+	The links share the airtime of the adapter. When their polls would take more than
+	airtimeBudget of the time, all poll intervals are stretched to fit.
+
+	Adapters can only hold a few connections. With more links than maxConnections (0 is no
+	limit), the links are time-sliced: a link connects, takes one sample and disconnects again.
+	Links waiting for a connection or a connecting turn are parked, and whatever is freed goes
+	to the parked link with the oldest data. A link doesn't jump ahead of parked links with
+	older data, so one that just had its slice can't take the next one too. Samples older than maxStaleness are counted as missed deadlines.
+	A cycle closes when every link delivered a sample or its deadline passed, the links that
+	didn't deliver one count as missed deadlines. The duration and throughput of the last cycle
+	are kept in lastCycle and cycleRate, and logged every BT_CYCLE_SUMMARY cycles.
+	"""
+
+	def __init__(self, workers, maxConnecting, airtimeBudget=1.0, maxConnections=0, maxStaleness=0, adapter="hci0"):
+		self.adapter = adapter
+		self.iface = adapter_index(adapter)
+		# The BtAdapters this manager is part of, if any
+		self.adapters = None
+		self.workerCount = workers
+		self.workers = []
+		self.maxConnecting = max(1, maxConnecting)
+		self.connecting = 0
+		self.queue = []
+		self.order = itertools.count()
+		self.cond = Condition()
+		self.links = {}
+		self.running = False
+		self.airtimeBudget = airtimeBudget
+		# Share of the time the links would take at the intervals their handlers ask for
+		self.airtimeLoad = 0
+
+		self.maxConnections = maxConnections
+		self.maxStaleness = maxStaleness
+		# Links holding a connection, connected or connecting, links waiting for one and links
+		# woken up to take a freed one
+		self.connections = 0
+		self.parked = []
+		self.waking = set()
+		self.samples = 0
+		self.missedDeadlines = 0
+		self.cycles = 0
+		self.cycleStart = time.monotonic()
+		self.cycleSeen = set()
+		# Links counted as missed by a cycle deadline since their last sample
+		self.cycleMissed = set()
+		self.lastCycle = 0
+		self.cycleRate = 0
+
+	def add(self, handler):
+		link = BtLink(handler, self)
+		self.links[handler.address] = link
+		self.schedule(link, time.monotonic())
+		self.start()
+		return link
+
+	def remove(self, handler):
+		link = self.links.pop(handler.address, None)
+		if link is None:
+			return
+		with self.cond:
+			self.queue = [entry for entry in self.queue if entry[2] is not link]
+			heapq.heapify(self.queue)
+			self.parked = [entry for entry in self.parked if entry[2] is not link]
+			heapq.heapify(self.parked)
+			self.waking.discard(link)
+			self.cycleSeen.discard(link.address)
+			self.cycleMissed.discard(link.address)
+		if link.connected:
+			link.close('removed')
+			self.release()
+		# Drop the Peripheral, its bluepy-helper is gone with the disconnect
+		link.peripheral = None
+
+	def reconnect(self, address):
+		link = self.links.get(address)
+		if link is not None:
+			link.reconnect = True
+
+	def restartHelper(self, address):
+		link = self.links.get(address)
+		if link is not None:
+			link.killHelper()
+
+	def stretch(self, interval):
+		# The poll interval that keeps the polls of all links within the airtime budget. The
+		# load is that of the intervals the handlers ask for, not of the stretched ones.
+		load = 0
+		for link in list(self.links.values()):
+			requested = link.handler.interval
+			if link.connected and requested > 0:
+				load += link.airtime / requested
+		self.airtimeLoad = load
+		if self.airtimeBudget > 0 and load > self.airtimeBudget:
+			return interval * load / self.airtimeBudget
+		return interval
+
+	def sliced(self):
+		return 0 < self.maxConnections < len(self.links)
+
+	def free(self):
+		# Number of links that could start connecting now
+		free = self.maxConnecting - self.connecting
+		if self.maxConnections:
+			free = min(free, self.maxConnections - self.connections)
+		return free
+
+	def claim(self, link):
+		# Take a connection and a connecting turn for link, or park it until they are free.
+		# Waiting links with older data go first.
+		with self.cond:
+			self.waking.discard(link)
+			oldest = min((other.lastSample for other in self.waking), default=None)
+			if self.parked and (oldest is None or self.parked[0][0] < oldest):
+				oldest = self.parked[0][0]
+			if self.free() <= 0 or (oldest is not None and oldest < link.lastSample):
+				heapq.heappush(self.parked, (link.lastSample, next(self.order), link))
+				self.wake()
+				return False
+			self.connecting += 1
+			self.connections += 1
+			return True
+
+	def release(self):
+		# A connection is free again
+		with self.cond:
+			self.connections = max(0, self.connections - 1)
+			self.wake()
+
+	def connected(self):
+		# The connecting turn of claim() is over
+		with self.cond:
+			self.connecting -= 1
+			self.wake()
+
+	def wake(self):
+		# Hand what is free to the parked links with the oldest data
+		with self.cond:
+			while self.parked and len(self.waking) < self.free():
+				link = heapq.heappop(self.parked)[2]
+				self.waking.add(link)
+				heapq.heappush(self.queue, (time.monotonic(), next(self.order), link))
+				self.cond.notify()
+
+	def sampled(self, link, now):
+		# Called by a link that took a sample at now
+		with self.cond:
+			self.samples += 1
+			if link.address in self.cycleMissed:
+				self.cycleMissed.discard(link.address)
+			elif link.lastSample and self.maxStaleness and now - link.lastSample > self.maxStaleness:
+				self.missedDeadlines += 1
+				logger.info(f"{link.address} data was {now - link.lastSample:.0f}s old, {self.missedDeadlines} missed deadlines")
+
+			self.cycleSeen.add(link.address)
+			self.checkCycle(now)
+
+	def checkCycle(self, now):
+		# Close the cycle when every link delivered a sample or its deadline passed
+		with self.cond:
+			missing = [address for address in self.links if address not in self.cycleSeen]
+			if missing and now - self.cycleStart < (self.maxStaleness or BT_CYCLE_DEADLINE):
+				return
+
+			self.cycles += 1
+			self.lastCycle = now - self.cycleStart
+			self.cycleRate = len(self.cycleSeen) / self.lastCycle if self.lastCycle > 0 else 0
+			for address in missing:
+				# A link is only counted once until it delivers a sample again
+				if address not in self.cycleMissed:
+					self.cycleMissed.add(address)
+					self.missedDeadlines += 1
+			if missing:
+				logger.debug(f"Cycle {self.cycles} closed without a sample of {', '.join(missing)}")
+			if self.cycles % BT_CYCLE_SUMMARY == 0:
+				logger.info(
+					f"Cycle {self.cycles}: {len(self.cycleSeen)} of {len(self.links)} packs in {self.lastCycle:.1f}s, "
+					f"{self.cycleRate:.2f} packs/s, {self.missedDeadlines} missed deadlines"
+				)
+			self.cycleSeen.clear()
+			self.cycleStart = now
+
+	def schedule(self, link, due):
+		with self.cond:
+			heapq.heappush(self.queue, (due, next(self.order), link))
+			self.cond.notify()
+
+	def start(self):
+		if self.running:
+			return
+		self.running = True
+		for i in range(self.workerCount):
+			worker = Thread(target=self.work, name="bt-%s-%d" % (self.adapter, i))
+			# Thread will die with us if deamon
+			worker.daemon = True
+			worker.start()
+			self.workers.append(worker)
+
+	def stop(self):
+		with self.cond:
+			self.running = False
+			self.cond.notify_all()
+
+	def next(self):
+		# Wait for the first due link and take it off the queue, None when stopped
+		with self.cond:
+			while self.running:
+				if not self.queue:
+					self.cond.wait()
+					continue
+				delay = self.queue[0][0] - time.monotonic()
+				if delay > 0:
+					self.cond.wait(delay)
+					continue
+				return heapq.heappop(self.queue)[2]
+		return None
+
+	def step(self, link):
+		# Step link, an error of its handler must not take the worker and the other links down
+		try:
+			return link.step()
+		except Exception as ex:
+			logger.exception(f"Unexpected error on {link.address}")
+			link.rate(False)
+			link.failures += 1
+			link.close('crashed', ex)
+			return time.monotonic() + link.backoff()
+
+	def work(self):
+		while True:
+			link = self.next()
+			if link is None:
+				return
+			if link.address not in self.links:
+				continue
+
+			if link.connected:
+				due = self.step(link)
+			elif self.claim(link):
+				try:
+					due = self.step(link)
+				finally:
+					self.connected()
+			else:
+				continue
+
+			if not link.connected:
+				self.release()
+			# Check for a move before scheduling, once scheduled another worker may step the link
+			if self.adapters is not None and self.adapters.check(self, link):
+				continue
+			if link.address in self.links:
+				self.schedule(link, due)
+			# Packs that stopped delivering samples must not stall the cycle statistics
+			self.checkCycle(time.monotonic())
+
+
+
+def adapter_index(adapter):
+	# bluepy takes the number of hciN
+	match = re.match(r"hci(\d+)$", adapter)
+	return int(match.group(1)) if match else 0
+
+
+def list_adapters():
+	# The HCI adapters of this system, hci0 if none are found
+	try:
+		names = [name for name in os.listdir("/sys/class/bluetooth") if re.match(r"hci\d+$", name)]
+	except OSError:
+		names = []
+	return sorted(names, key=adapter_index) or ["hci0"]
+
+
+
+class BtAdapters(object):
+	"""
+	Spreads the links over the Bluetooth adapters, with a BtManager per adapter. So workers,
+	connection slots and the airtime budget are per adapter.
+
+	A pack is placed on the adapter it is pinned to in placement, otherwise on the one with the
+	fewest links, weighted by the average quality of its links. When the quality of a link drops
+	below migrateQuality, it is moved to another adapter if that one scores better for it.
+	The last quality of each pack on each adapter is remembered, so it doesn't bounce back.
+	"""
+
+	def __init__(self, adapters, placement, migrateQuality, managerFactory):
+		self.managers = {}
+		for adapter in adapters:
+			manager = managerFactory(adapter)
+			manager.adapters = self
+			self.managers[adapter] = manager
+		self.placement = {address.lower(): adapter for address, adapter in placement.items()}
+		self.migrateQuality = migrateQuality
+		self.qualities = {}
+		self.migrations = 0
+
+	def managerOf(self, address):
+		for manager in self.managers.values():
+			if address in manager.links:
+				return manager
+		return None
+
+	def adapterOf(self, address):
+		manager = self.managerOf(address)
+		return manager.adapter if manager else None
+
+	def score(self, manager, address):
+		# Lower is better: links per unit of link quality
+		quality = self.qualities.get((address, manager.adapter))
+		if quality is None:
+			links = list(manager.links.values())
+			quality = sum(link.quality for link in links) / len(links) if links else 1.0
+		return (len(manager.links) + 1) / max(quality, 0.05)
+
+	def choose(self, address, exclude=None):
+		pinned = self.placement.get(address.lower())
+		if pinned in self.managers:
+			return self.managers[pinned]
+		candidates = [m for m in self.managers.values() if m is not exclude]
+		if not candidates:
+			return None
+		return min(candidates, key=lambda m: self.score(m, address))
+
+	def add(self, handler):
+		manager = self.choose(handler.address)
+		logger.info(f"Placing {handler.address} on {manager.adapter}")
+		return manager.add(handler)
+
+	def remove(self, handler):
+		manager = self.managerOf(handler.address)
+		if manager is not None:
+			manager.remove(handler)
+
+	def reconnect(self, address):
+		manager = self.managerOf(address)
+		if manager is not None:
+			manager.reconnect(address)
+
+	def restartHelper(self, address):
+		manager = self.managerOf(address)
+		if manager is not None:
+			manager.restartHelper(address)
+
+	def check(self, manager, link):
+		# Called by the workers after stepping a link, moves it if its adapter serves it badly.
+		# True if it was moved.
+		if not self.migrateQuality or len(self.managers) < 2 or link.address.lower() in self.placement:
+			return False
+		if link.address not in manager.links or not link.degraded(self.migrateQuality):
+			return False
+
+		self.qualities[(link.address, manager.adapter)] = link.quality
+		target = self.choose(link.address, exclude=manager)
+		# On its own adapter the link is already counted and we know its quality
+		current = len(manager.links) / max(link.quality, 0.05)
+		if target is None or self.score(target, link.address) >= current:
+			# Nowhere better to go, look again after the next interval
+			link.since = time.monotonic()
+			return False
+
+		self.migrations += 1
+		logger.info(
+			f"Moving {link.address} from {manager.adapter} to {target.adapter}, "
+			f"link quality {link.quality:.2f} ({self.migrations} moves)"
+		)
+		manager.remove(link.handler)
+		target.add(link.handler)
+		return True
+
+
+
+manager = None
+
+def get_manager():
+	# The BtAdapters shared by all BMS connections of this process
+	global manager
+	if manager is None:
+		adapters = [a for a in list_adapters() if not BT_ADAPTERS or a in BT_ADAPTERS]
+		if not adapters:
+			logger.error(f"None of the adapters {BT_ADAPTERS} found, using hci0")
+			adapters = ["hci0"]
+		manager = BtAdapters(
+			adapters,
+			BT_ADAPTER_PLACEMENT,
+			BT_MIGRATE_QUALITY,
+			lambda adapter: BtManager(
+				BT_WORKERS, BT_MAX_CONNECTING, BT_AIRTIME_BUDGET, BT_MAX_CONNECTIONS, BT_MAX_STALENESS, adapter
+			),
+		)
+	return manager
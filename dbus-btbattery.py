@@ -1,10 +1,9 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-from typing import Union
+from typing import List, Union
 
 from time import sleep
 from dbus.mainloop.glib import DBusGMainLoop
-from threading import Thread
 import sys
 
 if sys.version_info.major == 2:
@@ -16,10 +15,13 @@ else:
 # from ve_utils import exit_on_error
 
 from dbushelper import DbusHelper
+from publisher import PublishWorker
 from utils import logger
 import utils
 from battery import Battery
 from jbdbt import JbdBt
+from jkbt import JkBt
+from advertisement import AdvBt
 from virtual import Virtual
 
 
@@ -28,21 +30,25 @@ logger.info("Starting dbus-btbattery")
 
 
 def main():
-	def poll_battery(loop):
-		# Run in separate thread. Pass in the mainloop so the thread can kill us if there is an exception.
-		poller = Thread(target=lambda: helper.publish_battery(loop))
-		# Thread will die with us if deamon
-		poller.daemon = True
-		poller.start()
-		return True
-
-
-	def get_btaddr() -> str:
-		# Get the bluetooth address we need to use from the argument
+	def get_btaddr() -> List[str]:
+		# Get the bluetooth addresses we need to use from the arguments, or else from the config
 		if len(sys.argv) > 1:
 			return sys.argv[1:]
 		else:
-			return False
+			return utils.VIRTUAL_BATTERIES
+
+
+	def get_battery_class():
+		# Select the BMS driver from the BMS_TYPE config option, JBD if not set
+		bms_type = utils.BMS_TYPE.strip().upper()
+		if bms_type == "JK":
+			return JkBt
+		if bms_type == "BTHOME":
+			return AdvBt
+		if bms_type not in ("", "JBD"):
+			logger.error("ERROR >>> Unknown BMS_TYPE " + utils.BMS_TYPE)
+			sys.exit(1)
+		return JbdBt
 
 
 	logger.info(
@@ -50,14 +56,18 @@ def main():
 	)
 
 	btaddr = get_btaddr()
-	if len(btaddr) == 2:
-		battery: Battery = Virtual( JbdBt(btaddr[0]), JbdBt(btaddr[1]) )
-	elif len(btaddr) == 3:
-		battery: Battery = Virtual( JbdBt(btaddr[0]), JbdBt(btaddr[1]), JbdBt(btaddr[2]) )
-	elif len(btaddr) == 4:
-		battery: Battery = Virtual( JbdBt(btaddr[0]), JbdBt(btaddr[1]), JbdBt(btaddr[2]), JbdBt(btaddr[3]) )
+	bms = get_battery_class()
+	if not btaddr:
+		logger.error("ERROR >>> No Bluetooth address given, on the command line or in VIRTUAL_BATTERIES")
+		sys.exit(1)
+	if len(btaddr) > 1:
+		try:
+			battery: Battery = Virtual(*[bms(address) for address in btaddr])
+		except ValueError as ex:
+			logger.error("ERROR >>> " + str(ex))
+			sys.exit(1)
 	else:
-		battery: Battery = JbdBt(btaddr[0])
+		battery: Battery = bms(btaddr[0])
 
 	if battery is None:
 		logger.error("ERROR >>> No battery connection at " + str(btaddr))
@@ -78,12 +88,20 @@ def main():
 		logger.error("ERROR >>> Problem with battery " + str(btaddr))
 		sys.exit(1)
 
-	# Poll the battery at INTERVAL and run the main loop
-	gobject.timeout_add(battery.poll_interval, lambda: poll_battery(mainloop))
+	# Publish the battery from a separate thread and run the main loop. Either as soon as the
+	# battery has new data, or poll the battery at INTERVAL.
+	# Pass in the mainloop so the thread can kill us if there is an exception.
+	if utils.PUBLISH_ON_FRAME:
+		worker = PublishWorker(helper, mainloop, utils.PUBLISH_KEEPALIVE_INTERVAL * 1000, True)
+		battery.set_data_callback(worker.trigger)
+	else:
+		worker = PublishWorker(helper, mainloop, battery.poll_interval)
+	worker.start()
 	try:
 		mainloop.run()
 	except KeyboardInterrupt:
 		pass
+	worker.stop()
 
 
 if __name__ == "__main__":
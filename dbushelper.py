@@ -4,6 +4,8 @@ import os
 import platform
 import dbus
 import traceback
+from contextlib import contextmanager
+from time import monotonic
 
 # Victron packages
 sys.path.insert(
@@ -27,17 +29,122 @@ def get_bus():
     )
 
 
+# Deadbands for measured values, cell paths are matched by prefix in DbusPublisher.get_deadband()
+PATH_DEADBANDS = {
+    "/Dc/0/Voltage": PUBLISH_DEADBAND_VOLTAGE,
+    "/Dc/0/MidVoltage": PUBLISH_DEADBAND_VOLTAGE,
+    "/Voltages/Sum": PUBLISH_DEADBAND_VOLTAGE,
+    "/Cell/Sum": PUBLISH_DEADBAND_VOLTAGE,
+    "/Dc/0/Current": PUBLISH_DEADBAND_CURRENT,
+    "/Dc/0/Power": PUBLISH_DEADBAND_POWER,
+    "/Dc/0/Temperature": PUBLISH_DEADBAND_TEMPERATURE,
+    "/System/MinCellTemperature": PUBLISH_DEADBAND_TEMPERATURE,
+    "/System/MaxCellTemperature": PUBLISH_DEADBAND_TEMPERATURE,
+    "/System/MinCellVoltage": PUBLISH_DEADBAND_CELL_VOLTAGE,
+    "/System/MaxCellVoltage": PUBLISH_DEADBAND_CELL_VOLTAGE,
+}
+CELL_PATH_PREFIXES = ("/Voltages/Cell", "/Voltages/Diff", "/Cell/")
+# The values are rounded floats, a step of exactly one deadband may come out a hair smaller.
+# Deadbands are shrunk by this share, so equal steps are treated the same.
+DEADBAND_TOLERANCE = 1e-6
+
+
+class DbusPublisher:
+    """
+    Sits in front of the VeDbusService and only writes a path when its value changed.
+    Numeric values also have to move by more than the deadband of their path, unless
+    the path was last written more than max_interval seconds ago.
+
+    Writes made inside cycle() are collected by the service and sent as one ItemsChanged
+    signal when the cycle ends, if batching is enabled and velib supports it.
+    """
+
+    def __init__(self, dbusservice, max_interval, batch=True):
+        self._dbusservice = dbusservice
+        self._target = dbusservice
+        self.max_interval = max_interval
+        # Older velib_python versions can't batch, they only emit PropertiesChanged per path
+        self.batch = batch and hasattr(dbusservice, "__enter__")
+        # path -> [last published value, publish time, deadband]
+        self._published = {}
+        self.writes = 0
+        self.suppressed = 0
+        logger.info(
+            "publishing changes as %s"
+            % ("one ItemsChanged per cycle" if self.batch else "PropertiesChanged per path")
+        )
+
+    @contextmanager
+    def cycle(self):
+        if not self.batch:
+            yield self
+            return
+
+        writes = self.writes
+        # The service context emits ItemsChanged for everything set on it when it exits
+        with self._dbusservice as context:
+            self._target = context
+            try:
+                yield self
+            finally:
+                self._target = self._dbusservice
+        logger.debug("batched %d changed paths" % (self.writes - writes))
+
+    @staticmethod
+    def get_deadband(path) -> float:
+        if path in PATH_DEADBANDS:
+            return PATH_DEADBANDS[path]
+        if path.startswith(CELL_PATH_PREFIXES) and not path.endswith("/Sum"):
+            return PUBLISH_DEADBAND_CELL_VOLTAGE
+        return 0
+
+    def __setitem__(self, path, value):
+        now = monotonic()
+        entry = self._published.get(path)
+        if entry is None:
+            entry = self._published[path] = [
+                None,
+                None,
+                self.get_deadband(path) * (1 - DEADBAND_TOLERANCE),
+            ]
+        elif now - entry[1] < self.max_interval:
+            last = entry[0]
+            if value == last and type(value) is type(last):
+                self.suppressed += 1
+                return
+            if (
+                entry[2]
+                and isinstance(value, (int, float))
+                and isinstance(last, (int, float))
+                and abs(value - last) < entry[2]
+            ):
+                self.suppressed += 1
+                return
+
+        self._target[path] = value
+        entry[0] = value
+        entry[1] = now
+        self.writes += 1
+
+    def __getitem__(self, path):
+        return self._dbusservice[path]
+
+
 class DbusHelper:
     def __init__(self, battery):
         self.battery = battery
         self.instance = 1
         self.settings = None
         self.error_count = 0
+        self.last_success = monotonic()
         self._dbusservice = VeDbusService(
             "com.victronenergy.battery."
             + self.battery.port[self.battery.port.rfind("/") + 1 :],
             get_bus(),
         )
+        self._publisher = DbusPublisher(
+            self._dbusservice, PUBLISH_MAX_INTERVAL, PUBLISH_ITEMS_CHANGED
+        )
 
     def setup_instance(self):
         # bms_id = self.battery.production if self.battery.production is not None else \
@@ -307,20 +414,25 @@ class DbusHelper:
         return True
 
     def publish_battery(self, loop):
-        # This is called every battery.poll_interval milli second as set up per battery type to read and update the data
+        # This is called when the battery delivers new data, or every battery.poll_interval milli second
+        # as set up per battery type, to read and update the data
         try:
             # Call the battery's refresh_data function
             success = self.battery.refresh_data()
             if success:
+                self.battery.refresh_cell_stats()
                 self.error_count = 0
+                self.last_success = monotonic()
                 self.battery.online = True
             else:
                 self.error_count += 1
-                # If the battery is offline for more than 10 polls (polled every second for most batteries)
-                if self.error_count >= 10:
+                # Polls don't come at a fixed rate, so go by the time since the last good one
+                failed_for = monotonic() - self.last_success
+                # If the battery is offline for more than 10 seconds
+                if failed_for >= 10:
                     self.battery.online = False
                 # Has it completely failed
-                if self.error_count >= 60:
+                if failed_for >= 60:
                     loop.quit()
 
             # This is to mannage CCL\DCL
@@ -329,8 +441,9 @@ class DbusHelper:
             # This is to mannage CVCL
             self.battery.manage_charge_voltage()
 
-            # publish all the data from the battery object to dbus
-            self.publish_dbus()
+            # publish all the data from the battery object to dbus, batched into one signal
+            with self._publisher.cycle():
+                self.publish_dbus()
 
         except:
             traceback.print_exc()
@@ -339,16 +452,16 @@ class DbusHelper:
     def publish_dbus(self):
 
         # Update SOC, DC and System items
-        self._dbusservice["/System/NrOfCellsPerBattery"] = self.battery.cell_count
-        self._dbusservice["/Soc"] = round(self.battery.soc, 2)
-        self._dbusservice["/Dc/0/Voltage"] = round(self.battery.voltage, 2)
-        self._dbusservice["/Dc/0/Current"] = round(self.battery.current, 2)
-        self._dbusservice["/Dc/0/Power"] = round(
+        self._publisher["/System/NrOfCellsPerBattery"] = self.battery.cell_count
+        self._publisher["/Soc"] = round(self.battery.soc, 2)
+        self._publisher["/Dc/0/Voltage"] = round(self.battery.voltage, 2)
+        self._publisher["/Dc/0/Current"] = round(self.battery.current, 2)
+        self._publisher["/Dc/0/Power"] = round(
             self.battery.voltage * self.battery.current, 2
         )
-        self._dbusservice["/Dc/0/Temperature"] = self.battery.get_temp()
-        self._dbusservice["/Capacity"] = self.battery.get_capacity_remain()
-        self._dbusservice["/ConsumedAmphours"] = (
+        self._publisher["/Dc/0/Temperature"] = self.battery.get_temp()
+        self._publisher["/Capacity"] = self.battery.get_capacity_remain()
+        self._publisher["/ConsumedAmphours"] = (
             0
             if self.battery.capacity is None
             or self.battery.get_capacity_remain() is None
@@ -357,94 +470,93 @@ class DbusHelper:
 
         midpoint, deviation = self.battery.get_midvoltage()
         if midpoint is not None:
-            self._dbusservice["/Dc/0/MidVoltage"] = midpoint
-            self._dbusservice["/Dc/0/MidVoltageDeviation"] = deviation
+            self._publisher["/Dc/0/MidVoltage"] = midpoint
+            self._publisher["/Dc/0/MidVoltageDeviation"] = deviation
 
         # Update battery extras
-        self._dbusservice["/History/ChargeCycles"] = self.battery.cycles
-        self._dbusservice["/History/TotalAhDrawn"] = self.battery.total_ah_drawn
-        self._dbusservice["/Io/AllowToCharge"] = (
+        self._publisher["/History/ChargeCycles"] = self.battery.cycles
+        self._publisher["/History/TotalAhDrawn"] = self.battery.total_ah_drawn
+        self._publisher["/Io/AllowToCharge"] = (
             1 if self.battery.charge_fet and self.battery.control_allow_charge else 0
         )
-        self._dbusservice["/Io/AllowToDischarge"] = (
+        self._publisher["/Io/AllowToDischarge"] = (
             1
             if self.battery.discharge_fet and self.battery.control_allow_discharge
             else 0
         )
-        self._dbusservice["/System/NrOfModulesBlockingCharge"] = (
+        self._publisher["/System/NrOfModulesBlockingCharge"] = (
             0
             if self.battery.charge_fet is None
             or (self.battery.charge_fet and self.battery.control_allow_charge)
             else 1
         )
-        self._dbusservice["/System/NrOfModulesBlockingDischarge"] = (
+        self._publisher["/System/NrOfModulesBlockingDischarge"] = (
             0 if self.battery.discharge_fet is None or self.battery.discharge_fet else 1
         )
-        self._dbusservice["/System/NrOfModulesOnline"] = 1 if self.battery.online else 0
-        self._dbusservice["/System/NrOfModulesOffline"] = (
+        self._publisher["/System/NrOfModulesOnline"] = 1 if self.battery.online else 0
+        self._publisher["/System/NrOfModulesOffline"] = (
             0 if self.battery.online else 1
         )
-        self._dbusservice["/System/MinCellTemperature"] = self.battery.get_min_temp()
-        self._dbusservice["/System/MaxCellTemperature"] = self.battery.get_max_temp()
+        self._publisher["/System/MinCellTemperature"] = self.battery.get_min_temp()
+        self._publisher["/System/MaxCellTemperature"] = self.battery.get_max_temp()
 
         # Charge control
-        self._dbusservice[
+        self._publisher[
             "/Info/MaxChargeCurrent"
         ] = self.battery.control_charge_current
-        self._dbusservice[
+        self._publisher[
             "/Info/MaxDischargeCurrent"
         ] = self.battery.control_discharge_current
 
         # Voltage control
-        self._dbusservice["/Info/MaxChargeVoltage"] = self.battery.control_voltage
+        self._publisher["/Info/MaxChargeVoltage"] = self.battery.control_voltage
 
         # Updates from cells
-        self._dbusservice["/System/MinVoltageCellId"] = self.battery.get_min_cell_desc()
-        self._dbusservice["/System/MaxVoltageCellId"] = self.battery.get_max_cell_desc()
-        self._dbusservice[
+        self._publisher["/System/MinVoltageCellId"] = self.battery.get_min_cell_desc()
+        self._publisher["/System/MaxVoltageCellId"] = self.battery.get_max_cell_desc()
+        self._publisher[
             "/System/MinCellVoltage"
         ] = self.battery.get_min_cell_voltage()
-        self._dbusservice[
+        self._publisher[
             "/System/MaxCellVoltage"
         ] = self.battery.get_max_cell_voltage()
-        self._dbusservice["/Balancing"] = self.battery.get_balancing()
+        self._publisher["/Balancing"] = self.battery.get_balancing()
 
         # Update the alarms
-        self._dbusservice["/Alarms/LowVoltage"] = self.battery.protection.voltage_low
-        self._dbusservice[
+        self._publisher["/Alarms/LowVoltage"] = self.battery.protection.voltage_low
+        self._publisher[
             "/Alarms/LowCellVoltage"
         ] = self.battery.protection.voltage_cell_low
-        self._dbusservice["/Alarms/HighVoltage"] = self.battery.protection.voltage_high
-        self._dbusservice["/Alarms/LowSoc"] = self.battery.protection.soc_low
-        self._dbusservice[
+        self._publisher["/Alarms/HighVoltage"] = self.battery.protection.voltage_high
+        self._publisher["/Alarms/LowSoc"] = self.battery.protection.soc_low
+        self._publisher[
             "/Alarms/HighChargeCurrent"
         ] = self.battery.protection.current_over
-        self._dbusservice[
+        self._publisher[
             "/Alarms/HighDischargeCurrent"
         ] = self.battery.protection.current_under
-        self._dbusservice[
+        self._publisher[
             "/Alarms/CellImbalance"
         ] = self.battery.protection.cell_imbalance
-        self._dbusservice[
+        self._publisher[
             "/Alarms/InternalFailure"
         ] = self.battery.protection.internal_failure
-        self._dbusservice[
+        self._publisher[
             "/Alarms/HighChargeTemperature"
         ] = self.battery.protection.temp_high_charge
-        self._dbusservice[
+        self._publisher[
             "/Alarms/LowChargeTemperature"
         ] = self.battery.protection.temp_low_charge
-        self._dbusservice[
+        self._publisher[
             "/Alarms/HighTemperature"
         ] = self.battery.protection.temp_high_discharge
-        self._dbusservice[
+        self._publisher[
             "/Alarms/LowTemperature"
         ] = self.battery.protection.temp_low_discharge
 
         # cell voltages
         if BATTERY_CELL_DATA_FORMAT > 0:
             try:
-                voltageSum = 0
                 for i in range(self.battery.cell_count):
                     voltage = self.battery.get_cell_voltage(i)
                     cellpath = (
@@ -452,16 +564,14 @@ class DbusHelper:
                         if (BATTERY_CELL_DATA_FORMAT & 2)
                         else "/Voltages/Cell%s"
                     )
-                    self._dbusservice[cellpath % (str(i + 1))] = voltage
+                    self._publisher[cellpath % (str(i + 1))] = voltage
                     if BATTERY_CELL_DATA_FORMAT & 1:
-                        self._dbusservice[
+                        self._publisher[
                             "/Balances/Cell%s" % (str(i + 1))
                         ] = self.battery.get_cell_balancing(i)
-                    if voltage:
-                        voltageSum += voltage
                 pathbase = "Cell" if (BATTERY_CELL_DATA_FORMAT & 2) else "Voltages"
-                self._dbusservice["/%s/Sum" % pathbase] = voltageSum
-                self._dbusservice["/%s/Diff" % pathbase] = (
+                self._publisher["/%s/Sum" % pathbase] = self.battery.get_cell_stats().sum
+                self._publisher["/%s/Diff" % pathbase] = (
                     self.battery.get_max_cell_voltage()
                     - self.battery.get_min_cell_voltage()
                 )
@@ -481,14 +591,14 @@ class DbusHelper:
                 )
 
                 for num in TIME_TO_SOC_POINTS:
-                    self._dbusservice["/TimeToSoC/" + str(num)] = (
+                    self._publisher["/TimeToSoC/" + str(num)] = (
                         self.battery.get_timetosoc(num, crntPrctPerSec)
                         if self.battery.current
                         else None
                     )
                 
                 # Update TimeToGo
-                self._dbusservice["/TimeToGo"] = (
+                self._publisher["/TimeToGo"] = (
                     self.battery.get_timetosoc(SOC_LOW_WARNING, crntPrctPerSec)
                     if self.battery.current
                     else None
@@ -0,0 +1,86 @@
+from threading import Lock
+from utils import *
+import json
+import os
+
+
+
+class GattCache(object):
+	"""
+	GATT handles of the BMSes, discovered once and kept on disk, so a reconnect can subscribe
+	and send right away instead of running service discovery again.
+
+	Entries are keyed by BT address and hold the handles a driver needs (e.g. notify, write,
+	cccd), the negotiated mtu and the firmware they were discovered with. A driver that finds
+	a cached handle doesn't work, or sees a different firmware, drops the entry and discovers
+	again.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = Lock()
+		self.entries = None
+
+	def load(self):
+		if self.entries is not None:
+			return
+		try:
+			with open(self.path) as f:
+				self.entries = json.load(f)
+		except (OSError, ValueError):
+			self.entries = {}
+
+	def save(self):
+		# Write a new file and move it over the old one, so a power cut can't leave half of it
+		tmp = self.path + ".tmp"
+		try:
+			with open(tmp, "w") as f:
+				json.dump(self.entries, f, indent=1, sort_keys=True)
+			os.replace(tmp, self.path)
+		except OSError as ex:
+			logger.info(f"Cannot save GATT cache {self.path}: {ex}")
+
+	def get(self, address):
+		with self.lock:
+			self.load()
+			entry = self.entries.get(address.lower())
+			return dict(entry) if entry else None
+
+	def put(self, address, **fields):
+		# Add fields to the entry of address
+		with self.lock:
+			self.load()
+			entry = self.entries.setdefault(address.lower(), {})
+			if all(entry.get(k) == v for k, v in fields.items()):
+				return
+			entry.update(fields)
+			self.save()
+
+	def drop(self, address):
+		with self.lock:
+			self.load()
+			if self.entries.pop(address.lower(), None) is not None:
+				self.save()
+
+	def checkFirmware(self, address, firmware):
+		# Record the firmware of the cached handles, drop them when it changed
+		entry = self.get(address)
+		if entry is None:
+			return
+		cached = entry.get("firmware")
+		if cached is None:
+			self.put(address, firmware=firmware)
+		elif cached != firmware:
+			logger.info(f"{address} firmware changed from {cached} to {firmware}, rediscovering handles on the next connect")
+			self.drop(address)
+
+
+
+gattCache = None
+
+def get_gatt_cache():
+	# The GattCache shared by all BMS connections of this process
+	global gattCache
+	if gattCache is None:
+		gattCache = GattCache(GATT_CACHE_FILE)
+	return gattCache
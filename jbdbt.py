@@ -1,17 +1,77 @@
-from bluepy.btle import Peripheral, DefaultDelegate, BTLEException, BTLEDisconnectError
-from threading import Thread, Lock
-from battery import Protection, Battery, Cell
+from bluepy.btle import DefaultDelegate, BTLEException, BTLEDisconnectError, BTLEGattError
+from btmanager import get_manager
+from sampling import AdaptiveSampler
+from gattcache import get_gatt_cache
+from watchdog import Watchdog
+from battery import Protection, Battery, BatterySnapshot
+from bitfields import Bitfield, Flag
 from utils import *
 from struct import *
-import argparse
-import sys
+from array import array
 import time
 import binascii
-import atexit
-import os
-
-# 0 disabled, or set the number of seconds to detect BT hang, and reboot.
-BT_WATCHDOG_TIMER=300
+import logging
+
+JBD_START_BYTE = b'\xdd'
+JBD_STOP = 0x77
+JBD_HEADER_LEN = 4 #[Start Code][Command][Status][Length]
+JBD_FOOTER_LEN = 3 #[16bit Checksum][Stop Code]
+JBD_MAX_FRAME_LEN = JBD_HEADER_LEN + 0xff + JBD_FOOTER_LEN
+
+JBD_CMD_GENERAL_INFO = 0x03
+JBD_CMD_CELL_INFO = 0x04
+
+JBD_STATUS_OK = 0x00
+JBD_STATUS_ERROR = 0x80
+
+JBD_SERVICE_UUID = 'ff00'
+JBD_NOTIFY_UUID = 'ff01'
+JBD_WRITE_UUID = 'ff02'
+# Write handle of most JBD BT modules, used when service discovery fails
+JBD_WRITE_HANDLE = 0x15
+# MTU we ask for, 244 bytes of notification payload hold a cell info frame of up to 118 cells
+JBD_MTU = 247
+BLE_DEFAULT_MTU = 23
+BLE_ATT_HEADER_LEN = 3
+# Seconds to wait for the response to a request, and how often a request is sent again
+JBD_REQUEST_TIMEOUT = 1.0
+JBD_REQUEST_RETRIES = 2
+
+def jbd_read_request(command):
+	# [Start Byte][read a5][command][payload len 0][checksum][stop byte]
+	checksum = (0x10000 - command) & 0xffff
+	return bytes((0xdd, 0xa5, command, 0x00, checksum >> 8, checksum & 0xff, JBD_STOP))
+
+JBD_READ_REQUESTS = {
+	JBD_CMD_GENERAL_INFO: jbd_read_request(JBD_CMD_GENERAL_INFO),	# dd a5 03 00 ff fd 77
+	JBD_CMD_CELL_INFO: jbd_read_request(JBD_CMD_CELL_INFO),		# dd a5 04 00 ff fc 77
+}
+
+# Fixed part of the general info (0x03) payload, the NTC temperatures follow it
+JBD_GENERAL_INFO = Struct(">HhHHHHhHHBBBBB")
+
+# Protection status word of the general info (0x03) frame, applied to JbdProtection
+JBD_PROTECTION_BITS = Bitfield(16, (
+	Flag("set_voltage_high_cell", 0, setter=True),
+	Flag("set_voltage_low_cell", 1, setter=True),
+	Flag("voltage_high", 2, 2, 0),
+	Flag("voltage_low", 3, 2, 0),
+	Flag("temp_high_charge", 4, 1, 0),
+	Flag("temp_low_charge", 5, 1, 0),
+	Flag("temp_high_discharge", 6, 1, 0),
+	Flag("temp_low_discharge", 7, 1, 0),
+	Flag("current_over", 8, 1, 0),
+	Flag("current_under", 9, 1, 0),
+	Flag("set_short", 10, setter=True),
+	Flag("set_ic_inspection", 11, setter=True),
+	Flag("set_software_lock", 12, setter=True),
+))
+
+# MOSFET status byte of the general info (0x03) frame, applied to JbdBt
+JBD_FET_BITS = Bitfield(8, (
+	Flag("charge_fet", 0),
+	Flag("discharge_fet", 1),
+))
 
 
 class JbdProtection(Protection):
@@ -37,98 +97,311 @@ class JbdProtection(Protection):
 
 	def set_short(self, value):
 		self.short = value
-		self.set_cell_imbalance(
+		self.internal_failure = (
 			2 if self.short or self.IC_inspection or self.software_lock else 0
 		)
 
 	def set_ic_inspection(self, value):
 		self.IC_inspection = value
-		self.set_cell_imbalance(
+		self.internal_failure = (
 			2 if self.short or self.IC_inspection or self.software_lock else 0
 		)
 
 	def set_software_lock(self, value):
 		self.software_lock = value
-		self.set_cell_imbalance(
+		self.internal_failure = (
 			2 if self.short or self.IC_inspection or self.software_lock else 0
 		)
 
 
 
-class JbdBtDev(DefaultDelegate, Thread):
+class JbdFrameReassembler(object):
+	"""
+	Rebuilds JBD response frames from BLE notifications.
+
+	Because of small MTU size, a frame may not be transmitted in a single packet. Incoming bytes
+	are copied once into a preallocated buffer, and a start byte is only looked for on a frame
+	boundary, so payload bytes that happen to read dd 03 or dd 04 can't restart a frame.
+	A finished frame is checked for status, checksum and stop byte, then handed to
+	callback(command, frame) as a memoryview of the buffer. A frame with error status is
+	reported to errorCallback(command). A notification that holds exactly one valid frame,
+	which is the normal case once a large MTU is negotiated, skips the buffer altogether. The view is only valid until the
+	next call to feed(), so keep a copy of anything that has to outlive the callback.
+	"""
+
+	def __init__(self, callback, errorCallback=None):
+		self.callback = callback
+		self.errorCallback = errorCallback
+		self.buffer = bytearray(JBD_MAX_FRAME_LEN)
+		self.view = memoryview(self.buffer)
+		self.pos = 0
+		self.frameLen = 0
+		self.frames = 0
+		self.errors = 0
+		self.singlePacket = 0
+
+	def reset(self):
+		self.pos = 0
+		self.frameLen = 0
+
+	def feed(self, data):
+		src = memoryview(data)
+		end = len(src)
+
+		if (
+			self.pos == 0
+			and end >= JBD_HEADER_LEN
+			and src[0] == JBD_START_BYTE[0]
+			and src[3] + JBD_HEADER_LEN + JBD_FOOTER_LEN == end
+			and self.valid(src)
+		):
+			# A whole frame in one notification, as with a large MTU: deliver it without a copy
+			self.singlePacket += 1
+			self.deliver(src)
+			return
+
+		i = 0
+		while i < end:
+			if self.pos == 0:
+				# Sync on the start byte, anything before it is garbage from a lost frame
+				i = data.find(JBD_START_BYTE, i)
+				if i == -1:
+					return
+
+			n = min((self.frameLen or JBD_HEADER_LEN) - self.pos, end - i)
+			self.view[self.pos:self.pos + n] = src[i:i + n]
+			self.pos += n
+			i += n
+
+			if self.frameLen == 0:
+				if self.pos < JBD_HEADER_LEN:
+					continue
+
+				if self.buffer[2] not in (JBD_STATUS_OK, JBD_STATUS_ERROR):
+					self.resync()
+					continue
+
+				# We use the 4th byte defined as "data len" in the BMS protocol to get the frame length
+				self.frameLen = self.buffer[3] + JBD_HEADER_LEN + JBD_FOOTER_LEN
+
+			if self.pos == self.frameLen:
+				self.complete()
+
+	def complete(self):
+		frame = self.view[:self.frameLen]
+		if not self.valid(frame):
+			self.errors += 1
+			logger.debug("Dropping invalid frame %s", binascii.hexlify(frame).decode('utf-8'))
+			self.resync()
+			return
+
+		self.reset()
+		self.deliver(frame)
+
+	def valid(self, frame):
+		end = len(frame) - JBD_FOOTER_LEN
+		# Checksum = 65536 - ([status byte] + [payload len byte] + [payload bytes])
+		checksum = (0x10000 - sum(frame[2:end])) & 0xffff
+		return frame[end + 2] == JBD_STOP and checksum == (frame[end] << 8 | frame[end + 1])
+
+	def deliver(self, frame):
+		if frame[2] != JBD_STATUS_OK:
+			self.errors += 1
+			logger.debug("BMS returned error status for command %02x", frame[1])
+			if self.errorCallback:
+				self.errorCallback(frame[1])
+			return
+
+		self.frames += 1
+		self.callback(frame[1], frame)
+
+	def resync(self):
+		# The start byte was a false positive, look for a real one in what we buffered after it
+		pending = bytes(self.view[1:self.pos])
+		self.reset()
+		if pending:
+			self.feed(pending)
+
+
+
+class JbdPendingRequest(object):
+	# The response slot of a request that was sent
+	__slots__ = ("command", "sentAt", "done", "ok")
+
+	def __init__(self, command):
+		self.command = command
+		self.sentAt = time.monotonic()
+		self.done = False
+		self.ok = False
+
+
+
+class JbdRequestStats(object):
+	# Counters of one request command
+	__slots__ = ("sent", "completed", "errors", "timeouts", "retries", "failures", "lastLatency", "maxLatency")
+
+	def __init__(self):
+		self.sent = 0
+		self.completed = 0
+		self.errors = 0
+		self.timeouts = 0
+		self.retries = 0
+		self.failures = 0
+		self.lastLatency = 0
+		self.maxLatency = 0
+
+	def __str__(self):
+		return (
+			f"sent {self.sent}, completed {self.completed}, errors {self.errors}, timeouts {self.timeouts}, "
+			f"retries {self.retries}, failed {self.failures}, latency {self.lastLatency:.3f}s (max {self.maxLatency:.3f}s)"
+		)
+
+
+
+class JbdBtDev(DefaultDelegate):
 	def __init__(self, address):
 		DefaultDelegate.__init__(self)
-		Thread.__init__(self)
 
 		self.cellDataCallback = None
-		self.cellData = None
-		self.cellDataTotalLen = 0
-		self.cellDataRemainingLen = 0
-		self.last_state = "0000"
-
 		self.generalDataCallback = None
-		self.generalData = None
-		self.generalDataTotalLen = 0
-		self.generalDataRemainingLen = 0
+		self.frames = JbdFrameReassembler(self.handleFrame, self.handleError)
+		# Requests waiting for their response, keyed by command byte
+		self.pending = {}
+		self.stats = {command: JbdRequestStats() for command in JBD_READ_REQUESTS}
 
 		self.address = address
-		self.interval = 5
+		self.sampler = AdaptiveSampler()
+		# MTU of the connection, negotiated on connect. A BMS that negotiated the default isn't asked again.
+		self.mtu = None
+		self.writeHandle = JBD_WRITE_HANDLE
+		self.firmwareChecked = False
 
-		# Bluepy stuff
-		self.bt = Peripheral()
-		self.bt.setDelegate(self)
 
+	@property
+	def interval(self):
+		return self.sampler.interval
 
 	def reset(self):
-		self.last_state = "0000"
-		self.cellDataTotalLen = 0
-		self.cellDataRemainingLen = 0
-		self.generalDataTotalLen = 0
-		self.generalDataRemainingLen = 0
-
-
-	def run(self):
-		self.running = True
-		timer = 0
-		connected = False
-		while self.running:
-			if not connected:
-				try:
-					logger.info('Connecting ' + self.address)
-					self.bt.connect(self.address, addrType="public")
-					logger.info('Connected ' + self.address)
-					connected = True
-					self.reset()
-				except BTLEException as ex:
-					logger.info('Connection failed: ' + str(ex))
-					time.sleep(3)
-					continue
-
-			try:
-				if self.bt.waitForNotifications(2):
-					continue
-
-				if (time.monotonic() - timer) > self.interval:
-					timer = time.monotonic()
-					result = self.bt.writeCharacteristic(0x15, b'\xdd\xa5\x03\x00\xff\xfd\x77', True)	# write x03 (general info)
-					#time.sleep(1) # Need time between writes?
-					while self.bt.waitForNotifications(1):
-						continue
-					result = self.bt.writeCharacteristic(0x15, b'\xdd\xa5\x04\x00\xff\xfc\x77', True)	# write x04 (cell voltages)
-
+		self.frames.reset()
+		self.pending.clear()
+
+
+	def onConnect(self, link):
+		self.reset()
+		self.firmwareChecked = False
+
+		cached = get_gatt_cache().get(self.address) or {}
+		if "write" in cached:
+			self.writeHandle = cached["write"]
+		else:
+			self.discover(link)
+
+		mtu = cached.get("mtu")
+		if mtu is None or mtu > BLE_DEFAULT_MTU:
+			mtu = self.negotiateMtu(link)
+			if mtu is None:
+				# Not negotiated, use the default on this connection and ask again on the next one
+				mtu = BLE_DEFAULT_MTU
+			else:
+				get_gatt_cache().put(self.address, mtu=mtu)
+		self.mtu = mtu
+
+	def discover(self, link):
+		# Look up the handles of the JBD service and cache them
+		try:
+			service = link.peripheral.getServiceByUUID(JBD_SERVICE_UUID)
+			self.writeHandle = service.getCharacteristics(JBD_WRITE_UUID)[0].getHandle()
+			notifyHandle = service.getCharacteristics(JBD_NOTIFY_UUID)[0].getHandle()
+		except BTLEDisconnectError:
+			raise
+		except (BTLEException, IndexError) as ex:
+			logger.info(f'{self.address} service discovery failed, using write handle {JBD_WRITE_HANDLE:#x}: {ex}')
+			self.writeHandle = JBD_WRITE_HANDLE
+			return
 
-			except BTLEDisconnectError:
-				logger.info('Disconnected')
-				connected = False
-				continue
+		get_gatt_cache().put(self.address, write=self.writeHandle, notify=notifyHandle)
+
+	def send(self, link, data):
+		try:
+			link.write(self.writeHandle, data, True)
+		except BTLEGattError as ex:
+			# The cached handle is stale, e.g. after a firmware update
+			logger.info(f'{self.address} write to handle {self.writeHandle:#x} failed, rediscovering: {ex}')
+			get_gatt_cache().drop(self.address)
+			self.discover(link)
+			link.write(self.writeHandle, data, True)
+
+	def checkFirmware(self, firmware):
+		# Called with the firmware version of the first general info of a connection
+		if not self.firmwareChecked:
+			self.firmwareChecked = True
+			get_gatt_cache().checkFirmware(self.address, firmware)
+
+	def negotiateMtu(self, link):
+		# Ask for an MTU that fits whole frames, the one the BMS agreed to or None if the request failed
+		try:
+			response = link.peripheral.setMTU(JBD_MTU)
+		except BTLEDisconnectError:
+			raise
+		except BTLEException as ex:
+			logger.info(f'{self.address} MTU negotiation failed, using {BLE_DEFAULT_MTU} on this connection: {ex}')
+			return None
+
+		mtu = JBD_MTU
+		try:
+			mtu = int(response['mtu'][0])
+		except (KeyError, IndexError, TypeError, ValueError):
+			pass
+		mtu = max(BLE_DEFAULT_MTU, min(mtu, JBD_MTU))
+		logger.info(f'{self.address} MTU {mtu}, frames up to {mtu - BLE_ATT_HEADER_LEN} bytes arrive in one notification')
+		return mtu
+
+	def onDisconnect(self, link):
+		self.reset()
+
+	def poll(self, link):
+		# Each request goes out as soon as the previous response is complete
+		general = self.request(link, JBD_CMD_GENERAL_INFO)
+		return self.request(link, JBD_CMD_CELL_INFO) and general
+
+	def request(self, link, command):
+		# Send a read request and deliver notifications until its response is complete
+		stats = self.stats[command]
+		for attempt in range(JBD_REQUEST_RETRIES + 1):
+			if attempt:
+				stats.retries += 1
+				# Drop what we got of the lost response
+				self.frames.reset()
+
+			slot = JbdPendingRequest(command)
+			self.pending[command] = slot
+			stats.sent += 1
+			self.send(link, JBD_READ_REQUESTS[command])
+
+			deadline = slot.sentAt + JBD_REQUEST_TIMEOUT
+			while not slot.done:
+				timeout = deadline - time.monotonic()
+				if timeout <= 0:
+					break
+				link.wait(timeout)
+
+			if slot.ok:
+				return True
+			if not slot.done:
+				stats.timeouts += 1
+				self.pending.pop(command, None)
+			logger.debug(f"{self.address} request {command:02x} attempt {attempt + 1} failed")
+
+		stats.failures += 1
+		logger.info(f"{self.address} no response to request {command:02x}: {stats}")
+		return False
 
 
 	def connect(self):
-		self.daemon=True
-		self.start()
+		get_manager().add(self)
 
 	def stop(self):
-		self.running = False
+		get_manager().remove(self)
 
 	def addCellDataCallback(self, func):
 		self.cellDataCallback = func
@@ -141,52 +414,40 @@ class JbdBtDev(DefaultDelegate, Thread):
 			logger.info("data is None")
 			return
 
-		hex_data = binascii.hexlify(data)
-		hex_string = hex_data.decode('utf-8')		
-		#logger.info("new Hex_String(" +str(len(data))+"): " + str(hex_string))
-
-
-		HEADER_LEN = 4 #[Start Code][Command][Status][Length]
-		FOOTER_LEN = 3 #[16bit Checksum][Stop Code]
-
-		# Route incoming BMS data
-
-		# Cell Data
-		if hex_string.find('dd04') != -1:
-			self.last_state = "dd04"
-			# Because of small MTU size, the BMS data may not be transmitted in a single packet.
-			# We use the 4th byte defined as "data len" in the BMS protocol to calculate the remaining bytes
-			# that will be transmitted in the second packet
-			self.cellDataTotalLen = data[3] + HEADER_LEN + FOOTER_LEN
-			self.cellDataRemainingLen = self.cellDataTotalLen - len(data)
-			logger.info("cellDataTotalLen: " + str(int(self.cellDataTotalLen)))
-			#logger.info("cellDataRemainingLen: " + str(int(self.cellDataRemainingLen)))
-			self.cellData = data
-		elif self.last_state == "dd04" and hex_string.find('dd04') == -1 and hex_string.find('dd03') == -1: 
-			self.cellData = self.cellData + data
-				
-		# General Data
-		elif hex_string.find('dd03') != -1:
-			self.last_state = "dd03"
-			self.generalDataTotalLen = data[3] + HEADER_LEN + FOOTER_LEN
-			self.generalDataRemainingLen = self.generalDataTotalLen - len(data)
-			logger.info("generalDataTotalLen: " + str(int(self.generalDataTotalLen)))
-			#logger.info("generalDataRemainingLen: " + str(int(self.generalDataRemainingLen)))
-			self.generalData = data
-		elif self.last_state == "dd03" and hex_string.find('dd04') == -1 and hex_string.find('dd03') == -1: 
-			self.generalData = self.generalData + data			
-
-		if self.last_state == "dd04" and self.cellData and len(self.cellData) == self.cellDataTotalLen:			
-			self.cellDataCallback(self.cellData)
-			logger.info("cellData(" + str(len(self.cellData))+ "): " + str(binascii.hexlify(self.cellData).decode('utf-8')))
-			self.last_state == "0000"
-			self.cellData = None
-
-		if self.last_state == "dd03" and self.generalData and len(self.generalData) == self.generalDataTotalLen:			
-			self.generalDataCallback(self.generalData)
-			logger.info("generalData(" + str(len(self.generalData)) + "): " + str(binascii.hexlify(self.generalData).decode('utf-8')))
-			self.last_state == "0000"
-			self.generalData = None
+		self.frames.feed(data)
+
+	def handleFrame(self, command, frame):
+		# frame is a view into the reassembler buffer, consumers must copy what they keep
+		if logger.isEnabledFor(logging.DEBUG):
+			logger.debug("frame %02x(%d): %s", command, len(frame), binascii.hexlify(frame).decode('utf-8'))
+
+		self.complete(command, True)
+
+		if command == JBD_CMD_CELL_INFO:
+			if self.cellDataCallback:
+				self.cellDataCallback(frame)
+		elif command == JBD_CMD_GENERAL_INFO:
+			if self.generalDataCallback:
+				self.generalDataCallback(frame)
+
+	def handleError(self, command):
+		self.complete(command, False)
+
+	def complete(self, command, ok):
+		# Fill the response slot of the request, frames nobody asked for have none
+		slot = self.pending.pop(command, None)
+		if slot is None:
+			return
+		slot.done = True
+		slot.ok = ok
+
+		stats = self.stats[command]
+		if ok:
+			stats.completed += 1
+			stats.lastLatency = time.monotonic() - slot.sentAt
+			stats.maxLatency = max(stats.maxLatency, stats.lastLatency)
+		else:
+			stats.errors += 1
 
 class JbdBt(Battery):
 	def __init__(self, address):
@@ -195,191 +456,139 @@ class JbdBt(Battery):
 		self.protection = JbdProtection()
 		self.type = "JBD BT"
 
-		# Bluepy stuff
-		self.bt = Peripheral()
-		self.bt.setDelegate(self)
-
-		self.mutex = Lock()
-		self.generalData = None
+		# Only touched by the BT thread, the poller only sees published snapshots
+		self.general = None
 		self.generalDataTS = time.monotonic()
-		self.cellData = None
 		self.cellDataTS = time.monotonic()
 
 		self.address = address
 		self.port = "/bt" + address.replace(":", "")
-		self.interval = 5
 
-		dev = JbdBtDev(self.address)
-		dev.addCellDataCallback(self.cellDataCB)
-		dev.addGeneralDataCallback(self.generalDataCB)
-		dev.connect()
+		# The connection is owned by the shared BtManager, created when it first connects
+		self.dev = JbdBtDev(self.address)
+		self.dev.addCellDataCallback(self.cellDataCB)
+		self.dev.addGeneralDataCallback(self.generalDataCB)
+		self.dev.connect()
+		self.watchdog = Watchdog(self.address)
 
 
 	def test_connection(self):
 		return False
 
 	def get_settings(self):
-		result = self.read_gen_data()
+		result = self.apply_snapshot()
 		while not result:
-			result = self.read_gen_data()
+			# A pack that never answers is recovered by the watchdog, up to a reboot
+			self.watchdog.check(min(self.generalDataTS, self.cellDataTS))
 			time.sleep(1)
+			result = self.apply_snapshot()
 		self.max_battery_charge_current = MAX_BATTERY_CHARGE_CURRENT
 		self.max_battery_discharge_current = MAX_BATTERY_DISCHARGE_CURRENT
 		return result
 
 	def refresh_data(self):
-		result = self.read_gen_data()
-		result = result and self.read_cell_data()
-		return result
+		self.watchdog.check(min(self.generalDataTS, self.cellDataTS))
+		return self.apply_snapshot()
 
 	def log_settings(self):
 		# Override log_settings() to call get_settings() first
 		self.get_settings()
 		Battery.log_settings(self)
 
-	def to_protection_bits(self, byte_data):
-		tmp = bin(byte_data)[2:].rjust(13, zero_char)
+	def apply_protection(self, protection):
+		self.to_protection_bits(protection)
 
-		self.protection.voltage_high = 2 if is_bit_set(tmp[10]) else 0
-		self.protection.voltage_low = 2 if is_bit_set(tmp[9]) else 0
-		self.protection.temp_high_charge = 1 if is_bit_set(tmp[8]) else 0
-		self.protection.temp_low_charge = 1 if is_bit_set(tmp[7]) else 0
-		self.protection.temp_high_discharge = 1 if is_bit_set(tmp[6]) else 0
-		self.protection.temp_low_discharge = 1 if is_bit_set(tmp[5]) else 0
-		self.protection.current_over = 1 if is_bit_set(tmp[4]) else 0
-		self.protection.current_under = 1 if is_bit_set(tmp[3]) else 0
+	def to_protection_bits(self, byte_data):
+		# Includes the extra protection flags for LltJbd, which go through the JbdProtection setters
+		JBD_PROTECTION_BITS.apply(self.protection, byte_data)
 
 		# Software implementations for low soc
 		self.protection.soc_low = (
 			2 if self.soc < SOC_LOW_ALARM else 1 if self.soc < SOC_LOW_WARNING else 0
 		)
 
-		# extra protection flags for LltJbd
-		self.protection.set_voltage_low_cell = is_bit_set(tmp[11])
-		self.protection.set_voltage_high_cell = is_bit_set(tmp[12])
-		self.protection.set_software_lock = is_bit_set(tmp[0])
-		self.protection.set_IC_inspection = is_bit_set(tmp[1])
-		self.protection.set_short = is_bit_set(tmp[2])
-
-	def to_cell_bits(self, byte_data, byte_data_high):
-		# clear the list
-		#for c in self.cells:
-		#	self.cells.remove(c)
-		self.cells: List[Cell] = []
-
-		# get up to the first 16 cells
-		tmp = bin(byte_data)[2:].rjust(min(self.cell_count, 16), zero_char)
-		for bit in reversed(tmp):
-			self.cells.append(Cell(is_bit_set(bit)))
-
-		# get any cells above 16
-		if self.cell_count > 16:
-			tmp = bin(byte_data_high)[2:].rjust(self.cell_count - 16, zero_char)
-			for bit in reversed(tmp):
-				self.cells.append(Cell(is_bit_set(bit)))
-
-	def to_fet_bits(self, byte_data):
-		tmp = bin(byte_data)[2:].rjust(2, zero_char)
-		self.charge_fet = is_bit_set(tmp[1])
-		self.discharge_fet = is_bit_set(tmp[0])
-
-	def read_gen_data(self):
-		self.mutex.acquire()
-		self.checkTS(self.generalDataTS)
-
-		if self.generalData == None:
-			self.mutex.release()
-			return False
-
-		gen_data = self.generalData[4:]
-		self.mutex.release()
-
-		if len(gen_data) < 27:
-			return False
+	def read_gen_data(self, gen_data):
+		# Decode the payload of a general info frame, without cell voltages
+		if len(gen_data) < JBD_GENERAL_INFO.size:
+			return None
 
 		(
 			voltage,
 			current,
 			capacity_remain,
 			capacity,
-			self.cycles,
-			self.production,
+			cycles,
+			production,
 			balance,
 			balance2,
 			protection,
 			version,
-			self.soc,
+			soc,
 			fet,
-			self.cell_count,
-			self.temp_sensors,
-		) = unpack_from(">HhHHHHhHHBBBBB", gen_data, 0)
-		self.voltage = voltage / 100
-		self.current = current / 100
-		self.capacity_remain = capacity_remain / 100
-		self.capacity = capacity / 100
-		self.to_cell_bits(balance, balance2)
-		self.version = float(str(version >> 4 & 0x0F) + "." + str(version & 0x0F))
-		self.to_fet_bits(fet)
-		self.to_protection_bits(protection)
-		self.max_battery_voltage = MAX_CELL_VOLTAGE * self.cell_count
-		self.min_battery_voltage = MIN_CELL_VOLTAGE * self.cell_count
-
-		for t in range(self.temp_sensors):
-			temp1 = unpack_from(">H", gen_data, 23 + (2 * t))[0]
-			self.to_temp(t + 1, kelvin_to_celsius(temp1 / 10))
-
-		return True
-
-	def read_cell_data(self):
-		self.mutex.acquire()
-		self.checkTS(self.cellDataTS)
-
-		if self.cellData == None:
-			self.mutex.release()
-			return False
-
-		cell_data = self.cellData[4:]
-		self.mutex.release()
-
-		if len(cell_data) < self.cell_count * 2:
-			return False
+			cell_count,
+			temp_sensors,
+		) = JBD_GENERAL_INFO.unpack_from(gen_data, 0)
+
+		temp_sensors = min(temp_sensors, (len(gen_data) - JBD_GENERAL_INFO.size) // 2)
+		temps = tuple(
+			kelvin_to_celsius(t / 10)
+			for t in unpack_from(">%dH" % temp_sensors, gen_data, JBD_GENERAL_INFO.size)
+		)
+		fets = JBD_FET_BITS.decode(fet)
+
+		return BatterySnapshot(
+			voltage=voltage / 100,
+			current=current / 100,
+			capacity_remain=capacity_remain / 100,
+			capacity=capacity / 100,
+			cycles=cycles,
+			production=production,
+			version=float(str(version >> 4 & 0x0F) + "." + str(version & 0x0F)),
+			soc=soc,
+			charge_fet=fets["charge_fet"],
+			discharge_fet=fets["discharge_fet"],
+			cell_count=cell_count,
+			temps=temps,
+			# the balance bits of cells 1-16 and any cells above 16, bit 0 is cell 1
+			balance_mask=(balance & 0xffff) | balance2 << 16,
+			protection=protection,
+		)
 
-		for c in range(self.cell_count):
-			try:
-				cell_volts = unpack_from(">H", cell_data, c * 2)
-				if len(cell_volts) != 0:
-					self.cells[c].voltage = cell_volts[0] / 1000
-			except struct.error:
-				self.cells[c].voltage = 0
+	def read_cell_data(self, cell_data, general):
+		# Decode the payload of a cell info frame, for the cell count of the general info
+		if len(cell_data) < general.cell_count * 2:
+			return None
 
-		return True
+		return array("H", unpack_from(">%dH" % general.cell_count, cell_data, 0))
 
 	def cellDataCB(self, data):
-		self.mutex.acquire()
-		self.cellData = data
+		# Decoded right away, data is a view into the reassembler buffer
 		self.cellDataTS = time.monotonic()
-		self.mutex.release()
-
-	def generalDataCB(self, data):
-		self.mutex.acquire()
-		self.generalData = data
-		self.generalDataTS = time.monotonic()
-		self.mutex.release()
+		general = self.general
+		if general is None:
+			return
 
-	def checkTS(self, ts):
-		elapsed = 0
-		if ts:
-			elapsed = time.monotonic() - ts
+		cell_mv = self.read_cell_data(data[JBD_HEADER_LEN:-JBD_FOOTER_LEN], general)
+		if cell_mv is None:
+			return
 
-		#if (int(elapsed) % 60) == 0:
-		#	logger.info(elapsed)
+		# Cell data is requested after general data, so this completes a sample
+		snapshot = general.replace(cell_mv=cell_mv, timestamp=self.cellDataTS)
+		self.publish_snapshot(snapshot)
+		self.dev.sampler.update(snapshot)
 
-		if BT_WATCHDOG_TIMER == 0:
+	def generalDataCB(self, data):
+		self.generalDataTS = time.monotonic()
+		general = self.read_gen_data(data[JBD_HEADER_LEN:-JBD_FOOTER_LEN])
+		if general is None:
 			return
+		self.general = general
+		self.dev.checkFirmware(general.version)
 
-		if elapsed > BT_WATCHDOG_TIMER:
-			logger.info('Watchdog timer expired. BT chipset might be locked up. Rebooting')
-			os.system('reboot')
+		# Keep the last cell voltages until the cell frame arrives, if the cell count still matches
+		previous = self.snapshot
+		if previous is not None and previous.cell_count == general.cell_count:
+			self.publish_snapshot(general.replace(cell_mv=previous.cell_mv), False)
 
 
 # Unit test
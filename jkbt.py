@@ -1,13 +1,14 @@
-from bluepy.btle import Peripheral, DefaultDelegate, BTLEException, BTLEDisconnectError, AssignedNumbers
-from threading import Thread, Lock
-from battery import Protection, Battery, Cell
+from bluepy.btle import DefaultDelegate, BTLEException, BTLEDisconnectError, BTLEGattError, AssignedNumbers
+from btmanager import get_manager
+from gattcache import get_gatt_cache
+from watchdog import Watchdog
+from battery import Protection, Battery, BatterySnapshot
+from bitfields import Bitfield, Flag
 from utils import *
 from struct import *
-import argparse
-import sys
+from array import array
 import time
 import binascii
-import atexit
 
 
 OUTGOING_HEADER = b'\xaa\x55\x90\xeb'
@@ -26,79 +27,133 @@ RESPONSE_EXTENDED_RECORD = 0x01
 RESPONSE_CELL_DATA = 0x02
 RESPONSE_DEVICE_INFO_RECORD = 0x03
 
-
-class JkBtDev(DefaultDelegate, Thread):
+RECORD_LEN = 300
+JK_MTU = 331
+MAX_CELLS = 24
+
+# Cell info record (JK02 layout, up to 24 cells). Everything is little endian apart from the
+# system alarm word, which is unpacked as two bytes.
+CELL_RECORD = Struct(
+	'<4x'	# header
+	'BB'	# record type, frame counter
+	'24H'	# cell voltages (mV)
+	'I'	# enabled cells bitmask
+	'HH'	# average cell voltage, cell voltage delta (mV)
+	'BB'	# max voltage cell, min voltage cell
+	'48x'	# cell resistances
+	'2x'	# unused
+	'I'	# wire resistance warning bitmask
+	'I'	# battery voltage (mV)
+	'I'	# battery power (mW)
+	'i'	# battery current (mA)
+	'hhh'	# temperature sensor 1, temperature sensor 2, MOSFET temperature (0.1C)
+	'BB'	# system alarms, high and low byte
+	'h'	# balance current (mA)
+	'BB'	# balancing action, SoC
+	'I'	# remaining capacity (mAh)
+	'I'	# nominal capacity (mAh)
+	'I'	# cycle count
+	'I'	# total cycle capacity (mAh)
+	'8x'	# SoH, precharge, user alarm, runtime
+	'BB'	# charge MOSFET, discharge MOSFET
+)
+
+# System alarm word of the cell info record, applied to Protection
+ALARM_BITS = Bitfield(16, (
+	Flag("temp_high_charge", 0, 1, 0),
+	Flag("temp_low_charge", 1, 1, 0),
+	Flag("voltage_cell_low", 3, 2, 0),
+	Flag("voltage_high", 4, 2, 0),
+	Flag("current_over", 6, 1, 0),
+	Flag("internal_failure", 11, 2, 0),	# current sensor anomaly
+	Flag("current_under", 13, 1, 0),
+	Flag("temp_high_discharge", 15, 1, 0),
+))
+
+
+class JkBtDev(DefaultDelegate):
 	def __init__(self, address):
 		DefaultDelegate.__init__(self)
-		Thread.__init__(self)
 
 		self.incomingData = bytearray()
 		self.address = address
+		# JK BMSes push cell data by themselves, a poll only delivers what arrived
+		self.interval = 1
+		self.link = None
 
-		# Bluepy stuff
-		self.bt = Peripheral()
-		#self.bt.setDelegate(self)
-		self.bt.withDelegate(self)
-
-	def run(self):
-		self.running = True
-		timer = 0
-		connected = False
-		while self.running:
-			if not connected:
-				try:
-					logger.info('Connecting ' + self.address)
-					self.bt.connect(self.address, addrType="public")
-					self.bt.setMTU(331)
+		self.records = 0
+		self.polledRecords = 0
 
-					self.incomingData = bytearray()
-					self.chargeSwitch = None
-					self.dischargeSwitch = None
-					self.commnadAcked = False
+		self.cellDataCallback = None
+		self.deviceInfoCallback = None
+		self.chargeSwitch = None
+		self.dischargeSwitch = None
 
-					#serviceJkbms = self.bt.getServiceByUUID(AssignedNumbers.genericAccess)
+	def onConnect(self, link):
+		self.link = link
+		link.peripheral.setMTU(JK_MTU)
 
-					serviceNotifyUuid = 'ffe0'
-					serviceNotify = self.bt.getServiceByUUID(serviceNotifyUuid)
+		self.incomingData = bytearray()
+		self.chargeSwitch = None
+		self.dischargeSwitch = None
+		self.commandAcked = False
 
-					characteristicConnectionUuid = 'ffe1'
-					characteristicConnection = serviceNotify.getCharacteristics(characteristicConnectionUuid)[0]
-					self.handleConnection = characteristicConnection.getHandle()
+		cached = get_gatt_cache().get(self.address)
+		if cached and "notify" in cached and "cccd" in cached:
+			self.handleConnection = cached["notify"]
+			try:
+				# With response, so a stale handle fails here
+				link.write(cached["cccd"], b'\x01\x00', True)
+			except BTLEGattError as ex:
+				logger.info(f'{self.address} cached handles failed, rediscovering: {ex}')
+				get_gatt_cache().drop(self.address)
+				self.discover(link)
+		else:
+			self.discover(link)
 
-					# make subscription, dynamic search for the respective 2902 characteristics
-					characteristicConnectionDescriptor = characteristicConnection.getDescriptors(AssignedNumbers.client_characteristic_configuration)[0]
-					characteristicConnectionDescriptorHandle = characteristicConnectionDescriptor.handle
+		self.sendCommand(COMMAND_REQ_DEVICE_INFO)
+		self.sendCommand(COMMAND_REQ_EXTENDED_RECORD)
 
-					self.bt.writeCharacteristic(characteristicConnectionDescriptorHandle, b'\x01\x00')
+	def discover(self, link):
+		#serviceJkbms = link.peripheral.getServiceByUUID(AssignedNumbers.genericAccess)
 
-					logger.info('Connected ' + self.address)
-					connected = True
+		serviceNotifyUuid = 'ffe0'
+		serviceNotify = link.peripheral.getServiceByUUID(serviceNotifyUuid)
 
-					self.sendCommand(COMMAND_REQ_DEVICE_INFO)
-					self.sendCommand(COMMAND_REQ_EXTENDED_RECORD)
+		characteristicConnectionUuid = 'ffe1'
+		characteristicConnection = serviceNotify.getCharacteristics(characteristicConnectionUuid)[0]
+		self.handleConnection = characteristicConnection.getHandle()
 
+		# make subscription, dynamic search for the respective 2902 characteristics
+		characteristicConnectionDescriptor = characteristicConnection.getDescriptors(AssignedNumbers.client_characteristic_configuration)[0]
+		characteristicConnectionDescriptorHandle = characteristicConnectionDescriptor.handle
 
-				except BTLEException as ex:
-					logger.info('Connection failed')
-					time.sleep(3)
-					continue
+		link.write(characteristicConnectionDescriptorHandle, b'\x01\x00')
 
-			try:
+		# Commands and notifications share the characteristic
+		get_gatt_cache().put(
+			self.address,
+			notify=self.handleConnection,
+			write=self.handleConnection,
+			cccd=characteristicConnectionDescriptorHandle,
+			mtu=JK_MTU,
+		)
 
-				if self.bt.waitForNotifications(0.5):
-					continue
+	def onDisconnect(self, link):
+		self.incomingData = bytearray()
 
-			except BTLEDisconnectError:
-				logger.info('Disconnected')
-				connected = False
-				continue
+	def poll(self, link):
+		# A sample is a cell data record that arrived since the last poll
+		sampled = self.records != self.polledRecords
+		self.polledRecords = self.records
+		return sampled
 
 
 	def connect(self):
-		self.start()
+		get_manager().add(self)
 
 	def stop(self):
-		self.running = False
+		get_manager().remove(self)
 
 
 	def crc(self, data):
@@ -139,7 +194,9 @@ class JkBtDev(DefaultDelegate, Thread):
 		log = binascii.hexlify(frame)
 
 		try:
-			self.bt.writeCharacteristic(self.handleConnection, frame)
+			self.link.write(self.handleConnection, frame)
+		except BTLEDisconnectError:
+			raise
 		except:
 			logger.info(f'cannot send command: {log}')
 			return
@@ -147,165 +204,200 @@ class JkBtDev(DefaultDelegate, Thread):
 		t = time.time()
 		timeout = t + MAX_COMMAND_TIMEOUT_SECONDS
 		while (not self.commandAcked) and (t < timeout):
-			self.bt.waitForNotifications(timeout - t)
+			self.link.wait(timeout - t)
 			t = time.time()
 
 
 
 
+	def addCellDataCallback(self, func):
+		self.cellDataCallback = func
+
+	def addDeviceInfoCallback(self, func):
+		self.deviceInfoCallback = func
+
 	def handleNotification(self, handle, data):
 
 		if (data.startswith(OUTGOING_HEADER)) and (len(data) == 20):
 			# ACK/NACK packet inside one datagram
-			self.incomingData = data
-			self.processData()
-			self.incomingData = bytearray()
+			self.processData(bytearray(data))
 		else:
 			if (len(self.incomingData) == 0) and (not data.startswith(INCOMING_HEADER)):
 				# ignore wrong start
 				d = binascii.hexlify(data)
-				logger.info('received missaligned data: {d}')
+				logger.info(f'received missaligned data: {d}')
 				return
 
 			self.incomingData += data
-			if len(self.incomingData) == 300:
-				self.processData()
+			if len(self.incomingData) >= RECORD_LEN:
+				# A new record buffer is started, so the finished one can be handed over as is
+				record = self.incomingData[:RECORD_LEN]
 				self.incomingData = bytearray()
+				self.processData(record)
 
-	def processData(self):
+	def processData(self, data):
 		# check CRC8
-		if self.crc(self.incomingData[:-1]) != self.incomingData[len(self.incomingData)-1]:
+		if self.crc(data[:-1]) != data[-1]:
 			# invalid CRC8
-			d = binascii.hexlify(self.incomingData)
-			logger.info('received packet with invaid CRC8: {d}')
+			d = binascii.hexlify(data)
+			logger.info(f'received packet with invaid CRC8: {d}')
 			return
 
-		address = self.incomingData[4]
+		address = data[4]
 
 		if address == RESPONSE_ACK:
-			if (self.incomingData[5] == 0x01) and (self.incomingData[6] == 0x01):
-				print("ACK")
+			if (data[5] == 0x01) and (data[6] == 0x01):
 				self.commandAcked = True
 				return
 			logger.info('received NACK')
 		elif address == RESPONSE_DEVICE_INFO_RECORD:
-			print("DEVICE_INFO_RECORD")
-
-			deviceModel = self.readString(self.incomingData, 6, 16)
-			hardwareVer = self.readString(self.incomingData, 22, 8)
-			softwareVer = self.readString(self.incomingData, 30, 8)
-			upTime = int.from_bytes(self.incomingData[38:42], byteorder='little')
-			powerOnTimes = int.from_bytes(self.incomingData[42:46], byteorder='little')
-			deviceName = self.readString(self.incomingData, 46, 16)
-			devicePass = self.readString(self.incomingData, 62, 16)
-			manufacturingDate = self.readString(self.incomingData, 78, 8)
-			serialNum = self.readString(self.incomingData, 86, 11)
-			password = self.readString(self.incomingData, 97, 5)
-			userData = self.readString(self.incomingData, 102, 16)
-			setupPass = self.readString(self.incomingData, 118, 16)
-			
-
-			print(deviceModel)
-			print(deviceName)
-			print(devicePass)
+			deviceModel = self.readString(data, 6, 16)
+			hardwareVer = self.readString(data, 22, 8)
+			softwareVer = self.readString(data, 30, 8)
+			deviceName = self.readString(data, 46, 16)
+			logger.info(f'{self.address} is a {deviceModel} named {deviceName}, hw {hardwareVer} sw {softwareVer}')
 
 			self.name = deviceName
+			get_gatt_cache().checkFirmware(self.address, softwareVer)
+			if self.deviceInfoCallback:
+				self.deviceInfoCallback(deviceModel, hardwareVer, softwareVer)
 		elif address == RESPONSE_EXTENDED_RECORD:
-			print("DEVICE_EXTENDED_RECORD")
-			self.chargeSwitch = True if (self.incomingData[118] == 0x01) else False
-			self.dischargeSwitch = True if (self.incomingData[122] == 0x01) else False
+			self.chargeSwitch = True if (data[118] == 0x01) else False
+			self.dischargeSwitch = True if (data[122] == 0x01) else False
 		elif address == RESPONSE_CELL_DATA:
-			print("DEVICE_CELL_DATA")
-			soc = self.incomingData[141] # SoC
-			totalVol = int.from_bytes(self.incomingData[118:122], byteorder='little')/1000 # Voltage
-			print(totalVol)
-			cellVol = [0] * 16
-			for i in range(0,16):
-				cellVol[i] = int.from_bytes(self.incomingData[6+2*i:8+2*i], byteorder='little')/1000 # Cell Voltage
-			chgCurr = int.from_bytes(self.incomingData[126:130], byteorder='little', signed=True)/1000 # Current
-			if chgCurr < 0:
-				disCurr = - chgCurr
-				chgCurr = 0
-			capacityAH = int.from_bytes(self.incomingData[142:146], byteorder='little')/1000 # remaining capacity AH
-			cycleAH = int.from_bytes(self.incomingData[154:158], byteorder='little')/1000 # cycle AH (accumulated value over master reset)
-			tempMOSFET = int(int.from_bytes(self.incomingData[134:136], byteorder='little', signed=True)/10) # MOSFET temperature
-			tempT1 = int(int.from_bytes(self.incomingData[130:132], byteorder='little', signed=True)/10) # T1 temperature
-			tempT2 = int(int.from_bytes(self.incomingData[132:134], byteorder='little', signed=True)/10) # T2 temperature
-			chgMOSFET = self.incomingData[166] # Charging MOSFET status flag
-			if (chgMOSFET == 0) and (not self.chargeSwitch):
-				chgMOSFET = 15
-			disMOSFET = self.incomingData[167] # Discharge MOSFET status flag
-			if (disMOSFET == 0) and (not self.dischargeSwitch):
-				disMOSFET = 15
-			balSt = 0 if (self.incomingData[140] == 0) else 4
-			disPower = int(int.from_bytes(self.incomingData[122:126], byteorder='little')/1000) # Power
-			if chgCurr > 0:
-				chgPower = disPower
-				disPower = 0
-			cellHigh = self.incomingData[62]+1 # Cell High number
-			cellHighVol = cellVol[cellHigh-1] # Cell High Voltage
-			cellLow = self.incomingData[63]+1 # Cell Low number
-			cellLowVol = cellVol[cellLow-1] # Cell Low Voltage
-			cellAvgVol = int.from_bytes(self.incomingData[58:60], byteorder='little')/1000 # Cell Average
-			cellDiffVol = int.from_bytes(self.incomingData[60:62], byteorder='little')/1000 # Cell diff
-
-			errorState = int.from_bytes(self.incomingData[136:138], byteorder='big')
-			if (errorState & 0x0003 != 0) and (chgMOSFET != 1): # bit 0 - charge over temp & bit 1 - charge under temp
-				chgMOSFET = 6
-			if (errorState & 0x0008 != 0) and (disMOSFET != 1): # bit 3 - cell undervoltage
-				disMOSFET = 2
-			if (errorState & 0x0010 != 0) and (chgMOSFET != 1): # bit 4 - cell overvoltage
-				chgMOSFET = 2
-			if (errorState & 0x0040 != 0) and (chgMOSFET != 1): # bit 6 - charge overcurrent
-				chgMOSFET = 3
-			if (errorState & 0x0800 != 0): # bit 9 - current sensor annomaly
-				ignore = 1
-			if (errorState & 0x2000 != 0) and (disMOSFET != 1): # bit 13 - discharge over current
-				disMOSFET = 3
-			if (errorState & 0x8000 != 0) and (disMOSFET != 1): # bit 15 - discharge over temp
-				disMOSFET = 6
-			if (errorState & 0x57a4 != 0):
-				logger.info(f'unknown system alarms: {errorState:x}')
-
-			
+			self.records += 1
+			if self.cellDataCallback:
+				self.cellDataCallback(data)
+
 
 
 class JkBt(Battery):
 	def __init__(self, address):
 		Battery.__init__(self, 0, 0, address)
 
-		self.protection = None
+		self.protection = Protection()
 		self.type = "JK BT"
 
-		# Bluepy stuff
-		self.bt = Peripheral()
-		self.bt.setDelegate(self)
-
-		self.mutex = Lock()
+		# Only touched by the BT thread, the poller only sees published snapshots
+		self.cellDataTS = time.monotonic()
+		self.hardwareVersion = None
+		self.softwareVersion = None
+		self.alarms = 0
 
 		self.address = address
 		self.port = "/bt" + address.replace(":", "")
-		self.interval = 5
 
-		dev = JkBtDev(self.address)
-		dev.connect()
+		# The connection is owned by the shared BtManager, created when it first connects
+		self.dev = JkBtDev(self.address)
+		self.dev.addCellDataCallback(self.cellDataCB)
+		self.dev.addDeviceInfoCallback(self.deviceInfoCB)
+		self.dev.connect()
+		self.watchdog = Watchdog(self.address)
 
 
 	def test_connection(self):
 		return False
 
 	def get_settings(self):
-		return False
+		result = self.apply_snapshot()
+		while not result:
+			# A pack that never answers is recovered by the watchdog, up to a reboot
+			self.watchdog.check(self.cellDataTS)
+			time.sleep(1)
+			result = self.apply_snapshot()
+		self.max_battery_charge_current = MAX_BATTERY_CHARGE_CURRENT
+		self.max_battery_discharge_current = MAX_BATTERY_DISCHARGE_CURRENT
+		return result
 
 	def refresh_data(self):
-		return False
+		self.watchdog.check(self.cellDataTS)
+		return self.apply_snapshot()
 
 	def log_settings(self):
 		# Override log_settings() to call get_settings() first
 		self.get_settings()
 		Battery.log_settings(self)
 
-
+	def apply_protection(self, protection):
+		self.to_protection_bits(protection)
+
+	def to_protection_bits(self, alarms):
+		ALARM_BITS.apply(self.protection, alarms)
+
+		# Software implementations for low soc
+		self.protection.soc_low = (
+			2 if self.soc < SOC_LOW_ALARM else 1 if self.soc < SOC_LOW_WARNING else 0
+		)
+
+		if alarms != self.alarms and ALARM_BITS.unknown(alarms):
+			logger.info(f'unknown system alarms: {alarms:x}')
+		self.alarms = alarms
+
+	def read_cell_data(self, cell_data):
+		# Decode a cell info record
+		if len(cell_data) < CELL_RECORD.size:
+			return None
+
+		(
+			record_type,
+			counter,
+			*cell_volts,
+			enabled_cells,
+			cell_avg,
+			cell_delta,
+			max_cell,
+			min_cell,
+			wire_warnings,
+			voltage,
+			power,
+			current,
+			temp1,
+			temp2,
+			temp_mos,
+			alarms_high,
+			alarms_low,
+			balance_current,
+			balancing,
+			soc,
+			capacity_remain,
+			capacity,
+			cycles,
+			cycle_capacity,
+			charge_mos,
+			discharge_mos,
+		) = CELL_RECORD.unpack_from(cell_data, 0)
+
+		cell_count = min(bin(enabled_cells).count("1"), MAX_CELLS)
+
+		return BatterySnapshot(
+			voltage=voltage / 1000,
+			current=current / 1000,
+			soc=soc,
+			capacity_remain=capacity_remain / 1000,
+			capacity=capacity / 1000,
+			cycles=cycles,
+			total_ah_drawn=cycle_capacity / 1000,
+			version=self.softwareVersion,
+			hardware_version=self.hardwareVersion,
+			charge_fet=charge_mos == 1,
+			discharge_fet=discharge_mos == 1,
+			cell_count=cell_count,
+			cell_mv=array("H", cell_volts[:cell_count]),
+			# The BMS only reports a balancing action, flag the cells the balancer works between
+			balance_mask=1 << max_cell | 1 << min_cell if balancing else 0,
+			temps=(temp1 / 10, temp2 / 10),
+			protection=alarms_high << 8 | alarms_low,
+		)
+
+	def cellDataCB(self, data):
+		self.cellDataTS = time.monotonic()
+		snapshot = self.read_cell_data(data)
+		if snapshot is not None:
+			self.publish_snapshot(snapshot)
+
+	def deviceInfoCB(self, model, hardware, software):
+		self.hardwareVersion = model + " " + hardware
+		self.softwareVersion = software
 
 
 
@@ -320,8 +412,9 @@ if __name__ == "__main__":
 
 	while True:
 		batt.refresh_data()
-
-
+		print("Cells " + str(batt.cell_count) )
+		for c in range(batt.cell_count):
+			print( str(batt.cells[c].voltage) + "v", end=" " )
 		print("")
 
 
@@ -0,0 +1,85 @@
+from threading import Thread, Event
+from utils import *
+import time
+
+
+
+class PublishWorker(Thread):
+	"""
+	Long lived thread that runs DbusHelper.publish_battery on a schedule.
+
+	Ticks are scheduled on a monotonic deadline, so they don't drift. A publish can never
+	overlap the previous one: when a publish runs past one or more deadlines, the missed
+	ticks are coalesced into the next one and counted as late.
+
+	With frame_driven set, trigger() publishes right away and interval is only a keep-alive,
+	restarted after every publish. Triggers that arrive during a publish are coalesced into one.
+	"""
+
+	def __init__(self, helper, loop, interval, frame_driven=False):
+		Thread.__init__(self)
+		# Thread will die with us if deamon
+		self.daemon = True
+
+		self.helper = helper
+		self.loop = loop
+		self.interval = interval / 1000
+		self.frame_driven = frame_driven
+		self.running = False
+		self.wakeup = Event()
+
+		self.ticks = 0
+		self.triggered_ticks = 0
+		self.late_ticks = 0
+		self.skipped_ticks = 0
+		self.last_duration = 0
+		self.max_duration = 0
+
+
+	def run(self):
+		self.running = True
+		deadline = time.monotonic() + self.interval
+		while self.running:
+			timeout = deadline - time.monotonic()
+			if timeout > 0:
+				self.wakeup.wait(timeout)
+			if not self.running:
+				break
+			if self.wakeup.is_set():
+				self.wakeup.clear()
+				self.triggered_ticks += 1
+
+			start = time.monotonic()
+			self.helper.publish_battery(self.loop)
+			end = time.monotonic()
+
+			self.ticks += 1
+			self.last_duration = end - start
+			self.max_duration = max(self.max_duration, self.last_duration)
+
+			if self.frame_driven:
+				# Only keep-alive when no fresh data arrives
+				deadline = end + self.interval
+				continue
+
+			deadline += self.interval
+			if end > deadline:
+				# Overrun, coalesce the ticks we missed into the next one
+				missed = int((end - deadline) / self.interval) + 1
+				deadline += missed * self.interval
+				self.late_ticks += 1
+				self.skipped_ticks += missed
+				logger.debug(
+					f"publish took {self.last_duration:.3f}s, skipped {missed} tick(s), "
+					f"{self.late_ticks} late of {self.ticks}"
+				)
+
+
+	def trigger(self):
+		# Called from the BMS driver thread when a fresh sample arrived
+		if self.frame_driven:
+			self.wakeup.set()
+
+	def stop(self):
+		self.running = False
+		self.wakeup.set()
@@ -0,0 +1,95 @@
+from utils import *
+
+# The interval grows by at most this factor per sample when the pack calms down
+POLL_BACKOFF = 1.5
+
+
+# (curve, value, margin) of the enabled limit curves a pack should not cross unnoticed. The
+# values are computed by AdaptiveSampler.levels() from a snapshot.
+BREAKPOINT_WATCH = []
+if CCCM_CV_ENABLE:
+	BREAKPOINT_WATCH.append((CHARGE_CURRENT_CV_CURVE, "max_cell", POLL_BREAKPOINT_MARGIN_VOLTAGE))
+if DCCM_CV_ENABLE:
+	BREAKPOINT_WATCH.append((DISCHARGE_CURRENT_CV_CURVE, "min_cell", POLL_BREAKPOINT_MARGIN_VOLTAGE))
+if CCCM_T_ENABLE:
+	BREAKPOINT_WATCH.append((CHARGE_CURRENT_T_CURVE, "max_temp", POLL_BREAKPOINT_MARGIN_TEMPERATURE))
+	BREAKPOINT_WATCH.append((CHARGE_CURRENT_T_CURVE, "min_temp", POLL_BREAKPOINT_MARGIN_TEMPERATURE))
+if DCCM_T_ENABLE:
+	BREAKPOINT_WATCH.append((DISCHARGE_CURRENT_T_CURVE, "max_temp", POLL_BREAKPOINT_MARGIN_TEMPERATURE))
+	BREAKPOINT_WATCH.append((DISCHARGE_CURRENT_T_CURVE, "min_temp", POLL_BREAKPOINT_MARGIN_TEMPERATURE))
+if CCCM_SOC_ENABLE:
+	BREAKPOINT_WATCH.append((CHARGE_CURRENT_SOC_CURVE, "soc", POLL_BREAKPOINT_MARGIN_SOC))
+if DCCM_SOC_ENABLE:
+	BREAKPOINT_WATCH.append((DISCHARGE_CURRENT_SOC_CURVE, "soc", POLL_BREAKPOINT_MARGIN_SOC))
+
+
+
+class AdaptiveSampler(object):
+	"""
+	Chooses the poll interval of a pack from the snapshots it delivers.
+
+	Every snapshot is compared to the previous one. The urgency is the largest of the rates of
+	change of current, cell spread and temperature, each relative to its POLL_FAST_* rate, and
+	of how close a watched value gets to a setpoint of an enabled limit curve, counting only
+	setpoints where the limit changes and that the value moves toward. An urgency of 1 or
+	more polls at minInterval, 0 at maxInterval. A shorter interval is taken at once, a longer
+	one only grows by POLL_BACKOFF per sample, so a single quiet sample doesn't slow us down.
+	"""
+
+	def __init__(self, minInterval=POLL_INTERVAL_MIN, maxInterval=POLL_INTERVAL_MAX):
+		self.minInterval = min(minInterval, maxInterval)
+		self.maxInterval = max(minInterval, maxInterval)
+		# Start fast, to have data right after connecting
+		self.interval = self.minInterval
+		self.urgency = 0
+		self.previous = None
+		self.previousLevels = None
+
+	def levels(self, snapshot):
+		cell_mv = snapshot.cell_mv
+		temps = snapshot.temps or (0,)
+		return {
+			"current": snapshot.current or 0,
+			"spread": max(cell_mv) - min(cell_mv) if cell_mv else 0,
+			"max_cell": max(cell_mv) / 1000 if cell_mv else None,
+			"min_cell": min(cell_mv) / 1000 if cell_mv else None,
+			"max_temp": max(temps),
+			"min_temp": min(temps),
+			"soc": snapshot.soc,
+		}
+
+	def update(self, snapshot):
+		# Take a new snapshot into account and return the poll interval
+		levels = self.levels(snapshot)
+		previous = self.previous
+		previousLevels = self.previousLevels
+		self.previous = snapshot
+		self.previousLevels = levels
+		if previous is None:
+			return self.interval
+
+		elapsed = snapshot.timestamp - previous.timestamp
+		if elapsed <= 0:
+			return self.interval
+
+		urgency = max(
+			abs(levels["current"] - previousLevels["current"]) / elapsed / POLL_FAST_CURRENT_RATE,
+			abs(levels["spread"] - previousLevels["spread"]) / elapsed / POLL_FAST_SPREAD_RATE,
+			max(abs(levels["max_temp"] - previousLevels["max_temp"]), abs(levels["min_temp"] - previousLevels["min_temp"]))
+				/ elapsed / POLL_FAST_TEMPERATURE_RATE,
+		)
+		for curve, name, margin in BREAKPOINT_WATCH:
+			value = levels[name]
+			previousValue = previousLevels[name]
+			if value is None or previousValue is None or margin <= 0:
+				continue
+			# Only a setpoint the value moves toward is urgent
+			urgency = max(urgency, 1 - curve.breakpoint_distance(value, value - previousValue) / margin)
+		self.urgency = urgency
+
+		target = self.maxInterval - (self.maxInterval - self.minInterval) * min(urgency, 1)
+		if target < self.interval:
+			self.interval = target
+		else:
+			self.interval = min(target, self.interval * POLL_BACKOFF)
+		return self.interval
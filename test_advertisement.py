@@ -0,0 +1,59 @@
+import unittest
+
+import pytest
+
+pytest.importorskip("bluepy.btle")
+
+from advertisement import decode_bthome
+
+
+def service_data(*objects, info=0x40):
+	return bytes((0xd2, 0xfc, info)) + b"".join(bytes(o) for o in objects)
+
+
+class DecodeBthomeTest(unittest.TestCase):
+	def test_battery_fields(self):
+		data = service_data(
+			(0x00, 0x2a),			# packet id 42
+			(0x01, 0x55),			# soc 85 %
+			(0x02, 0xc4, 0x09),		# temperature 25.00 °C
+			(0x0c, 0xd0, 0x34),		# voltage 13.520 V
+			(0x5d, 0x18, 0xfc),		# current -1.000 A
+			(0x45, 0x9c, 0xff),		# temperature -10.0 °C
+		)
+		values = decode_bthome(data)
+		self.assertEqual(values["packet_id"], 42)
+		self.assertEqual(values["soc"], 85)
+		self.assertAlmostEqual(values["voltage"], 13.52)
+		self.assertAlmostEqual(values["current"], -1.0)
+		self.assertEqual(len(values["temps"]), 2)
+		self.assertAlmostEqual(values["temps"][0], 25.0)
+		self.assertAlmostEqual(values["temps"][1], -10.0)
+
+	def test_unused_objects_are_skipped(self):
+		data = service_data(
+			(0x04, 0x01, 0x02, 0x03),	# pressure, 3 bytes
+			(0x15, 0x01),			# battery low, binary
+			(0x53, 0x02, 0x41, 0x42),	# text with a length byte
+			(0x01, 0x32),
+		)
+		self.assertEqual(decode_bthome(data), {"soc": 50})
+
+	def test_stops_at_unknown_object(self):
+		data = service_data((0x01, 0x32), (0xf0, 0x01), (0x0c, 0xd0, 0x34))
+		self.assertEqual(decode_bthome(data), {"soc": 50})
+
+	def test_truncated_object(self):
+		self.assertEqual(decode_bthome(service_data((0x01, 0x32), (0x0c, 0xd0))), {"soc": 50})
+
+	def test_not_bthome(self):
+		self.assertIsNone(decode_bthome(None))
+		self.assertIsNone(decode_bthome(b"\xd2\xfc"))
+		self.assertIsNone(decode_bthome(b"\x1a\x18\x40\x01\x32"))
+		# Encrypted, and version 1
+		self.assertIsNone(decode_bthome(service_data((0x01, 0x32), info=0x41)))
+		self.assertIsNone(decode_bthome(service_data((0x01, 0x32), info=0x20)))
+
+
+if __name__ == "__main__":
+	unittest.main()
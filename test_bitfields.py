@@ -0,0 +1,55 @@
+import unittest
+
+from bitfields import Bitfield, Flag
+
+
+class Target(object):
+	def __init__(self):
+		self.calls = []
+
+	def set_lock(self, value):
+		self.calls.append(value)
+
+
+BITS = Bitfield(16, (
+	Flag("charge", 0),
+	Flag("alarm", 3, 2, 0),
+	Flag("set_lock", 9, setter=True),
+	Flag("fault", 15, "yes", "no"),
+))
+
+
+class BitfieldTest(unittest.TestCase):
+	def test_one_lane_per_used_byte(self):
+		self.assertEqual([shift for shift, table in BITS.lanes], [0, 8])
+		self.assertEqual(len(BITS.lanes[0][1]), 256)
+
+	def test_decode(self):
+		self.assertEqual(BITS.decode(0), {"charge": False, "alarm": 0, "set_lock": False, "fault": "no"})
+		self.assertEqual(BITS.decode(0x8209), {"charge": True, "alarm": 2, "set_lock": True, "fault": "yes"})
+
+	def test_decode_matches_bit_tests(self):
+		for value in range(0, 0x10000, 7):
+			expected = {f.name: f.on if value >> f.bit & 1 else f.off for f in BITS.flags}
+			self.assertEqual(BITS.decode(value), expected)
+
+	def test_apply(self):
+		target = Target()
+		BITS.apply(target, 0x0208)
+		self.assertEqual(target.charge, False)
+		self.assertEqual(target.alarm, 2)
+		self.assertEqual(target.fault, "no")
+		self.assertEqual(target.calls, [True])
+
+	def test_unknown(self):
+		self.assertEqual(BITS.unknown(0x8209), 0)
+		self.assertEqual(BITS.unknown(0x10006), 0x0006)
+
+	def test_empty_lane_skipped(self):
+		bits = Bitfield(16, (Flag("high", 12),))
+		self.assertEqual([shift for shift, table in bits.lanes], [8])
+		self.assertEqual(bits.decode(0x1000), {"high": True})
+
+
+if __name__ == "__main__":
+	unittest.main()
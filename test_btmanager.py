@@ -0,0 +1,145 @@
+import time
+import unittest
+
+import pytest
+
+pytest.importorskip("bluepy.btle")
+
+from btmanager import BtLink, BtManager
+
+
+class Handler(object):
+	def __init__(self, address, interval):
+		self.address = address
+		self.interval = interval
+
+
+def make_links(manager, intervals, airtime):
+	links = []
+	for i, interval in enumerate(intervals):
+		link = BtLink(Handler("aa:bb:cc:dd:ee:%02x" % i, interval), manager)
+		link.connected = True
+		link.airtime = airtime
+		manager.links[link.address] = link
+		links.append(link)
+	return links
+
+
+class StretchTest(unittest.TestCase):
+	def test_within_budget_keeps_interval(self):
+		manager = BtManager(1, 1, 0.5)
+		make_links(manager, [1.0, 10.0], 0.1)
+		self.assertEqual(manager.stretch(1.0), 1.0)
+		self.assertEqual(manager.stretch(10.0), 10.0)
+
+	def test_each_link_keeps_its_own_interval(self):
+		manager = BtManager(1, 1, 0.5)
+		links = make_links(manager, [1.0, 10.0], 0.5)
+		# 0.5 / 1 + 0.5 / 10 = 0.55, over the budget by a factor 1.1
+		self.assertAlmostEqual(manager.stretch(1.0), 1.1)
+		self.assertAlmostEqual(manager.stretch(10.0), 11.0)
+		self.assertAlmostEqual(manager.airtimeLoad, 0.55)
+
+	def test_stretched_intervals_meet_the_budget(self):
+		manager = BtManager(1, 1, 0.5)
+		links = make_links(manager, [2.0] * 8, 0.25)
+		for _ in range(10):
+			for link in links:
+				link.interval = manager.stretch(link.handler.interval)
+		load = sum(link.airtime / link.interval for link in links)
+		self.assertAlmostEqual(links[0].interval, 4.0)
+		self.assertAlmostEqual(load, 0.5)
+
+
+class ClaimTest(unittest.TestCase):
+	def setUp(self):
+		self.manager = BtManager(1, 2, maxConnections=2)
+		self.links = make_links(self.manager, [1.0] * 4, 0.1)
+		for i, link in enumerate(self.links):
+			link.connected = False
+			link.lastSample = 100 + i
+
+	def woken(self):
+		return [entry[2] for entry in sorted(self.manager.queue)]
+
+	def test_claims_up_to_max_connections(self):
+		self.assertTrue(self.manager.claim(self.links[0]))
+		self.assertTrue(self.manager.claim(self.links[1]))
+		self.assertFalse(self.manager.claim(self.links[2]))
+		self.assertEqual(self.manager.connections, 2)
+		self.assertEqual(self.manager.connecting, 2)
+		self.assertEqual([entry[2] for entry in self.manager.parked], [self.links[2]])
+
+	def test_freed_connection_goes_to_oldest_data(self):
+		self.manager.claim(self.links[0])
+		self.manager.claim(self.links[1])
+		self.manager.claim(self.links[3])
+		self.manager.claim(self.links[2])
+		self.manager.connected()
+		self.manager.connected()
+		self.assertEqual(self.woken(), [])
+		self.manager.release()
+		self.assertEqual(self.woken(), [self.links[2]])
+		self.assertEqual(self.manager.waking, {self.links[2]})
+
+	def test_no_jumping_ahead_of_parked_links(self):
+		self.manager.claim(self.links[1])
+		self.manager.claim(self.links[2])
+		self.manager.claim(self.links[0])
+		self.manager.connected()
+		self.manager.release()
+		# links[3] has newer data than the woken links[0], so it waits for its turn
+		self.assertFalse(self.manager.claim(self.links[3]))
+		self.assertTrue(self.manager.claim(self.links[0]))
+		self.assertEqual(self.manager.waking, set())
+
+	def test_connecting_turns_are_limited(self):
+		manager = BtManager(1, 1)
+		links = make_links(manager, [1.0, 1.0], 0.1)
+		self.assertTrue(manager.claim(links[0]))
+		self.assertFalse(manager.claim(links[1]))
+		manager.connected()
+		self.assertEqual(manager.waking, {links[1]})
+		self.assertTrue(manager.claim(links[1]))
+
+
+class CycleTest(unittest.TestCase):
+	def setUp(self):
+		self.manager = BtManager(1, 1, maxStaleness=60)
+		self.links = make_links(self.manager, [1.0, 1.0, 1.0], 0.1)
+		self.start = self.manager.cycleStart
+
+	def test_cycle_closes_when_every_link_sampled(self):
+		for i, link in enumerate(self.links):
+			self.manager.sampled(link, self.start + 2 * (i + 1))
+		self.assertEqual(self.manager.cycles, 1)
+		self.assertAlmostEqual(self.manager.lastCycle, 6.0)
+		self.assertAlmostEqual(self.manager.cycleRate, 0.5)
+		self.assertEqual(self.manager.missedDeadlines, 0)
+
+	def test_dead_link_closes_cycle_on_deadline(self):
+		self.manager.sampled(self.links[0], self.start + 1)
+		self.manager.sampled(self.links[1], self.start + 2)
+		self.assertEqual(self.manager.cycles, 0)
+		self.manager.checkCycle(self.start + 61)
+		self.assertEqual(self.manager.cycles, 1)
+		self.assertEqual(self.manager.missedDeadlines, 1)
+		self.assertAlmostEqual(self.manager.cycleRate, 2 / 61)
+
+	def test_missing_link_is_counted_once(self):
+		self.manager.checkCycle(self.start + 61)
+		self.manager.checkCycle(self.start + 122)
+		self.assertEqual(self.manager.cycles, 2)
+		self.assertEqual(self.manager.missedDeadlines, 3)
+		# The late sample was already counted by the deadline
+		link = self.links[0]
+		link.lastSample = self.start
+		self.manager.sampled(link, self.start + 130)
+		self.assertEqual(self.manager.missedDeadlines, 3)
+		link.lastSample = self.start + 130
+		self.manager.sampled(link, self.start + 200)
+		self.assertEqual(self.manager.missedDeadlines, 4)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("dbus")
+
+import dbushelper
+from dbushelper import DbusPublisher
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class DbusPublisherTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(dbushelper, "monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = {}
+        self.publisher = DbusPublisher(self.service, 60, batch=False)
+
+    def test_deadbands(self):
+        self.assertEqual(DbusPublisher.get_deadband("/Dc/0/Current"), 0.05)
+        self.assertEqual(DbusPublisher.get_deadband("/Voltages/Cell3"), 0.001)
+        self.assertEqual(DbusPublisher.get_deadband("/Voltages/Sum"), 0.01)
+        self.assertEqual(DbusPublisher.get_deadband("/Soc"), 0)
+
+    def test_small_change_is_suppressed(self):
+        self.publisher["/Dc/0/Voltage"] = 53.20
+        self.publisher["/Dc/0/Voltage"] = 53.205
+        self.assertEqual(self.service["/Dc/0/Voltage"], 53.20)
+        self.assertEqual(self.publisher.suppressed, 1)
+
+    def test_step_of_one_deadband_is_published(self):
+        # 53.21 - 53.20 comes out a hair below 0.01
+        self.publisher["/Dc/0/Voltage"] = 53.20
+        self.publisher["/Dc/0/Voltage"] = 53.21
+        self.assertEqual(self.service["/Dc/0/Voltage"], 53.21)
+        self.assertEqual(self.publisher.writes, 2)
+
+    def test_deadband_is_measured_from_published_value(self):
+        for value in (53.200, 53.204, 53.208, 53.212):
+            self.publisher["/Dc/0/Voltage"] = value
+        self.assertEqual(self.service["/Dc/0/Voltage"], 53.212)
+        self.assertEqual(self.publisher.writes, 2)
+
+    def test_unchanged_value_is_suppressed(self):
+        self.publisher["/Soc"] = 80
+        self.publisher["/Soc"] = 80
+        self.publisher["/Soc"] = 81
+        self.assertEqual(self.publisher.writes, 2)
+        self.assertEqual(self.publisher.suppressed, 1)
+
+    def test_type_change_is_published(self):
+        self.publisher["/Soc"] = 80
+        self.publisher["/Soc"] = None
+        self.assertIsNone(self.service["/Soc"])
+
+    def test_republished_after_max_interval(self):
+        self.publisher["/Dc/0/Current"] = 1.0
+        self.clock.now += 61
+        self.publisher["/Dc/0/Current"] = 1.0
+        self.assertEqual(self.publisher.writes, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import pytest
+
+btle = pytest.importorskip("bluepy.btle")
+
+import jbdbt
+from gattcache import GattCache
+from jbdbt import JbdBtDev, JbdFrameReassembler, JBD_CMD_CELL_INFO, JBD_CMD_GENERAL_INFO
+
+
+def make_frame(command, payload, status=0x00):
+	body = bytes((status, len(payload))) + bytes(payload)
+	checksum = (0x10000 - sum(body)) & 0xffff
+	return bytes((0xdd, command)) + body + bytes((checksum >> 8, checksum & 0xff, 0x77))
+
+
+class ReassemblerTest(unittest.TestCase):
+	def setUp(self):
+		self.frames = []
+		self.failed = []
+		self.reassembler = JbdFrameReassembler(
+			lambda command, frame: self.frames.append((command, bytes(frame))), self.failed.append
+		)
+
+	def test_single_packet(self):
+		frame = make_frame(JBD_CMD_CELL_INFO, [0x0c, 0xe4, 0x0c, 0xe5])
+		self.reassembler.feed(frame)
+		self.assertEqual(self.frames, [(JBD_CMD_CELL_INFO, frame)])
+		self.assertEqual(self.reassembler.singlePacket, 1)
+
+	def test_split_over_notifications(self):
+		frame = make_frame(JBD_CMD_GENERAL_INFO, range(40))
+		for i in range(0, len(frame), 20):
+			self.reassembler.feed(frame[i:i + 20])
+		self.assertEqual(self.frames, [(JBD_CMD_GENERAL_INFO, frame)])
+		self.assertEqual(self.reassembler.singlePacket, 0)
+
+	def test_start_bytes_in_payload(self):
+		# Payload bytes reading dd 03 must not restart the frame
+		frame = make_frame(JBD_CMD_GENERAL_INFO, [0xdd, 0x03, 0x00, 0x10] * 6)
+		for i in range(0, len(frame), 7):
+			self.reassembler.feed(frame[i:i + 7])
+		self.assertEqual(self.frames, [(JBD_CMD_GENERAL_INFO, frame)])
+
+	def test_garbage_before_frame(self):
+		frame = make_frame(JBD_CMD_CELL_INFO, [0x0c, 0xe4])
+		self.reassembler.feed(b'\x01\x02' + frame[:5])
+		self.reassembler.feed(frame[5:])
+		self.assertEqual(self.frames, [(JBD_CMD_CELL_INFO, frame)])
+
+	def test_bad_checksum_resyncs(self):
+		bad = bytearray(make_frame(JBD_CMD_CELL_INFO, [0x0c, 0xe4]))
+		bad[-2] ^= 0xff
+		frame = make_frame(JBD_CMD_GENERAL_INFO, [0x01, 0x02])
+		self.reassembler.feed(bytes(bad) + frame)
+		self.assertEqual(self.frames, [(JBD_CMD_GENERAL_INFO, frame)])
+		self.assertEqual(self.reassembler.errors, 1)
+
+	def test_false_start_byte(self):
+		# A start byte followed by an impossible status is skipped
+		frame = make_frame(JBD_CMD_CELL_INFO, [0x0c, 0xe4])
+		self.reassembler.feed(b'\xdd\x03\x42\x02' + frame)
+		self.assertEqual(self.frames, [(JBD_CMD_CELL_INFO, frame)])
+
+	def test_error_status(self):
+		self.reassembler.feed(make_frame(JBD_CMD_CELL_INFO, [], status=0x80))
+		self.assertEqual(self.frames, [])
+		self.assertEqual(self.failed, [JBD_CMD_CELL_INFO])
+		self.assertEqual(self.reassembler.errors, 1)
+
+
+class Peripheral(object):
+	def __init__(self, responses):
+		self.responses = list(responses)
+		self.requests = 0
+
+	def setMTU(self, mtu):
+		self.requests += 1
+		response = self.responses.pop(0)
+		if isinstance(response, Exception):
+			raise response
+		return {"mtu": [response]}
+
+
+class Link(object):
+	def __init__(self, peripheral):
+		self.peripheral = peripheral
+
+
+class MtuTest(unittest.TestCase):
+	ADDRESS = "aa:bb:cc:dd:ee:ff"
+
+	def setUp(self):
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		self.cache = GattCache(os.path.join(directory.name, "gatt_cache.json"))
+		self.cache.put(self.ADDRESS, write=0x15)
+		patcher = mock.patch.object(jbdbt, "get_gatt_cache", lambda: self.cache)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.dev = JbdBtDev(self.ADDRESS)
+
+	def test_negotiated_mtu_is_cached(self):
+		self.dev.onConnect(Link(Peripheral([247])))
+		self.assertEqual(self.dev.mtu, 247)
+		self.assertEqual(self.cache.get(self.ADDRESS)["mtu"], 247)
+
+	def test_default_mtu_is_not_asked_again(self):
+		peripheral = Peripheral([23])
+		self.dev.onConnect(Link(peripheral))
+		self.dev.onConnect(Link(peripheral))
+		self.assertEqual(self.dev.mtu, 23)
+		self.assertEqual(peripheral.requests, 1)
+
+	def test_failed_negotiation_is_retried(self):
+		peripheral = Peripheral([btle.BTLEException("timeout"), 247])
+		self.dev.onConnect(Link(peripheral))
+		self.assertEqual(self.dev.mtu, 23)
+		self.assertNotIn("mtu", self.cache.get(self.ADDRESS))
+		self.dev.onConnect(Link(peripheral))
+		self.assertEqual(self.dev.mtu, 247)
+		self.assertEqual(self.cache.get(self.ADDRESS)["mtu"], 247)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,45 @@
+import math
+import unittest
+
+from utils import PiecewiseCurve
+
+
+class PiecewiseCurveTest(unittest.TestCase):
+    def setUp(self):
+        # Flat from 0 to 10, ramp down to 20, flat again to 30
+        self.curve = PiecewiseCurve([0, 10, 20, 30], [100, 100, 50, 50], (0, 30))
+
+    def test_breakpoints_skip_flat_segments(self):
+        self.assertEqual(self.curve.breakpoints, (10, 20))
+
+    def test_descending_setpoints_are_sorted(self):
+        curve = PiecewiseCurve([30, 20, 10, 0], [50, 50, 100, 100])
+        self.assertEqual(curve.inArray, (0, 10, 20, 30))
+        self.assertEqual(curve.breakpoints, (10, 20))
+
+    def test_linear(self):
+        self.assertEqual(self.curve.linear(-5), 100)
+        self.assertEqual(self.curve.linear(15), 75)
+        self.assertEqual(self.curve.linear(15.5), 72.5)
+        self.assertEqual(self.curve.linear(40), 50)
+
+    def test_step(self):
+        self.assertEqual(self.curve.step(15, True), 50)
+        self.assertEqual(self.curve.step(15, False), 100)
+
+    def test_distance_moving_up(self):
+        self.assertEqual(self.curve.breakpoint_distance(4, 1), 6)
+        self.assertEqual(self.curve.breakpoint_distance(10, 1), 10)
+        self.assertEqual(self.curve.breakpoint_distance(25, 1), math.inf)
+
+    def test_distance_moving_down(self):
+        self.assertEqual(self.curve.breakpoint_distance(25, -1), 5)
+        self.assertEqual(self.curve.breakpoint_distance(20, -1), 10)
+        self.assertEqual(self.curve.breakpoint_distance(4, -1), math.inf)
+
+    def test_distance_not_moving(self):
+        self.assertEqual(self.curve.breakpoint_distance(15, 0), math.inf)
+
+
+if __name__ == "__main__":
+    unittest.main()
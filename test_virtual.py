@@ -0,0 +1,90 @@
+import unittest
+from array import array
+
+from battery import BatterySnapshot, NO_VOLTAGE
+from virtual import Aggregate, parse_topology
+
+
+def snapshot(voltage, current, soc, cells, charge_fet=True, balance_mask=0):
+	return BatterySnapshot(
+		voltage=voltage,
+		current=current,
+		soc=soc,
+		capacity=100,
+		capacity_remain=soc,
+		cycles=10,
+		charge_fet=charge_fet,
+		discharge_fet=True,
+		cell_count=len(cells),
+		cell_mv=array("H", cells),
+		balance_mask=balance_mask,
+	)
+
+
+class ParseTopologyTest(unittest.TestCase):
+	def test_forms(self):
+		self.assertEqual(parse_topology("2s4p", 8), (2, 4))
+		self.assertEqual(parse_topology("8S", 8), (8, 1))
+		self.assertEqual(parse_topology("4p", 8), (2, 4))
+		self.assertEqual(parse_topology("", 3), (3, 1))
+
+	def test_mismatch(self):
+		self.assertRaises(ValueError, parse_topology, "2s2p", 8)
+		self.assertRaises(ValueError, parse_topology, "3s", 8)
+		self.assertRaises(ValueError, parse_topology, "0p", 4)
+		self.assertRaises(ValueError, parse_topology, "2x4", 8)
+
+
+class AggregateTest(unittest.TestCase):
+	def setUp(self):
+		self.aggregate = Aggregate(2)
+		self.first = snapshot(13.2, 5, 80, [3300, 3310, 3290, 3300], balance_mask=0b0010)
+		self.second = snapshot(13.4, 5, 60, [3350, 3340, 3360, 3350])
+		self.aggregate.update(0, self.first)
+		self.aggregate.update(1, self.second)
+
+	def test_totals(self):
+		self.assertAlmostEqual(self.aggregate.voltage, 26.6)
+		self.assertEqual(self.aggregate.current, 10)
+		self.assertEqual(self.aggregate.soc, 60)
+		self.assertEqual(self.aggregate.members, 2)
+		self.assertEqual(self.aggregate.cell_count, 8)
+		self.assertEqual(list(self.aggregate.cells.mv), [3300, 3310, 3290, 3300, 3350, 3340, 3360, 3350])
+		self.assertEqual(self.aggregate.cells.balance_mask, 0b0010)
+		self.assertEqual((self.aggregate.minCell, self.aggregate.maxCell), (3290, 3360))
+
+	def test_unchanged_snapshot(self):
+		updates = self.aggregate.updates
+		self.assertFalse(self.aggregate.update(0, self.first))
+		self.assertEqual(self.aggregate.updates, updates)
+
+	def test_extreme_searched_again(self):
+		# The pack holding the lowest soc got better, the other one holds it now
+		self.aggregate.update(1, self.second.replace(soc=90))
+		self.assertEqual(self.aggregate.soc, 80)
+		self.assertEqual(self.aggregate.extremes["soc"], (80, 0))
+
+	def test_same_cell_count_keeps_layout(self):
+		layouts = self.aggregate.layouts
+		self.aggregate.update(0, self.first.replace(cell_mv=array("H", [3200, 3310, 3290, 3300]), balance_mask=0))
+		self.assertEqual(self.aggregate.layouts, layouts)
+		self.assertEqual(self.aggregate.minCell, 3200)
+		self.assertEqual(self.aggregate.cells.balance_mask, 0)
+
+	def test_pack_taken_out(self):
+		self.aggregate.update(0, None)
+		self.assertAlmostEqual(self.aggregate.voltage, 13.4)
+		self.assertEqual(self.aggregate.members, 1)
+		self.assertEqual(self.aggregate.cell_count, 4)
+		self.assertEqual(list(self.aggregate.cells.mv), [3350, 3340, 3360, 3350])
+
+	def test_fets_and_missing_cells(self):
+		self.aggregate.update(1, self.second.replace(charge_fet=False, cell_mv=array("H", [3350, 3340])))
+		self.assertFalse(self.aggregate.charge_fet)
+		self.assertTrue(self.aggregate.discharge_fet)
+		self.assertEqual(list(self.aggregate.cells.mv)[6:], [NO_VOLTAGE, NO_VOLTAGE])
+		self.assertEqual((self.aggregate.minCell, self.aggregate.maxCell), (3290, 3350))
+
+
+if __name__ == "__main__":
+	unittest.main()
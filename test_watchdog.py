@@ -0,0 +1,67 @@
+import unittest
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("bluepy.btle")
+
+import watchdog
+from watchdog import Watchdog
+
+
+class Clock(object):
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+
+class WatchdogTest(unittest.TestCase):
+	def setUp(self):
+		self.clock = Clock()
+		patcher = mock.patch.object(watchdog.time, "monotonic", self.clock)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.dog = Watchdog("aa:bb:cc:dd:ee:ff", thresholds=(60, 120, 180, 300), runCommand=lambda command: True)
+		self.steps = []
+		for name in watchdog.WATCHDOG_STEPS:
+			setattr(self.dog, name, lambda name=name: self.steps.append(name))
+
+	def test_fresh_data_does_nothing(self):
+		self.dog.check(self.clock.now - 10)
+		self.assertEqual(self.steps, [])
+
+	def test_late_check_takes_one_step(self):
+		lastData = self.clock.now - 1000
+		self.dog.check(lastData)
+		self.assertEqual(self.steps, ["reconnect"])
+		self.dog.check(lastData)
+		self.assertEqual(self.steps, ["reconnect"])
+
+	def test_steps_are_timed_from_the_last_step(self):
+		lastData = self.clock.now - 1000
+		self.dog.check(lastData)
+		self.clock.now += 59
+		self.dog.check(lastData)
+		self.assertEqual(self.steps, ["reconnect"])
+		self.clock.now += 1
+		self.dog.check(lastData)
+		self.assertEqual(self.steps, ["reconnect", "restartHelper"])
+		self.clock.now += 60
+		self.dog.check(lastData)
+		self.clock.now += 120
+		self.dog.check(lastData)
+		self.assertEqual(self.steps, list(watchdog.WATCHDOG_STEPS))
+
+	def test_data_back_resets_the_ladder(self):
+		lastData = self.clock.now - 60
+		self.dog.check(lastData)
+		self.clock.now += 10
+		self.dog.check(self.clock.now)
+		self.assertEqual(self.dog.level, 0)
+		self.assertEqual(self.dog.recoveries["reconnect"], 1)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -219,8 +219,92 @@ LIPRO_CELL_COUNT = int(config["DEFAULT"]["LIPRO_CELL_COUNT"])
 
 PUBLISH_CONFIG_VALUES = int(config["DEFAULT"]["PUBLISH_CONFIG_VALUES"])
 
+# -------- D-Bus publishing ---------
+# A path is only written to dbus when its value changed. Measured values also have to move by more
+# than their deadband, unless they were last published more than PUBLISH_MAX_INTERVAL seconds ago.
+PUBLISH_DEADBAND_CELL_VOLTAGE = float(
+    config["DEFAULT"]["PUBLISH_DEADBAND_CELL_VOLTAGE"]
+)
+PUBLISH_DEADBAND_VOLTAGE = float(config["DEFAULT"]["PUBLISH_DEADBAND_VOLTAGE"])
+PUBLISH_DEADBAND_CURRENT = float(config["DEFAULT"]["PUBLISH_DEADBAND_CURRENT"])
+PUBLISH_DEADBAND_POWER = float(config["DEFAULT"]["PUBLISH_DEADBAND_POWER"])
+PUBLISH_DEADBAND_TEMPERATURE = float(config["DEFAULT"]["PUBLISH_DEADBAND_TEMPERATURE"])
+PUBLISH_MAX_INTERVAL = float(config["DEFAULT"]["PUBLISH_MAX_INTERVAL"])
+# Send the paths changed in one publish cycle as a single ItemsChanged signal (True/False).
+PUBLISH_ITEMS_CHANGED = "True" == config["DEFAULT"]["PUBLISH_ITEMS_CHANGED"]
+# Publish when the BMS delivers a new sample (True/False), with a slow keep-alive in between
+PUBLISH_ON_FRAME = "True" == config["DEFAULT"]["PUBLISH_ON_FRAME"]
+PUBLISH_KEEPALIVE_INTERVAL = float(config["DEFAULT"]["PUBLISH_KEEPALIVE_INTERVAL"])
+
 BMS_TYPE = config["DEFAULT"]["BMS_TYPE"]
 
+# -------- Advertisement (BTHome) batteries ---------
+# Cells per pack, advertisements don't carry the cell count
+ADV_CELL_COUNT = int(config["DEFAULT"]["ADV_CELL_COUNT"])
+# Seconds without an advertisement before the battery counts as offline
+ADV_STALE_TIME = float(config["DEFAULT"]["ADV_STALE_TIME"])
+
+# -------- Bluetooth connections ---------
+# Adapters to use, all adapters found if empty
+BT_ADAPTERS = _get_list_from_config("DEFAULT", "BT_ADAPTERS", lambda v: v.strip())
+# Packs pinned to an adapter, as address=adapter
+BT_ADAPTER_PLACEMENT = dict(
+    (address.strip().lower(), adapter.strip())
+    for address, _, adapter in _get_list_from_config(
+        "DEFAULT", "BT_ADAPTER_PLACEMENT", lambda v: v.partition("=")
+    )
+)
+# Move a pack to another adapter when its link quality drops below this, 0 never moves packs
+BT_MIGRATE_QUALITY = float(config["DEFAULT"]["BT_MIGRATE_QUALITY"])
+# Size of the thread pool that drives the BMS connections of an adapter
+BT_WORKERS = int(config["DEFAULT"]["BT_WORKERS"])
+# Connection attempts that may run at the same time on an adapter
+BT_MAX_CONNECTING = int(config["DEFAULT"]["BT_MAX_CONNECTING"])
+# File with the GATT handles discovered per BMS, next to the driver if not set
+GATT_CACHE_FILE = config["DEFAULT"]["GATT_CACHE_FILE"].strip() or str(
+    path.joinpath("gatt_cache.json").absolute()
+)
+# Seconds without data from a pack before the watchdog reconnects it, restarts its bluepy-helper,
+# resets the adapter and reboots. Empty disables the watchdog.
+BT_WATCHDOG_STEPS = _get_list_from_config(
+    "DEFAULT", "BT_WATCHDOG_STEPS", lambda v: float(v)
+)
+BT_HCI_RESET_COMMAND = config["DEFAULT"]["BT_HCI_RESET_COMMAND"]
+BT_REBOOT_COMMAND = config["DEFAULT"]["BT_REBOOT_COMMAND"]
+# Minimum hours between two reboots by the watchdog
+BT_WATCHDOG_REBOOT_INTERVAL = float(config["DEFAULT"]["BT_WATCHDOG_REBOOT_INTERVAL"])
+# Connections an adapter holds at the same time, 0 is no limit. With more packs they take turns.
+BT_MAX_CONNECTIONS = int(config["DEFAULT"]["BT_MAX_CONNECTIONS"])
+# Seconds a pack may go without a sample when packs take turns, longer gaps are logged
+BT_MAX_STALENESS = float(config["DEFAULT"]["BT_MAX_STALENESS"])
+# Share of the time an adapter may spend polling, poll intervals are stretched beyond it
+BT_AIRTIME_BUDGET = float(config["DEFAULT"]["BT_AIRTIME_BUDGET"])
+
+# -------- Virtual battery ---------
+# Addresses of the packs that form one virtual battery, used when none are given on the command line
+VIRTUAL_BATTERIES = _get_list_from_config("DEFAULT", "VIRTUAL_BATTERIES", lambda v: v.strip())
+# Packs in series per string and strings in parallel, e.g. 2s4p, empty is all packs in series
+VIRTUAL_TOPOLOGY = config["DEFAULT"]["VIRTUAL_TOPOLOGY"]
+# Seconds the virtual battery waits for its packs each refresh, slower packs count with their last values
+VIRTUAL_REFRESH_DEADLINE = float(config["DEFAULT"]["VIRTUAL_REFRESH_DEADLINE"])
+
+# -------- Adaptive polling ---------
+# Poll interval range in seconds, fast when the pack changes quickly or a limit is close
+POLL_INTERVAL_MIN = float(config["DEFAULT"]["POLL_INTERVAL_MIN"])
+POLL_INTERVAL_MAX = float(config["DEFAULT"]["POLL_INTERVAL_MAX"])
+# Rates of change that ask for the fastest polling
+POLL_FAST_CURRENT_RATE = float(config["DEFAULT"]["POLL_FAST_CURRENT_RATE"])
+POLL_FAST_SPREAD_RATE = float(config["DEFAULT"]["POLL_FAST_SPREAD_RATE"])
+POLL_FAST_TEMPERATURE_RATE = float(config["DEFAULT"]["POLL_FAST_TEMPERATURE_RATE"])
+# Distance to a setpoint of an enabled limit curve from which polling speeds up
+POLL_BREAKPOINT_MARGIN_VOLTAGE = float(
+    config["DEFAULT"]["POLL_BREAKPOINT_MARGIN_VOLTAGE"]
+)
+POLL_BREAKPOINT_MARGIN_TEMPERATURE = float(
+    config["DEFAULT"]["POLL_BREAKPOINT_MARGIN_TEMPERATURE"]
+)
+POLL_BREAKPOINT_MARGIN_SOC = float(config["DEFAULT"]["POLL_BREAKPOINT_MARGIN_SOC"])
+
 
 def constrain(val, min_val, max_val):
     if min_val > max_val:
@@ -272,6 +356,120 @@ def calcStepRelationship(inValue, inArray, outArray, returnLower):
     return outArray[idx] if returnLower else outArray[idx - 1]
 
 
+class PiecewiseCurve:
+    """
+    A limit curve compiled once from its setpoints, for calcLinearRelationship() and
+    calcStepRelationship() style lookups without allocating on every call.
+    The setpoints are sorted by input and the step widths are precomputed. If lut_range
+    (min, max) is given, the results for whole numbers in that range are precomputed too.
+    """
+
+    __slots__ = (
+        "inArray",
+        "outArray",
+        "dIn",
+        "dOut",
+        "breakpoints",
+        "lut_min",
+        "lut_max",
+        "lut",
+    )
+
+    def __init__(self, inArray, outArray, lut_range=None):
+        inArray = list(inArray)
+        outArray = list(outArray)
+        if inArray and inArray[0] > inArray[-1]:  # change compare-direction in array
+            inArray.reverse()
+            outArray.reverse()
+
+        self.inArray = tuple(inArray)
+        self.outArray = tuple(outArray)
+        count = min(len(inArray), len(outArray))
+        self.dIn = (0,) + tuple(inArray[i - 1] - inArray[i] for i in range(1, count))
+        self.dOut = (0,) + tuple(outArray[i - 1] - outArray[i] for i in range(1, count))
+        # The setpoints next to a segment where the output changes, flat ones don't matter
+        self.breakpoints = tuple(
+            inArray[i]
+            for i in range(count)
+            if (i > 0 and self.dOut[i]) or (i + 1 < count and self.dOut[i + 1])
+        )
+
+        self.lut_min = self.lut_max = None
+        self.lut = None
+        if lut_range is not None and inArray:
+            lut_min, lut_max = lut_range
+            try:
+                # [linear, step returning lower, step returning upper] per whole number
+                self.lut = tuple(
+                    (self.linear(v), self.step(v, True), self.step(v, False))
+                    for v in range(lut_min, lut_max + 1)
+                )
+                self.lut_min = lut_min
+                self.lut_max = lut_max
+            except (IndexError, ZeroDivisionError):
+                self.lut = None
+
+    def _lut_entry(self, inValue):
+        if self.lut_min <= inValue <= self.lut_max:
+            idx = int(inValue)
+            if idx == inValue:
+                return self.lut[idx - self.lut_min]
+        return None
+
+    def linear(self, inValue):
+        inArray = self.inArray
+        # Handle out of bounds
+        if inValue <= inArray[0]:
+            return self.outArray[0]
+        if inValue >= inArray[-1]:
+            return self.outArray[-1]
+
+        if self.lut is not None:
+            entry = self._lut_entry(inValue)
+            if entry is not None:
+                return entry[0]
+
+        # else calculate linear current between the setpoints
+        idx = bisect.bisect(inArray, inValue)
+        lowerOUT = self.outArray[idx]
+        return constrain(
+            lowerOUT + ((inValue - inArray[idx]) / self.dIn[idx]) * self.dOut[idx],
+            lowerOUT,
+            self.outArray[idx - 1],
+        )
+
+    def step(self, inValue, returnLower):
+        inArray = self.inArray
+        # Handle out of bounds
+        if inValue <= inArray[0]:
+            return self.outArray[0]
+        if inValue >= inArray[-1]:
+            return self.outArray[-1]
+
+        if self.lut is not None:
+            entry = self._lut_entry(inValue)
+            if entry is not None:
+                return entry[1] if returnLower else entry[2]
+
+        # else get index between the setpoints
+        idx = bisect.bisect(inArray, inValue)
+        return self.outArray[idx] if returnLower else self.outArray[idx - 1]
+
+    def breakpoint_distance(self, inValue, direction):
+        # Distance from inValue to the next setpoint where the limit changes, in the direction
+        # the value moves (> 0 up, < 0 down). Infinite if it doesn't move or none is ahead.
+        breakpoints = self.breakpoints
+        if direction > 0:
+            idx = bisect.bisect_right(breakpoints, inValue)
+            if idx < len(breakpoints):
+                return breakpoints[idx] - inValue
+        elif direction < 0:
+            idx = bisect.bisect_left(breakpoints, inValue)
+            if idx > 0:
+                return inValue - breakpoints[idx - 1]
+        return float("inf")
+
+
 def is_bit_set(tmp):
     return False if tmp == zero_char else True
 
@@ -289,7 +487,35 @@ def format_value(value, prefix, suffix):
         + ("" if suffix is None else suffix)
     )
 
+# -------- Compiled limit curves ---------
+# The limit setpoints from above compiled once, used by Battery to calculate CCL/DCL/CVL
+SOC_LUT_RANGE = (0, 100)
+# Battery.to_temp() keeps temperatures in this range
+TEMPERATURE_LUT_RANGE = (-20, 100)
 
+CHARGE_CURRENT_CV_CURVE = PiecewiseCurve(
+    CELL_VOLTAGES_WHILE_CHARGING, MAX_CHARGE_CURRENT_CV
+)
+DISCHARGE_CURRENT_CV_CURVE = PiecewiseCurve(
+    CELL_VOLTAGES_WHILE_DISCHARGING, MAX_DISCHARGE_CURRENT_CV
+)
+CHARGE_CURRENT_T_CURVE = PiecewiseCurve(
+    TEMPERATURE_LIMITS_WHILE_CHARGING, MAX_CHARGE_CURRENT_T, TEMPERATURE_LUT_RANGE
+)
+DISCHARGE_CURRENT_T_CURVE = PiecewiseCurve(
+    TEMPERATURE_LIMITS_WHILE_DISCHARGING, MAX_DISCHARGE_CURRENT_T, TEMPERATURE_LUT_RANGE
+)
+CHARGE_CURRENT_SOC_CURVE = PiecewiseCurve(
+    [100, CC_SOC_LIMIT1, CC_SOC_LIMIT2, CC_SOC_LIMIT3],
+    [CC_CURRENT_LIMIT1, CC_CURRENT_LIMIT2, CC_CURRENT_LIMIT3, MAX_BATTERY_CHARGE_CURRENT],
+    SOC_LUT_RANGE,
+)
+DISCHARGE_CURRENT_SOC_CURVE = PiecewiseCurve(
+    [DC_SOC_LIMIT3, DC_SOC_LIMIT2, DC_SOC_LIMIT1],
+    [MAX_BATTERY_DISCHARGE_CURRENT, DC_CURRENT_LIMIT3, DC_CURRENT_LIMIT2, DC_CURRENT_LIMIT1],
+    SOC_LUT_RANGE,
+)
+PENALTY_CURVE = PiecewiseCurve(PENALTY_AT_CELL_VOLTAGE, PENALTY_BATTERY_VOLTAGE)
 
 
 locals_copy = locals().copy()
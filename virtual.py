@@ -1,7 +1,10 @@
-from battery import Protection, Battery, Cell
+from battery import Protection, Battery, Cell, CellArray, NO_VOLTAGE
+from array import array
+from concurrent.futures import ThreadPoolExecutor, wait
 from utils import *
 from struct import *
 import argparse
+import re
 import sys
 import time
 import binascii
@@ -9,115 +12,332 @@ import atexit
 
 
 
-class Virtual(Battery):
-	def __init__(self, b1=None, b2=None, b3=None, b4=None):
-		Battery.__init__(self, 0, 0, 0)
+def parse_topology(topology, count):
+	"""
+	Packs in series per string and strings in parallel of a topology like 2s4p, 8s or 4p, for
+	count packs. Empty puts all packs in series. Raises ValueError if it doesn't fit count.
+	"""
+	match = re.fullmatch(r"(?:(\d+)s)?(?:(\d+)p)?", topology.strip().lower())
+	if match is None:
+		raise ValueError(f"Invalid topology '{topology}', expected e.g. 2s4p")
+	series, parallel = (int(n) if n else None for n in match.groups())
+	if series is None and parallel is None:
+		series, parallel = count, 1
+	elif series is None:
+		series = count // parallel if parallel else 0
+	elif parallel is None:
+		parallel = count // series if series else 0
+	if series < 1 or parallel < 1 or series * parallel != count:
+		raise ValueError(f"Topology '{topology}' doesn't fit {count} packs")
+	return series, parallel
 
-		self.type = "Virtual"
-		self.port = "/" + self.type
 
-		self.batts = []
-		if b1:
-			self.batts.append(b1)
-		if b2:
-			self.batts.append(b2)
-		if b3:
-			self.batts.append(b3)
-		if b4:
-			self.batts.append(b4)
-		
 
-	def test_connection(self):
-		return False
+# Fields of the packs that are added up, and the ones where one pack sets the value of the bank
+AGGREGATE_SUMS = ("voltage", "current")
+AGGREGATE_EXTREMES = (("soc", min), ("capacity", min), ("capacity_remain", min), ("cycles", max))
 
 
-	def get_settings(self):
-		self.voltage = 0
-		self.current = 0
-		self.cycles = 0
-		self.production = 0
-		self.soc = 0
-		self.cell_count = 0
-		self.capacity = 0
-		self.capacity_remain = 0
-		self.charge_fet	= True
-		self.discharge_fet = True
 
-		result = False
-		# Loop through all batteries
-		for b in self.batts:
-			result = b.get_settings();
-			if result:
-				# Add battery voltages together
-				self.voltage += b.voltage
-			
-				# Add cell counts
-				self.cell_count += b.cell_count
+class Aggregate(object):
+	"""
+	The totals of the packs of a virtual battery, kept up to date from their snapshots.
 
-				# Add current values, and div by cell count after the loop to get avg
-				self.current += b.current
+	update() only does work for a pack whose snapshot changed: sums are corrected by the
+	difference, FETs are counted, and an extreme is only searched again among all packs when
+	the pack that held it got worse. Its cells are copied into its place in cells, all packs
+	are only laid out again when a cell count changed. A snapshot of None takes a pack out.
+	The packs are in series, Virtual keeps an Aggregate per string.
+	"""
 
-				# Use the highest cycle count 
-				if b.cycles > self.cycles:
-					self.cycles = b.cycles
-				
-				# Use the lowest capacity value
-				if b.capacity < self.capacity or self.capacity == 0:
-					self.capacity = b.capacity
+	def __init__(self, count):
+		self.snapshots = [None] * count
+		# First cell of each pack in cells, and the end of the last one
+		self.offsets = [0] * (count + 1)
+		self.cells = CellArray()
+		self.cell_count = 0
+		self.members = 0
+		self.chargeOff = 0
+		self.dischargeOff = 0
+		# Lowest and highest cell in mV, NO_VOLTAGE and 0 without cells
+		self.minCell = NO_VOLTAGE
+		self.maxCell = 0
+		for name in AGGREGATE_SUMS:
+			setattr(self, name, 0)
+		# (value, index of the pack) of each extreme, the value is also an attribute
+		self.extremes = {}
+		for name, _ in AGGREGATE_EXTREMES:
+			self.extremes[name] = (None, None)
+			setattr(self, name, None)
+		self.updates = 0
+		self.layouts = 0
+
+	@property
+	def charge_fet(self):
+		return self.chargeOff == 0
+
+	@property
+	def discharge_fet(self):
+		return self.dischargeOff == 0
+
+	def update(self, index, snapshot):
+		# Take the snapshot of pack index into account, true if anything changed
+		old = self.snapshots[index]
+		if snapshot is old:
+			return False
+		self.snapshots[index] = snapshot
+		self.updates += 1
+		self.members += (snapshot is not None) - (old is not None)
+
+		for name in AGGREGATE_SUMS:
+			setattr(self, name, getattr(self, name) - self.value(old, name) + self.value(snapshot, name))
+		self.chargeOff += self.off(snapshot, "charge_fet") - self.off(old, "charge_fet")
+		self.dischargeOff += self.off(snapshot, "discharge_fet") - self.off(old, "discharge_fet")
+
+		for name, pick in AGGREGATE_EXTREMES:
+			current, holder = self.extremes[name]
+			value = None if snapshot is None else getattr(snapshot, name)
+			if value is not None and (holder is None or pick(value, current) == value):
+				self.extremes[name] = (value, index)
+			elif holder == index:
+				self.extremes[name] = self.search(name, pick)
+			setattr(self, name, self.extremes[name][0])
+
+		if self.count(snapshot) == self.offsets[index + 1] - self.offsets[index]:
+			self.copyCells(index)
+		else:
+			self.layout()
+
+		mv = self.cells.mv
+		if NO_VOLTAGE in mv:
+			mv = [v for v in mv if v != NO_VOLTAGE]
+		self.minCell = min(mv, default=NO_VOLTAGE)
+		self.maxCell = max(mv, default=0)
+		return True
+
+	def value(self, snapshot, name):
+		return 0 if snapshot is None else getattr(snapshot, name) or 0
+
+	def off(self, snapshot, name):
+		return 0 if snapshot is None or getattr(snapshot, name) else 1
+
+	def count(self, snapshot):
+		return 0 if snapshot is None else snapshot.cell_count or 0
+
+	def search(self, name, pick):
+		candidates = [
+			(getattr(snapshot, name), index)
+			for index, snapshot in enumerate(self.snapshots)
+			if snapshot is not None and getattr(snapshot, name) is not None
+		]
+		return pick(candidates, key=lambda c: c[0]) if candidates else (None, None)
+
+	def layout(self):
+		# Place the cells of all packs one after another
+		self.layouts += 1
+		offset = 0
+		for index, snapshot in enumerate(self.snapshots):
+			self.offsets[index] = offset
+			offset += self.count(snapshot)
+		self.offsets[-1] = offset
+		self.cell_count = offset
+		self.cells.resize(offset)
+		for index in range(len(self.snapshots)):
+			self.copyCells(index)
+
+	def copyCells(self, index):
+		snapshot = self.snapshots[index]
+		offset = self.offsets[index]
+		count = self.offsets[index + 1] - offset
+		if not count:
+			return
+		mv = self.cells.mv
+		known = 0
+		if snapshot.cell_mv is not None:
+			known = min(count, len(snapshot.cell_mv))
+			mv[offset : offset + known] = snapshot.cell_mv[:known]
+		if known < count:
+			mv[offset + known : offset + count] = array("H", [NO_VOLTAGE]) * (count - known)
+		field = (1 << count) - 1
+		cells = self.cells
+		cells.balance_mask = (cells.balance_mask & ~(field << offset)) | ((snapshot.balance_mask or 0) & field) << offset
 
-				# Use the lowest capacity_remain value
-				if b.capacity_remain < self.capacity_remain or self.capacity_remain == 0:
-					self.capacity_remain = b.capacity_remain
 
-				# Use the lowest SOC value
-				if b.soc < self.soc or self.soc == 0:
-					self.soc = b.soc
 
-				self.charge_fet &= b.charge_fet 
-				self.discharge_fet &= b.discharge_fet 
+class Virtual(Battery):
+	"""
+	One battery made of any number of packs, in strings of packs in series that are in parallel
+	with each other. The topology, e.g. 2s4p, gives the packs per string and the number of
+	strings, the packs are listed string by string. The packs must publish snapshots, the
+	totals are only updated for the strings whose snapshot changed, see Aggregate.
+
+	The currents and capacities of the strings add up, the voltage is their average. The
+	weakest cells set the limits: the charge limits of one string are worked out for the
+	highest cell of all strings, the discharge limits for the lowest, and both are multiplied
+	by the number of strings whose FET is on. The cells shown are those of the first string
+	with data, so the cell paths don't jump between strings. The min and max cell are those of
+	all strings, their id names the string too, e.g. S2C5.
+
+	The packs are refreshed at the same time, each in a thread of a pool. A pack that doesn't
+	answer within deadline seconds doesn't hold up the others: its last values are used and its
+	call is left running, to be picked up by the next refresh.
+	"""
+
+	def __init__(self, *batts, topology=VIRTUAL_TOPOLOGY, deadline=VIRTUAL_REFRESH_DEADLINE):
+		Battery.__init__(self, 0, 0, 0)
 
+		self.type = "Virtual"
+		self.port = "/" + self.type
 
-		self.cells = [None]*self.cell_count
+		self.batts = [b for b in batts if b]
+		self.series, self.parallel = parse_topology(topology, len(self.batts))
+		# The plan: string and place in the string of each pack
+		self.plan = [divmod(index, self.series) for index in range(len(self.batts))]
+		self.strings = [Aggregate(self.series) for _ in range(self.parallel)]
+		# The cells of the first string, kept up to date by its Aggregate
+		self.cells = self.strings[0].cells
+		self.cell_count = 0
+		# Highest and lowest cell of all strings, used by the cell voltage limits, and where they are
+		self.cell_max_voltage = None
+		self.cell_min_voltage = None
+		self.cell_max_desc = None
+		self.cell_min_desc = None
+		# Strings whose charge and discharge FET is on
+		self.chargeStrings = 0
+		self.dischargeStrings = 0
+		self.current = 0
+		self.production = 0
+		self.deadline = deadline
+		self.pool = ThreadPoolExecutor(max_workers=max(len(self.batts), 1), thread_name_prefix="virtual")
+		# Calls of the packs that missed the deadline and are still running
+		self.pending = {}
+		self.missed = 0
 
-		bcnt = len(self.batts)
+		# A fresh sample from any battery is a fresh sample of the virtual battery
+		for b in self.batts:
+			b.set_data_callback(self.notify_data)
 
-		if bcnt:
-			# Avg the current
-			self.current /= bcnt
+	def test_connection(self):
+		return False
 
+	def call(self, method, timeout=None):
+		# Call method of all batteries at once, returns the result of each, or None if it is still running
+		futures = []
+		for b in self.batts:
+			future = self.pending.get(b)
+			if future is None or future.done():
+				future = self.pool.submit(getattr(b, method))
+			futures.append(future)
+
+		done, _ = wait(futures, timeout)
+		results = []
+		for b, future in zip(self.batts, futures):
+			if future in done:
+				self.pending.pop(b, None)
+				results.append(future.result())
+			else:
+				self.pending[b] = future
+				self.missed += 1
+				logger.info(f"{b.port} missed the {timeout}s deadline of {method} ({self.missed} times), using its last values")
+				results.append(None)
+		return results
+
+	def aggregate(self, results):
+		# Only the packs with a new snapshot change the totals, nothing of a pack is parsed again
+		result = True
+		changed = False
+		for b, ok, (string, place) in zip(self.batts, results, self.plan):
+			if ok is None:
+				# Still running, use the last values if it had any
+				ok = b.applied_snapshot is not None
+			result &= bool(ok)
+			changed |= self.strings[string].update(place, b.applied_snapshot if ok else None)
+		if changed:
+			self.combine()
+
+		if self.batts:
 			# Use the temp sensors from the first battery?
 			self.temp_sensors = self.batts[0].temp_sensors
 			self.temp1 = self.batts[0].temp1
 			self.temp2 = self.batts[0].temp2
-
-
+		return result and len(self.batts) > 0
+
+	def combine(self):
+		# The values of the battery from the strings that have data, once per change
+		strings = [s for s in self.strings if s.members]
+		if not strings:
+			return
+		# Strings that miss a pack would pull the voltage down
+		complete = [s for s in strings if s.members == self.series] or strings
+		self.voltage = sum(s.voltage for s in complete) / len(complete)
+
+		# The current through a string is the average of its packs, the strings add up
+		self.current = sum(s.current / s.members for s in strings)
+		self.capacity = sum(s.capacity or 0 for s in strings)
+		self.capacity_remain = sum(s.capacity_remain or 0 for s in strings)
+		if self.capacity:
+			# SOC of the strings, weighted by their capacity
+			self.soc = sum((s.soc or 0) * (s.capacity or 0) for s in strings) / self.capacity
+		else:
+			self.soc = min((s.soc for s in strings if s.soc is not None), default=0)
+		self.cycles = max((s.cycles for s in strings if s.cycles is not None), default=0)
+
+		self.chargeStrings = sum(1 for s in strings if s.charge_fet)
+		self.dischargeStrings = sum(1 for s in strings if s.discharge_fet)
+		self.charge_fet = self.chargeStrings > 0
+		self.discharge_fet = self.dischargeStrings > 0
+
+		high = max(strings, key=lambda s: s.maxCell)
+		low = min(strings, key=lambda s: s.minCell)
+		self.cell_max_voltage = high.maxCell / 1000 if high.maxCell else None
+		self.cell_min_voltage = low.minCell / 1000 if low.minCell != NO_VOLTAGE else None
+		self.cell_max_desc = self.cellDesc(high, high.maxCell) if high.maxCell else None
+		self.cell_min_desc = self.cellDesc(low, low.minCell) if low.minCell != NO_VOLTAGE else None
+
+		self.cells = strings[0].cells
+		self.cell_count = strings[0].cell_count
 		self.max_battery_voltage = MAX_CELL_VOLTAGE * self.cell_count
 		self.min_battery_voltage = MIN_CELL_VOLTAGE * self.cell_count
 
-		self.max_battery_charge_current = MAX_BATTERY_CHARGE_CURRENT
-		self.max_battery_discharge_current = MAX_BATTERY_DISCHARGE_CURRENT
-		return result
 
+	def cellDesc(self, string, mv):
+		# Name of the cell of string with mv, e.g. C5, or S2C5 with strings in parallel
+		desc = "C" + str(string.cells.mv.index(mv) + 1)
+		if self.parallel > 1:
+			desc = "S" + str(self.strings.index(string) + 1) + desc
+		return desc
 
-	def refresh_data(self):
-		result = self.get_settings()
+	def get_min_cell_desc(self):
+		# The lowest cell of all strings, like the min cell voltage
+		return self.cell_min_desc
 
-		# Clear cells list
-		self.cells: List[Cell] = []
+	def get_max_cell_desc(self):
+		return self.cell_max_desc
 
-		result2 = False
-		# Loop through all batteries
-		for b in self.batts:
-			result2 = b.refresh_data();
-			if result2:
-				# Append cells list
-				self.cells += b.cells
+
+	def manage_charge_current(self):
+		# Battery works out the limits of one string, for the highest and lowest cell of all
+		# strings. The current splits over the strings that can take it, without any the FET
+		# being off blocks it.
+		Battery.manage_charge_current(self)
+		self.control_charge_current *= max(self.chargeStrings, 1)
+		self.control_discharge_current *= max(self.dischargeStrings, 1)
 
 
-		result = result and result2
+	def get_settings(self):
+		# Waits for all batteries, they block until they have data
+		result = self.aggregate(self.call("get_settings"))
+
+		# The limits of one string, see manage_charge_current()
+		self.max_battery_charge_current = MAX_BATTERY_CHARGE_CURRENT
+		self.max_battery_discharge_current = MAX_BATTERY_DISCHARGE_CURRENT
 		return result
 
 
+	def refresh_data(self):
+		return self.aggregate(self.call("refresh_data", self.deadline))
+
+
 	def log_settings(self):
 		# Override log_settings() to call get_settings() first
 		self.get_settings()
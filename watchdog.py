@@ -0,0 +1,133 @@
+from btmanager import get_manager
+from utils import *
+import subprocess
+import time
+
+# Recovery steps, in the order they are tried. Each name is a method of Watchdog.
+WATCHDOG_STEPS = ("reconnect", "restartHelper", "resetAdapter", "reboot")
+
+# Seconds between two resets of the same adapter, whichever pack asks for them
+WATCHDOG_ADAPTER_RESET_INTERVAL = 60
+# Holds the time of the last reboot by the watchdog, to rate limit them across reboots
+WATCHDOG_REBOOT_FILE = str(path.joinpath(".watchdog_reboot").absolute())
+
+# Time of the last reset per adapter
+adapterResets = {}
+
+
+def run_command(command):
+	# Run a recovery command, true if it succeeded
+	try:
+		result = subprocess.run(command, shell=True, timeout=30)
+	except (OSError, subprocess.SubprocessError) as ex:
+		logger.info(f"Watchdog command '{command}' failed: {ex}")
+		return False
+	if result.returncode != 0:
+		logger.info(f"Watchdog command '{command}' returned {result.returncode}")
+	return result.returncode == 0
+
+
+
+class Watchdog(object):
+	"""
+	Recovers a pack that stopped delivering data, with the cheapest step that helps.
+
+	When no data arrived for thresholds[0] seconds the pack is reconnected, after thresholds[1]
+	its bluepy-helper is killed and started again, after thresholds[2] the adapter is reset
+	and after thresholds[3] the system reboots. It takes at most one step per check(), and
+	each step gets the time up to the next threshold to help, counted from when it was taken.
+	So a late check after a long stall doesn't run the whole ladder at once. Adapter resets
+	and reboots are rate limited, as they hit every pack. When the last step didn't help
+	either, the ladder starts over.
+
+	Each step is logged and counted in counts, recoveries counts by the last step taken
+	before data came back. runCommand(command) runs the reset and reboot commands and can be
+	replaced, e.g. for testing.
+	"""
+
+	def __init__(self, address, thresholds=BT_WATCHDOG_STEPS, adapter="hci0", runCommand=run_command):
+		# adapter is only used for packs that aren't connected through the BtManager
+		self.address = address
+		self.thresholds = tuple(thresholds)[:len(WATCHDOG_STEPS)]
+		self.adapter = adapter
+		self.runCommand = runCommand
+		self.level = 0
+		self.since = 0
+		self.lastStep = 0
+		self.counts = {name: 0 for name in WATCHDOG_STEPS}
+		self.recoveries = {name: 0 for name in WATCHDOG_STEPS}
+
+	def check(self, lastData):
+		# Called regularly with the monotonic time of the last data of the pack
+		if not self.thresholds:
+			return
+
+		now = time.monotonic()
+		if now - lastData < self.thresholds[0]:
+			if self.level:
+				step = WATCHDOG_STEPS[self.level - 1]
+				self.recoveries[step] += 1
+				logger.info(f"{self.address} data is back after watchdog step {step}")
+				self.level = 0
+			self.since = 0
+			return
+
+		# One step per call, each step gets the time between its threshold and the next one to help
+		if self.level == 0:
+			due = max(lastData, self.since) + self.thresholds[0]
+		else:
+			due = self.lastStep + self.thresholds[self.level] - self.thresholds[self.level - 1]
+		if now < due:
+			return
+
+		step = WATCHDOG_STEPS[self.level]
+		self.level += 1
+		self.lastStep = now
+		self.counts[step] += 1
+		logger.info(f"{self.address} no data for {now - lastData:.0f}s, watchdog step {self.level}: {step} ({self.counts[step]} times)")
+		getattr(self, step)()
+
+		if self.level == len(self.thresholds):
+			# Nothing helped, start over with the cheap steps
+			self.level = 0
+			self.since = now
+
+	def reconnect(self):
+		get_manager().reconnect(self.address)
+
+	def restartHelper(self):
+		get_manager().restartHelper(self.address)
+
+	def resetAdapter(self):
+		# The adapter the pack is on now, it may have moved
+		adapter = get_manager().adapterOf(self.address) or self.adapter
+		now = time.monotonic()
+		last = adapterResets.get(adapter)
+		if last is not None and now - last < WATCHDOG_ADAPTER_RESET_INTERVAL:
+			logger.info(f"{adapter} was reset {now - last:.0f}s ago, not resetting again")
+			return
+		adapterResets[adapter] = now
+		self.runCommand(BT_HCI_RESET_COMMAND.format(adapter=adapter))
+
+	def reboot(self):
+		try:
+			with open(WATCHDOG_REBOOT_FILE) as f:
+				last = float(f.read())
+		except (OSError, ValueError):
+			last = 0
+
+		now = time.time()
+		if now - last < BT_WATCHDOG_REBOOT_INTERVAL * 3600:
+			logger.info(f"Watchdog rebooted {(now - last) / 3600:.1f}h ago, not rebooting again")
+			return
+
+		try:
+			with open(WATCHDOG_REBOOT_FILE, "w") as f:
+				f.write(str(now))
+		except OSError as ex:
+			# Without the time stamp we can't rate limit, so don't reboot at all
+			logger.info(f"Cannot write {WATCHDOG_REBOOT_FILE}, not rebooting: {ex}")
+			return
+
+		logger.info('Watchdog timer expired. BT chipset might be locked up. Rebooting')
+		self.runCommand(BT_REBOOT_COMMAND)